@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+
+"""
+Times the frames of the game over scripted routes around the real maps, as fast
+as it can go without a window, and prints the timings for each phase of a frame.
+
+usage: python benchmark.py [--save <file>] [--compare <file>] [map ...]
+
+The results can be saved as JSON and compared with those of an earlier run, eg.
+to see the effect of a change.
+"""
+
+import os
+import sys
+
+# draw to a dummy video driver, unless another one is asked for
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+pygame.init()
+
+import rpg.states
+import rpg.benchmark
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    savePath, comparePath = None, None
+    if "--save" in args:
+        savePath = args.pop(args.index("--save") + 1)
+        args.remove("--save")
+    if "--compare" in args:
+        comparePath = args.pop(args.index("--compare") + 1)
+        args.remove("--compare")
+    rpg.states.initDisplay()
+    results = rpg.benchmark.runBenchmarks(args)
+    baseResults = rpg.benchmark.loadResults(comparePath) if comparePath else None
+    print rpg.benchmark.formatResults(results, baseResults)
+    if savePath:
+        rpg.benchmark.saveResults(results, savePath)
@@ -0,0 +1,12 @@
+#! /usr/bin/env python
+
+"""
+Compiles every map in the maps folder into the binary .mapc format.  Compiled
+maps are loaded in preference to the text files, unless the text file has been
+changed since it was compiled - so re-run this after editing any maps.
+"""
+
+import rpg.parser
+
+if __name__ == '__main__':
+    rpg.parser.compileMaps()
@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+
+"""
+Times the map and collision primitives - movement checks, masks, span tiles,
+actions and tile levels - against every map in the maps folder and some dense
+synthetic maps, and prints the calls per second and retained containers per
+call.
+
+usage: python mapbenchmark.py [--save <file>] [--compare <file>] [map ...]
+
+The results can be saved as JSON and compared with those of an earlier run, eg.
+to see the effect of a change.
+"""
+
+import sys
+import pygame
+
+pygame.init()
+
+import rpg.benchmark
+import rpg.mapbenchmark
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    savePath, comparePath = None, None
+    if "--save" in args:
+        savePath = args.pop(args.index("--save") + 1)
+        args.remove("--save")
+    if "--compare" in args:
+        comparePath = args.pop(args.index("--compare") + 1)
+        args.remove("--compare")
+    results = rpg.mapbenchmark.runBenchmarks(args)
+    baseResults = rpg.benchmark.loadResults(comparePath) if comparePath else None
+    print rpg.mapbenchmark.formatResults(results, baseResults)
+    if savePath:
+        rpg.benchmark.saveResults(results, savePath)
@@ -2,6 +2,7 @@
 
 from pygame.locals import KEYDOWN, K_ESCAPE, K_x, K_UP, K_DOWN, K_LEFT, K_RIGHT, K_SPACE, QUIT
 
+import sys
 import time
 import pygame
 import cwiid
@@ -19,6 +20,9 @@ pygame.init()
 
 import rpg.states
 
+from rpg.gameclock import GameClock
+from rpg.replay import Recorder, Replay, loadRecording
+
 def initWiimote():
     try:
         print "Press 1+2 on the Wii-mote to connect"
@@ -47,30 +51,70 @@ def getPressed():
 
     return keyPresses
 
-def playMain():
+def playMain(recorder = None):
     # get the first state
+    rpg.states.initDisplay()
     currentState = rpg.states.showTitle()
     # start the main loop
-    clock = pygame.time.Clock()
+    clock = GameClock(rpg.states.FRAMES_PER_SEC)
     while True:
-        clock.tick(rpg.states.FRAMES_PER_SEC)
+        # the game logic runs at a fixed rate - if we're running behind we
+        # catch up by running more than one tick before drawing the next frame
+        ticks = clock.tick()
         for event in pygame.event.get():
             if event.type == QUIT or (event.type == KEYDOWN and event.key == K_ESCAPE):
+                print clock.getStats()
                 return
             if event.type == KEYDOWN and event.key == K_x:
                 # mute sound handler
                 rpg.states.soundHandler.toggleSound()
         # detect key presses
         keyPresses = getPressed()
-        # delegate key presses to the current state
-        newState = currentState.execute(keyPresses)
-        # flush sounds
-        rpg.states.soundHandler.flush()
-        # change state if necessary
-        if newState:
-            currentState = newState
+        for i in range(ticks):
+            if recorder:
+                recorder.startTick(currentState, keyPresses)
+            # delegate key presses to the current state
+            newState = currentState.execute(keyPresses)
+            # flush sounds
+            rpg.states.soundHandler.flush()
+            # change state if necessary
+            if newState:
+                currentState = newState
+            if recorder:
+                recorder.endTick(currentState)
+        # most states draw as they execute, but the play state draws separately -
+        # this is whichever state is current after the ticks, so a play state
+        # that has just taken over is drawn straight away
+        if hasattr(currentState, "drawFrame"):
+            currentState.drawFrame()
+
+"""
+Plays back a recording made with --record, either at the normal rate or as fast
+as it can go, and reports any ticks where the game differs from the recording.
+"""
+def replayMain(recording, realTime):
+    rpg.states.initDisplay()
+    replay = Replay(recording)
+    seconds = replay.run(realTime)
+    replay.stop()
+    print replay.getStats(seconds)
+    if replay.mismatches:
+        print "first mismatch at tick %d" % replay.mismatches[0]
 
 # this calls the testMain function when this script is executed
 if __name__ == '__main__':
-    wii = initWiimote()
-    playMain()
+    # usage: play.py [--record <file> | --replay <file> [--uncapped]]
+    args = sys.argv[1:]
+    if "--replay" in args:
+        recording = loadRecording(args[args.index("--replay") + 1])
+        replayMain(recording, "--uncapped" not in args)
+    else:
+        wii = initWiimote()
+        recorder = None
+        if "--record" in args:
+            recordPath = args[args.index("--record") + 1]
+            recorder = Recorder()
+        playMain(recorder)
+        if recorder and recorder.recording:
+            recorder.recording.save(recordPath)
+            print "recorded %d ticks to %s" % (recorder.recording.getTicks(), recordPath)
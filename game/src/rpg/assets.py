@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+
+from __future__ import with_statement
+
+import threading
+import view
+
+from collections import OrderedDict
+
+# the number of bytes of surface memory the cache tries to keep within
+ASSET_BUDGET = 32 * 1024 * 1024
+
+# asset kinds, used as the first part of each key
+MAP = "map"
+TILE_SET = "tileset"
+IMAGE = "image"
+STATIC_FRAMES = "staticframes"
+MOVEMENT_FRAMES = "movementframes"
+FONT_GLYPHS = "fontglyphs"
+
+"""
+A central cache for the game's assets - maps, tile sets and images - with
+accounting of the surface memory each asset holds.  Assets are kept in least
+recently used order and when the total goes over budget the least recently
+used assets are evicted, apart from any that are pinned (eg. the current map).
+An asset is sized by its getSize method if it has one, otherwise it is assumed
+to be a surface.
+
+Subsurfaces keep their parent alive, eg. sprite frames keep their sheet, so
+they are charged for the whole parent.  Each surface is only counted once, so
+evicting the sheet itself frees nothing while its frames are still cached.
+"""
+class AssetCache:
+
+    def __init__(self, budget = ASSET_BUDGET):
+        self.budget = budget
+        self.assets = OrderedDict()
+        self.pinned = set()
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the map prefetcher checks for assets from its worker thread
+        self.lock = threading.RLock()
+
+    """
+    Returns the asset with the given key, using the given function to load it
+    if it isn't in the cache.  The cache is only trimmed when something new is
+    loaded, so hits stay cheap.
+    """
+    def get(self, key, load, pin = False):
+        with self.lock:
+            if pin:
+                self.pinned.add(key)
+            if key in self.assets:
+                self.hits += 1
+                # move to the most recently used end
+                asset = self.assets.pop(key)
+                self.assets[key] = asset
+            else:
+                self.misses += 1
+                asset = load()
+                self.assets[key] = asset
+                self.trim()
+            return asset
+
+    """
+    Checks for an asset without counting a hit or a miss.
+    """
+    def contains(self, key):
+        with self.lock:
+            return key in self.assets
+
+    def discard(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+            self.assets.pop(key, None)
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+            self.trim()
+
+    def getUsedBytes(self):
+        with self.lock:
+            return getAssetSize(self.assets.values(), set())
+
+    """
+    Evicts the least recently used assets that aren't pinned until the cache is
+    within its budget.  Assets can grow after they are added - eg. a map renders
+    more chunks - and what an eviction frees depends on what else shares its
+    surfaces, so the cache is measured again each time.
+    """
+    def trim(self):
+        if self.getUsedBytes() <= self.budget:
+            return
+        for key in self.assets.keys():
+            if key not in self.pinned:
+                del self.assets[key]
+                self.evictions += 1
+                if self.getUsedBytes() <= self.budget:
+                    return
+
+    def getStats(self):
+        return "assets: %d, bytes: %d/%d, hits: %d, misses: %d, evictions: %d" \
+            % (len(self.assets), self.getUsedBytes(), self.budget,
+               self.hits, self.misses, self.evictions)
+
+"""
+Returns the number of bytes of pixel data held by the given asset.  Surfaces
+already in countedSurfaces aren't counted again - see getRootSurface.
+"""
+def getAssetSize(asset, countedSurfaces = None):
+    if hasattr(asset, "getSize"):
+        return asset.getSize()
+    if countedSurfaces is None:
+        countedSurfaces = set()
+    if isinstance(asset, dict):
+        return getAssetSize(asset.values(), countedSurfaces)
+    if isinstance(asset, list):
+        return sum([getAssetSize(item, countedSurfaces) for item in asset])
+    surface = getRootSurface(asset)
+    if surface in countedSurfaces:
+        return 0
+    countedSurfaces.add(surface)
+    return getSurfaceSize(surface)
+
+"""
+Returns the surface that holds the pixels of the given surface - its parent's,
+if it's a subsurface.
+"""
+def getRootSurface(surface):
+    while surface.get_parent():
+        surface = surface.get_parent()
+    return surface
+
+"""
+Subsurfaces share their parent's pixels and keep it alive, so they are charged
+for the whole of it.
+"""
+def getSurfaceSize(surface):
+    surface = getRootSurface(surface)
+    return surface.get_pitch() * surface.get_height()
+
+# the asset cache shared by the whole game
+assetCache = AssetCache()
+
+def getScaledImage(imagePath, colourKey = None):
+    return assetCache.get((IMAGE, imagePath, colourKey),
+                          lambda: view.loadScaledImage(imagePath, colourKey))
+
+"""
+Animation frames are shared by every sprite that uses them, so they must never
+be drawn on - see spriteframes.FramePool.
+"""
+def getStaticFrames(imagePath, numFrames = 4):
+    return assetCache.get((STATIC_FRAMES, imagePath, numFrames),
+                          lambda: view.shareStaticFrames(view.processStaticFrames(getScaledImage(imagePath), numFrames)))
+
+def getMovementFrames(imagePath, numFrames = 4):
+    return assetCache.get((MOVEMENT_FRAMES, imagePath, numFrames),
+                          lambda: view.shareMovementFrames(view.processMovementFrames(getScaledImage(imagePath), numFrames)))
+
+"""
+The glyphs of a font are subsurfaces of its image, so every font that uses the
+same image shares the one atlas.  Glyphs are transparent, like animation
+frames, so they can be drawn straight onto the screen - see font.Font.drawText.
+"""
+def getFontGlyphs(imagePath, charWidth, rows = 1):
+    return assetCache.get((FONT_GLYPHS, imagePath, charWidth, rows),
+                          lambda: view.shareStaticFrames(view.processFontImage(getScaledImage(imagePath), charWidth, rows)))
@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+
+import json
+import math
+import timeit
+import pygame
+import states
+import simulation
+import map
+import sprites
+import fixedsprites
+import player
+
+from pygame.locals import K_UP, K_DOWN, K_LEFT, K_RIGHT, K_SPACE
+
+from registry import Registry
+
+PHASES = ["input", "interactions", "spriteUpdate", "mapBlit", "spriteDraw", "hud", "present", "frame"]
+
+PERCENTILES = [50, 95, 99]
+
+MOVE_KEYS = {"U": K_UP, "D": K_DOWN, "L": K_LEFT, "R": K_RIGHT, "A": K_SPACE}
+
+"""
+Scripted routes around each map - the map, the tile position and level to start
+from, and the moves to make.  Each move is the keys to hold, from MOVE_KEYS,
+and the number of ticks to hold them for.  Every route stays on its map and
+keeps clear of the enemies, so the player doesn't lose a life.
+"""
+ROUTES = [("central", (6, 22), 2,
+           "D:51 R:15 D:41 R:16 U:16 R:320 U:16 R:34 D:23 L:320 D:9 L:48 U:112 R:14 "
+           "U:32 L:14 U:16 L:16 U:41 L:48 D:16 L:16 D:64 R:16 U:7 L:16 U:73 R:62 D:48 "
+           "R:16 D:16 R:16 D:96 L:14 D:41 R:14 U:16 R:320 U:16 R:34"),
+          ("east", (1, 21), 3,
+           "D:19 R:15 D:48 R:16 D:48 R:96 D:16 R:2 U:23 L:96 U:48 L:16 U:48 R:158 U:16 "
+           "R:18 D:23 L:176 D:48 R:14 D:48 R:96 D:16 R:2"),
+          ("wasps", (12, 10), 5,
+           "U:36 R:47 U:16 R:2 D:23 L:32 D:80 L:34 U:71 R:16 U:16 R:48 U:16 R:2 D:23 "
+           "L:32 D:80 L:34 U:71 R:16 U:16 R:48 U:16 R:2"),
+          ("caves", (11, 15), 1,
+           "U:52 L:15 U:16 L:32 U:48 R:78 U:32 R:2 D:39 L:80 D:64 R:14 D:32 R:50 U:23 "
+           "L:16 U:16 L:16 U:16 L:32 U:48 R:78 U:32 R:2"),
+          ("northcave", (7, 15), 1,
+           "U:20 R:65 D:7 L:64 D:16 L:2 U:23 R:66 D:7 L:64 D:16 L:2 U:23 R:66 D:7 L:64 "
+           "D:16 L:2")]
+
+"""
+Returns the keys that are pressed for each tick of the given moves.
+"""
+def getRouteKeys(moves):
+    routeKeys = []
+    for move in moves.split():
+        keys, ticks = move.split(":")
+        pressedKeys = [MOVE_KEYS[key] for key in keys]
+        routeKeys += [pressedKeys] * int(ticks)
+    return routeKeys
+
+"""
+Returns the value at the given percentile of the given values, using the
+nearest rank.
+"""
+def getPercentile(sortedValues, percentile):
+    rank = int(math.ceil(percentile / 100.0 * len(sortedValues)))
+    return sortedValues[max(rank, 1) - 1]
+
+"""
+Times the phases of each frame.  The functions that make up each phase are
+swapped for timed versions by instrument, and the originals are put back by
+restore.  Times are in milliseconds.
+"""
+class PhaseTimer:
+
+    def __init__(self, getTime = timeit.default_timer):
+        self.getTime = getTime
+        self.originals = []
+        self.frameTimes = dict((phase, 0.0) for phase in PHASES)
+        self.times = dict((phase, []) for phase in PHASES)
+
+    """
+    Times the given function of the given class or module as part of the given
+    phase.
+    """
+    def instrument(self, owner, name, phase):
+        function = owner.__dict__[name]
+        getTime = self.getTime
+        frameTimes = self.frameTimes
+        def timedFunction(*args, **kwargs):
+            startTime = getTime()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                frameTimes[phase] += (getTime() - startTime) * 1000
+        setattr(owner, name, timedFunction)
+        self.originals.append((owner, name, function))
+
+    def instrumentGame(self):
+        self.instrument(simulation, "getKeyPresses", "input")
+        self.instrument(player.Player, "handleInteractions", "interactions")
+        self.instrument(sprites.IndexedSprites, "update", "spriteUpdate")
+        self.instrument(map.RpgMap, "drawMapArea", "mapBlit")
+        self.instrument(sprites.RpgSprites, "draw", "spriteDraw")
+        self.instrument(sprites.RpgSprites, "drawArea", "spriteDraw")
+        self.instrument(fixedsprites.HeadsUpDisplay, "update", "hud")
+        self.instrument(fixedsprites.HeadsUpDisplay, "draw", "hud")
+        self.instrument(states, "updateDisplay", "present")
+
+    def restore(self):
+        for owner, name, function in reversed(self.originals):
+            setattr(owner, name, function)
+        self.originals = []
+
+    def addTime(self, phase, startTime):
+        self.frameTimes[phase] += (self.getTime() - startTime) * 1000
+
+    """
+    Records the phase times for the frame that started at the given time, and
+    starts the next frame.
+    """
+    def endFrame(self, startTime):
+        self.addTime("frame", startTime)
+        for phase in PHASES:
+            self.times[phase].append(self.frameTimes[phase])
+            self.frameTimes[phase] = 0.0
+
+    def getResults(self):
+        results = {}
+        for phase in PHASES:
+            sortedTimes = sorted(self.times[phase])
+            phaseResults = {"max": sortedTimes[-1] if sortedTimes else 0.0}
+            for percentile in PERCENTILES:
+                key = "p%d" % percentile
+                phaseResults[key] = getPercentile(sortedTimes, percentile) if sortedTimes else 0.0
+            results[phase] = phaseResults
+        return results
+
+"""
+Plays the given route as fast as it can go, drawing every tick, and returns the
+phase timings.  Loading the map isn't timed.  The routes stay on their map, and
+the map prefetcher is turned off so that loading the maps next to it - on
+another thread or a few chunks per tick - doesn't add noise to the timings.
+"""
+def runRoute(route):
+    mapName, tilePosition, level, moves = route
+    game = simulation.Simulation(Registry(mapName, tilePosition, level), False)
+    timer = PhaseTimer()
+    timer.instrumentGame()
+    try:
+        for pressedKeys in getRouteKeys(moves):
+            startTime = timer.getTime()
+            # there are no events to pump without a display - see states.initDisplay
+            if pygame.display.get_init():
+                pygame.event.pump()
+            timer.addTime("input", startTime)
+            state = game.step(pressedKeys)
+            if hasattr(state, "drawFrame"):
+                state.drawFrame()
+            timer.endFrame(startTime)
+    finally:
+        timer.restore()
+        game.stop()
+    results = timer.getResults()
+    results["frames"] = game.ticks
+    results["map"] = game.getPlayer().rpgMap.name
+    return results
+
+"""
+Runs the given routes, or all of them, and returns the results keyed on the map
+each route starts from.  The display must already be set up - see
+states.initDisplay.  A headless display has nothing to present, so use a dummy
+video driver instead to time everything.
+"""
+def runBenchmarks(mapNames = None):
+    results = {}
+    for route in ROUTES:
+        if mapNames and route[0] not in mapNames:
+            continue
+        results[route[0]] = runRoute(route)
+    return results
+
+def saveResults(results, filePath):
+    with open(filePath, "w") as resultsFile:
+        json.dump(results, resultsFile, indent = 2, sort_keys = True)
+
+def loadResults(filePath):
+    with open(filePath) as resultsFile:
+        return json.load(resultsFile)
+
+"""
+Returns the results as a table of milliseconds per phase for each route.  If
+base results are given, the change from them is shown as well.
+"""
+def formatResults(results, baseResults = None):
+    lines = []
+    for routeName in sorted(results):
+        routeResults = results[routeName]
+        lines.append("%s (%d frames)" % (routeName, routeResults["frames"]))
+        for phase in PHASES:
+            timings = routeResults[phase]
+            line = "  %-13s" % phase
+            for key in ["p50", "p95", "p99", "max"]:
+                line += " %s %7.3f" % (key, timings[key])
+                if baseResults and routeName in baseResults:
+                    baseTiming = baseResults[routeName][phase][key]
+                    if baseTiming:
+                        line += " (%+4.0f%%)" % ((timings[key] - baseTiming) * 100 / baseTiming)
+                    else:
+                        line += "       "
+            lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,233 @@
+#! /usr/bin/env python
+
+from __future__ import with_statement
+
+import mmap
+import zlib
+import struct
+
+from map import MapSprite
+from playevents import BoundaryEvent, TileEvent, BoundaryTransition, SceneTransition, EndGameTransition
+from playevents import TILE_EVENT, BOUNDARY_EVENT, BOUNDARY_TRANSITION, SCENE_TRANSITION
+
+MAGIC = "MAPC"
+VERSION = 2
+
+# level record kinds
+LEVEL = 0
+SPECIAL_LEVEL = 1
+DOWN_LEVEL = 2
+
+# image record mask kinds
+NO_MASK = 0
+FLAT_MASK = 1
+VERTICAL_MASK = 2
+
+NO_STRING = 0xFFFF
+
+"""
+The compiled format is a header followed by fixed-width record arrays, in this
+order: string offsets, string data, levels, images, sprites, sprite points and
+events.  All numbers are little-endian.  The header stores the modification
+time and size of the source .map file so that stale files can be detected, and
+ends with a checksum of the rest of the file so that corrupt files can be.
+"""
+HEADER = struct.Struct("<4sHHHdq6II")
+CHECKSUM = struct.Struct("<I")
+STRING_OFFSET = struct.Struct("<I")
+# x, y, kind, level, down level
+LEVEL_RECORD = struct.Struct("<HHBdh")
+# x, y, tile index, tile set name, tile name, mask kind, mask level
+IMAGE_RECORD = struct.Struct("<HHBHHBh")
+# type, uid, level, first point, number of points
+SPRITE_RECORD = struct.Struct("<HHhII")
+POINT_RECORD = struct.Struct("<hh")
+# event type, a, b, c, transition type, map name, x, y, level, direction, boundary, modifier
+EVENT_RECORD = struct.Struct("<BhhhBHhhhBBh")
+
+"""
+Everything needed to build an RpgMap, independent of where it was read from.
+Levels and images are lists of records:
+
+  levels: (x, y, kind, level, downLevel)
+  images: (x, y, tileIndex, tileSetName, tileName, maskKind, maskLevel)
+"""
+class MapData:
+
+    def __init__(self, cols, rows, levels, images, mapSprites, mapEvents):
+        self.cols, self.rows = cols, rows
+        self.levels = levels
+        self.images = images
+        self.mapSprites = mapSprites
+        self.mapEvents = mapEvents
+
+"""
+Builds the string table as records are encoded - each distinct string is
+stored once and referenced by index.
+"""
+class StringTable:
+
+    def __init__(self):
+        self.strings = []
+        self.indexes = {}
+
+    def getIndex(self, string):
+        if string is None:
+            return NO_STRING
+        if string not in self.indexes:
+            self.indexes[string] = len(self.strings)
+            self.strings.append(string)
+        return self.indexes[string]
+
+def writeCompiledMap(path, mapData, sourceStamp):
+    strings = StringTable()
+    levels = [LEVEL_RECORD.pack(*level) for level in mapData.levels]
+    images = [IMAGE_RECORD.pack(x, y, tileIndex,
+                                strings.getIndex(tileSetName),
+                                strings.getIndex(tileName),
+                                maskKind, maskLevel)
+              for x, y, tileIndex, tileSetName, tileName, maskKind, maskLevel in mapData.images]
+    sprites, points = [], []
+    for mapSprite in mapData.mapSprites:
+        sprites.append(SPRITE_RECORD.pack(strings.getIndex(mapSprite.type),
+                                          strings.getIndex(mapSprite.uid),
+                                          mapSprite.level,
+                                          len(points),
+                                          len(mapSprite.tilePoints)))
+        points += [POINT_RECORD.pack(x, y) for x, y in mapSprite.tilePoints]
+    events = [encodeEvent(event, strings) for event in mapData.mapEvents]
+    # string offsets are followed by the string data itself
+    offsets, offset = [], 0
+    for string in strings.strings:
+        offsets.append(STRING_OFFSET.pack(offset))
+        offset += len(string)
+    offsets.append(STRING_OFFSET.pack(offset))
+    body = "".join("".join(section) for section in
+                   (offsets, strings.strings, levels, images, sprites, points, events))
+    mtime, size = sourceStamp
+    header = HEADER.pack(MAGIC, VERSION, mapData.cols, mapData.rows, mtime, size,
+                         len(strings.strings), len(levels), len(images),
+                         len(sprites), len(points), len(events), 0)
+    with open(path, "wb") as compiledFile:
+        compiledFile.write(header[:-CHECKSUM.size])
+        compiledFile.write(CHECKSUM.pack(getChecksum(header, body)))
+        compiledFile.write(body)
+
+"""
+Returns the checksum of the header, less the checksum itself, and the body.
+"""
+def getChecksum(header, body):
+    return zlib.crc32(body, zlib.crc32(header[:HEADER.size - CHECKSUM.size])) & 0xffffffff
+
+def encodeEvent(event, strings):
+    a, b, c = 0, 0, 0
+    if event.type == TILE_EVENT:
+        a, b, c = event.x, event.y, event.level
+    elif event.type == BOUNDARY_EVENT:
+        a, b, c = event.boundary, event.range[0], event.range[-1]
+    transition = event.transition
+    mapName = strings.getIndex(transition.mapName)
+    x, y, level, direction, boundary, modifier = 0, 0, 0, 0, 0, 0
+    if transition.type == BOUNDARY_TRANSITION:
+        boundary, modifier = transition.boundary, transition.modifier
+    elif transition.type == SCENE_TRANSITION:
+        x, y = transition.tilePosition
+        level, direction = transition.level, transition.direction
+        boundary = transition.boundary or 0
+    return EVENT_RECORD.pack(event.type, a, b, c, transition.type, mapName,
+                             x, y, level, direction, boundary, modifier)
+
+"""
+Memory-maps the given compiled map and decodes it.  Returns None if the file
+is missing, unreadable, corrupt or was compiled from a different version of the
+source file (when a sourceStamp is given).
+"""
+def readCompiledMap(path, sourceStamp = None):
+    try:
+        with open(path, "rb") as compiledFile:
+            data = mmap.mmap(compiledFile.fileno(), 0, access = mmap.ACCESS_READ)
+    except (IOError, ValueError, mmap.error):
+        return None
+    try:
+        return decodeCompiledMap(data, sourceStamp)
+    except (struct.error, IndexError, ValueError), e:
+        print "corrupt compiled map: %s (%s)" % (path, e)
+        return None
+    finally:
+        data.close()
+
+"""
+Decodes a compiled map, raising a ValueError or IndexError if it is corrupt.
+"""
+def decodeCompiledMap(data, sourceStamp):
+    (magic, version, cols, rows, mtime, size, numStrings, numLevels, numImages,
+     numSprites, numPoints, numEvents, checksum) = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        return None
+    if sourceStamp and sourceStamp != (mtime, size):
+        return None
+    checkData(checksum == getChecksum(data[:HEADER.size], data[HEADER.size:]), "bad checksum")
+    checkData(cols > 0 and rows > 0, "empty map")
+    # the string data takes up whatever the records don't
+    recordsSize = (STRING_OFFSET.size * (numStrings + 1) + LEVEL_RECORD.size * numLevels
+                   + IMAGE_RECORD.size * numImages + SPRITE_RECORD.size * numSprites
+                   + POINT_RECORD.size * numPoints + EVENT_RECORD.size * numEvents)
+    checkData(HEADER.size + recordsSize <= len(data), "counts don't fit the file")
+    offset = HEADER.size
+    # strings
+    stringOffsets = readRecords(data, offset, STRING_OFFSET, numStrings + 1)
+    offset += STRING_OFFSET.size * (numStrings + 1)
+    checkData(stringOffsets[-1][0] == len(data) - HEADER.size - recordsSize, "bad string data size")
+    checkData(stringOffsets == sorted(stringOffsets), "bad string offsets")
+    strings = [data[offset + start:offset + end] for (start,), (end,)
+               in zip(stringOffsets[:-1], stringOffsets[1:])]
+    offset += stringOffsets[-1][0]
+    # tiles
+    levels = readRecords(data, offset, LEVEL_RECORD, numLevels)
+    offset += LEVEL_RECORD.size * numLevels
+    images = [(x, y, tileIndex, strings[tileSet], strings[tileName], maskKind, maskLevel)
+              for x, y, tileIndex, tileSet, tileName, maskKind, maskLevel
+              in readRecords(data, offset, IMAGE_RECORD, numImages)]
+    offset += IMAGE_RECORD.size * numImages
+    for record in levels + images:
+        checkData(record[0] < cols and record[1] < rows, "tile outside the map")
+    # sprites
+    spriteRecords = readRecords(data, offset, SPRITE_RECORD, numSprites)
+    offset += SPRITE_RECORD.size * numSprites
+    points = readRecords(data, offset, POINT_RECORD, numPoints)
+    offset += POINT_RECORD.size * numPoints
+    for type, uid, level, first, count in spriteRecords:
+        checkData(first + count <= numPoints, "sprite points out of range")
+    mapSprites = [MapSprite(strings[type], strings[uid], level,
+                            [list(point) for point in points[first:first + count]])
+                  for type, uid, level, first, count in spriteRecords]
+    # events
+    mapEvents = [decodeEvent(record, strings)
+                 for record in readRecords(data, offset, EVENT_RECORD, numEvents)]
+    return MapData(cols, rows, levels, images, mapSprites, mapEvents)
+
+def checkData(condition, problem):
+    if not condition:
+        raise ValueError(problem)
+
+def readRecords(data, offset, record, count):
+    size = record.size
+    return [record.unpack_from(data, offset + i * size) for i in range(count)]
+
+def decodeEvent(record, strings):
+    (eventType, a, b, c, transitionType, mapName,
+     x, y, level, direction, boundary, modifier) = record
+    if mapName != NO_STRING:
+        mapName = strings[mapName]
+    if transitionType == BOUNDARY_TRANSITION:
+        transition = BoundaryTransition(mapName, boundary, modifier)
+    elif transitionType == SCENE_TRANSITION:
+        transition = SceneTransition(mapName, x, y, level, direction, boundary or None)
+    else: # transitionType == END_GAME_TRANSITION
+        transition = EndGameTransition()
+    if eventType == TILE_EVENT:
+        return TileEvent(transition, a, b, c)
+    # eventType == BOUNDARY_EVENT
+    if c != b:
+        return BoundaryEvent(transition, a, b, c)
+    return BoundaryEvent(transition, a, b)
@@ -30,16 +30,17 @@ class FixedSprite(pygame.sprite.Sprite):
         self.rect = self.image.get_rect()
         self.rect.topleft = self.position
         
+    # see RpgSprite.getDrawState
+    def getDrawState(self):
+        return (self.image,)
+        
 class FixedCoin(FixedSprite):
 
-    initialImage = None
-    
     def __init__(self, position = (0, 0)):
-        if FixedCoin.initialImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "small-coin.png")
-            FixedCoin.initialImage = view.loadScaledImage(imagePath)
+        imagePath = os.path.join(SPRITES_FOLDER, "small-coin.png")
+        initialImage = assets.getScaledImage(imagePath)
         FixedSprite.__init__(self, position)
-        self.setImage(view.createDuplicateSpriteImage(FixedCoin.initialImage))
+        self.setImage(view.createDuplicateSpriteImage(initialImage))
 
 class CoinCount(FixedSprite):
     
@@ -64,13 +65,10 @@ class CoinCount(FixedSprite):
 
 class KeyCount(FixedSprite):
     
-    initialImage = None
-    
     def __init__(self, count = 0, position = (0, 0)):
-        if KeyCount.initialImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "small-key.png")
-            KeyCount.initialImage = view.loadScaledImage(imagePath)
-        self.keyImage = view.createDuplicateSpriteImage(KeyCount.initialImage)
+        imagePath = os.path.join(SPRITES_FOLDER, "small-key.png")
+        initialImage = assets.getScaledImage(imagePath)
+        self.keyImage = view.createDuplicateSpriteImage(initialImage)
         FixedSprite.__init__(self, position)
         self.count = count
         self.newImage()
@@ -95,13 +93,10 @@ class KeyCount(FixedSprite):
 
 class Lives(FixedSprite):
     
-    initialImage = None
-    
     def __init__(self, count = 0, position = (0, 0)):
-        if Lives.initialImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "life.png")
-            Lives.initialImage = view.loadScaledImage(imagePath)
-        self.livesImage = view.createDuplicateSpriteImage(Lives.initialImage)
+        imagePath = os.path.join(SPRITES_FOLDER, "life.png")
+        initialImage = assets.getScaledImage(imagePath)
+        self.livesImage = view.createDuplicateSpriteImage(initialImage)
         FixedSprite.__init__(self, position)
         self.count = count
         self.newImage()
@@ -126,14 +121,11 @@ class Lives(FixedSprite):
 
 class CheckpointIcon(FixedSprite):
 
-    initialImage = None
-    
     def __init__(self, position = (0, 0)):
-        if CheckpointIcon.initialImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "small-check.png")
-            CheckpointIcon.initialImage = view.loadScaledImage(imagePath)
+        imagePath = os.path.join(SPRITES_FOLDER, "small-check.png")
+        initialImage = assets.getScaledImage(imagePath)
         FixedSprite.__init__(self, position)
-        self.onImage = view.createDuplicateSpriteImage(CheckpointIcon.initialImage)
+        self.onImage = view.createDuplicateSpriteImage(initialImage)
         self.offImage = view.createTransparentRect((0, 0))
         self.setImage(self.offImage)
         self.on = False
@@ -161,3 +153,48 @@ class CheckpointIcon(FixedSprite):
                 self.setImage(self.onImage)
                 self.on = True
         self.ticks += 1
+
+"""
+Composites the fixed sprites into a single transparent overlay the size of the
+view.  The overlay is only drawn again when one of the sprites changes - eg. a
+count goes up or the checkpoint icon blinks - so drawing the fixed sprites is a
+single blit of the overlay.
+"""
+class HeadsUpDisplay:
+
+    def __init__(self, fixedSprites):
+        self.fixedSprites = fixedSprites
+        self.overlay = view.createTransparentRect((VIEW_WIDTH, VIEW_HEIGHT))
+        # the draw states and areas of the sprites in the overlay
+        self.drawStates = None
+        self.rects = []
+
+    """
+    Draws the overlay again if any of the sprites have changed, and returns the
+    areas of the view that have changed as a result.
+    """
+    def update(self):
+        drawStates = [(sprite.getDrawState(), Rect(sprite.rect)) for sprite in self.fixedSprites]
+        if drawStates == self.drawStates:
+            return []
+        self.drawStates = drawStates
+        self.overlay.fill(view.TRANSPARENT_COLOUR)
+        rects = []
+        for sprite in self.fixedSprites:
+            self.overlay.blit(sprite.image, sprite.rect)
+            if sprite.rect.width and sprite.rect.height:
+                rects.append(Rect(sprite.rect))
+        dirtyRects = self.rects + rects
+        self.rects = rects
+        return dirtyRects
+
+    """
+    Draws the given area of the overlay onto the same area of the surface, or
+    all of the overlay if no area is given.
+    """
+    def draw(self, surface, area = None):
+        if area is None:
+            for rect in self.rects:
+                surface.blit(self.overlay, rect.topleft, rect)
+        elif area.collidelist(self.rects) >= 0:
+            surface.blit(self.overlay, area.topleft, area)
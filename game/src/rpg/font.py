@@ -2,24 +2,65 @@
 
 import os
 import view
+import assets
 
+from collections import OrderedDict
 from view import SCALAR
 
 FONT_FOLDER = "images"
 
+# the number of rendered strings that are kept - see TextCache
+TEXT_CACHE_SIZE = 64
+
 CHARS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N',
          'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z', '.', '!',
          '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '/', ' ']
 
 NUMBERS = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
 
+"""
+Keeps the most recently rendered strings, keyed on the font and the text, so
+that the same text is only rendered once.  Text images are shared, so they must
+never be drawn on.
+"""
+class TextCache:
+    
+    def __init__(self, size = TEXT_CACHE_SIZE):
+        self.size = size
+        self.textImages = OrderedDict()
+        # counters
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, key, render):
+        if key in self.textImages:
+            self.hits += 1
+            # move to the most recently used end
+            textImage = self.textImages.pop(key)
+        else:
+            self.misses += 1
+            textImage = render()
+            if len(self.textImages) >= self.size:
+                self.textImages.popitem(last = False)
+        self.textImages[key] = textImage
+        return textImage
+    
+    def getStats(self):
+        return "text images: %d/%d, hits: %d, misses: %d" \
+            % (len(self.textImages), self.size, self.hits, self.misses)
+
+# the text cache shared by all fonts
+textCache = TextCache()
+
 """
 Font class that maps a list of supported chars to their corresponding images.
-This is then used to get an image for a given piece of text.
+This is then used to get an image for a given piece of text.  The font name is
+used to tell fonts apart in the text cache.
 """
 class Font:
     
-    def __init__(self, supportedChars, charImages):
+    def __init__(self, name, supportedChars, charImages):
+        self.name = name
         self.chars = {}
         for i, char in enumerate(supportedChars):
             self.chars[char] = charImages[i]
@@ -27,42 +68,47 @@ class Font:
         self.charHeight = charImages[0].get_height()
             
     def getTextImage(self, text):
+        return textCache.get((self.name, text), lambda: self.renderText(text))
+    
+    def renderText(self, text):
         # filter out any unsupported chars
         supportedText = [c for c in text if c in self.chars]
         textImage = view.createTransparentRect((len(supportedText) * self.charWidth, self.charHeight))
-        for i, char in enumerate(supportedText):
-            textImage.blit(self.chars[char], (i * self.charWidth, 0))
+        self.drawText(textImage, supportedText)
         return textImage
+    
+    """
+    Draws the given text straight onto a surface, glyph by glyph, which is
+    cheaper than getting a text image for text that keeps changing - eg. a
+    number in a line of text that is already on the screen.
+    """
+    def drawText(self, surface, text, position = (0, 0)):
+        x, y = position
+        for char in text:
+            if char in self.chars:
+                surface.blit(self.chars[char], (x, y))
+                x += self.charWidth
+                
+    def getTextWidth(self, text):
+        return len([c for c in text if c in self.chars]) * self.charWidth
             
 class GameFont(Font):
 
-    fontImage = None
-    
     def __init__(self):
-        if GameFont.fontImage is None:    
-            imagePath = os.path.join(FONT_FOLDER, "font-white.png")
-            GameFont.fontImage = view.loadScaledImage(imagePath)        
-        charImages = view.processFontImage(GameFont.fontImage, 8 * SCALAR, 3)
-        Font.__init__(self, CHARS, charImages)
+        imagePath = os.path.join(FONT_FOLDER, "font-white.png")
+        charImages = assets.getFontGlyphs(imagePath, 8 * SCALAR, 3)
+        Font.__init__(self, imagePath, CHARS, charImages)
         
 class TitleFont(Font):
 
-    fontImage = None
-    
     def __init__(self):
-        if TitleFont.fontImage is None:    
-            imagePath = os.path.join(FONT_FOLDER, "font-black.png")
-            TitleFont.fontImage = view.loadScaledImage(imagePath)        
-        charImages = view.processFontImage(TitleFont.fontImage, 8 * SCALAR, 3)
-        Font.__init__(self, CHARS, charImages)
+        imagePath = os.path.join(FONT_FOLDER, "font-black.png")
+        charImages = assets.getFontGlyphs(imagePath, 8 * SCALAR, 3)
+        Font.__init__(self, imagePath, CHARS, charImages)
         
 class NumbersFont(Font):
 
-    fontImage = None
-    
     def __init__(self):
-        if NumbersFont.fontImage is None:    
-            imagePath = os.path.join(FONT_FOLDER, "numbers.png")
-            NumbersFont.fontImage = view.loadScaledImage(imagePath)        
-        charImages = view.processFontImage(NumbersFont.fontImage, 8 * SCALAR)
-        Font.__init__(self, NUMBERS, charImages)
\ No newline at end of file
+        imagePath = os.path.join(FONT_FOLDER, "numbers.png")
+        charImages = assets.getFontGlyphs(imagePath, 8 * SCALAR)
+        Font.__init__(self, imagePath, NUMBERS, charImages)
@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+
+import pygame
+
+# the most frames that can be skipped in a row before the game slows down instead
+MAX_FRAME_SKIP = 4
+
+"""
+A fixed rate clock for the game loop.  All movement in the game is measured in
+ticks, so the game logic must run at a steady rate for the game to play at the
+right speed.  When drawing a frame takes too long the clock asks for more than
+one tick before the next frame, which means the frames in between are skipped.
+If the game falls too far behind the ticks that can't be caught up are dropped,
+so the game slows down rather than skipping frames forever.
+
+Times are in milliseconds.  The time and sleep functions can be swapped out,
+eg. for testing.
+"""
+class GameClock:
+
+    def __init__(self, ticksPerSec, maxFrameSkip = MAX_FRAME_SKIP,
+                 getTime = pygame.time.get_ticks, sleep = pygame.time.wait):
+        self.tickTime = 1000.0 / ticksPerSec
+        self.maxTicks = maxFrameSkip + 1
+        self.getTime = getTime
+        self.sleep = sleep
+        self.nextTickTime = None
+        # counters
+        self.frames = 0
+        self.skippedFrames = 0
+        self.lateFrames = 0
+        self.droppedTicks = 0
+
+    """
+    Waits for the next tick and returns the number of ticks that should be run
+    before the next frame is drawn.  More than one tick means that the frame is
+    late and the frames for the other ticks are skipped.
+    """
+    def tick(self):
+        now = self.getTime()
+        if self.nextTickTime is None:
+            self.nextTickTime = now
+        elif now < self.nextTickTime:
+            self.sleep(int(self.nextTickTime - now))
+            now = self.nextTickTime
+        ticks = int((now - self.nextTickTime) // self.tickTime) + 1
+        self.nextTickTime += ticks * self.tickTime
+        if ticks > self.maxTicks:
+            self.droppedTicks += ticks - self.maxTicks
+            ticks = self.maxTicks
+            # start again from now, as the dropped ticks are never run
+            self.nextTickTime = now + self.tickTime
+        self.frames += 1
+        if ticks > 1:
+            self.lateFrames += 1
+            self.skippedFrames += ticks - 1
+        return ticks
+
+    def getStats(self):
+        return "frames: %d, skipped: %d, late: %d, dropped ticks: %d" \
+            % (self.frames, self.skippedFrames, self.lateFrames, self.droppedTicks)
@@ -2,14 +2,43 @@
 
 from __future__ import with_statement
 
+import bisect
 import math
 import view
+import assets
 import playevents
 
-from view import TILE_SIZE
+from pygame.locals import Rect
 
-MIN_SHUFFLE = (0, -1, -1, 1)
-MAX_SHUFFLE = (-1, 1, 0, -1)
+from view import TILE_SIZE, VIEW_WIDTH, VIEW_HEIGHT
+
+# walkability grid values - any other value is a special level
+BLOCKED = 0
+WALKABLE = -1
+
+# marks a tile with masks in the masked tile bitmap
+MASKED = "\x01"
+
+# returned for sprites that aren't touching any masked tiles - must not be modified
+NO_MASKS = {}
+
+# the number of getMasks results a map remembers before it starts again
+MASK_CACHE_SIZE = 1024
+
+"""
+The map image is rendered in chunks as they come near the view.  Chunks are the
+same size as the view, so the view never spans more than four of them.
+"""
+CHUNK_COLS = VIEW_WIDTH // TILE_SIZE
+CHUNK_ROWS = VIEW_HEIGHT // TILE_SIZE
+CHUNK_WIDTH = CHUNK_COLS * TILE_SIZE
+CHUNK_HEIGHT = CHUNK_ROWS * TILE_SIZE
+
+# chunks within this distance of the view are rendered before they come into view
+CHUNK_MARGIN = TILE_SIZE
+
+# the number of rendered chunks a map keeps before it evicts those furthest from the view
+CHUNK_BUDGET = 12
 
 """
 Encapsulates the logic required for the main map.  You should not instantiate
@@ -24,26 +53,101 @@ class RpgMap:
         self.cols = len(mapTiles)
         self.rows = len(mapTiles[0])
         self.mapSprites = mapSprites
-        self.initialiseMapImage()
+        self.mapRect = Rect(0, 0, self.cols * TILE_SIZE, self.rows * TILE_SIZE)
+        # rendered chunks of the map image, keyed on chunk x,y
+        self.chunks = {}
         self.initialiseEvents(mapEvents)
         self.toRestore = None
+        # walkability grids keyed on level - see getLevelGrid
+        self.levelGrids = {}
+        # uids of the sprites that have been drawn into the map - see bakeSprite
+        self.bakedSprites = set()
+        self.initialiseMasks()
         
-    def initialiseMapImage(self):
-        self.mapImage = view.createRectangle((self.cols * TILE_SIZE, self.rows * TILE_SIZE),
-                                              view.BLACK)
-        for tiles in self.mapTiles:
-            for tile in tiles:
-                tileImage = tile.createTileImage()
-                if tileImage:
-                    self.mapImage.blit(tileImage, (tile.x * TILE_SIZE, tile.y * TILE_SIZE))
-        self.mapRect = self.mapImage.get_rect()
+    """
+    Draws the given area of the map onto the surface at the given position.  Any
+    chunks in or near the area that have not been rendered yet are rendered first.
+    """
+    def drawMapArea(self, surface, position, area):
+        self.renderMapArea(area)
+        cx1, cy1, cx2, cy2 = self.getChunkRange(area)
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                chunkLeft, chunkTop = cx * CHUNK_WIDTH, cy * CHUNK_HEIGHT
+                chunkArea = area.clip(Rect(chunkLeft, chunkTop, CHUNK_WIDTH, CHUNK_HEIGHT))
+                surface.blit(self.chunks[(cx, cy)],
+                             (position[0] + chunkArea.left - area.left,
+                              position[1] + chunkArea.top - area.top),
+                             chunkArea.move(-chunkLeft, -chunkTop))
+    
+    """
+    Renders any chunks in or near the given area that have not been rendered yet,
+    or at most maxChunks of them.  Returns True if they have all been rendered.
+    """
+    def renderMapArea(self, area, maxChunks = None):
+        return self.renderChunks(area.inflate(CHUNK_MARGIN * 2, CHUNK_MARGIN * 2), maxChunks)
+    
+    def renderChunks(self, nearRect, maxChunks = None):
+        nearChunks = []
+        rendered = 0
+        cx1, cy1, cx2, cy2 = self.getChunkRange(nearRect)
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                if (cx, cy) not in self.chunks:
+                    if rendered == maxChunks:
+                        continue
+                    self.chunks[(cx, cy)] = self.renderChunk(cx, cy)
+                    rendered += 1
+                nearChunks.append((cx, cy))
+        if len(self.chunks) > CHUNK_BUDGET:
+            self.evictChunks(nearChunks, nearRect.center)
+        return len(nearChunks) == (cx2 - cx1 + 1) * (cy2 - cy1 + 1)
+            
+    def renderChunk(self, cx, cy):
+        left, top = cx * CHUNK_COLS, cy * CHUNK_ROWS
+        right, bottom = min(left + CHUNK_COLS, self.cols), min(top + CHUNK_ROWS, self.rows)
+        chunk = view.createRectangle(((right - left) * TILE_SIZE, (bottom - top) * TILE_SIZE),
+                                     view.BLACK)
+        for x in range(left, right):
+            for y in range(top, bottom):
+                self.mapTiles[x][y].drawTile(chunk, ((x - left) * TILE_SIZE, (y - top) * TILE_SIZE))
+        return chunk
+    
+    """
+    Evicts the chunks furthest from the view until the map is within its chunk
+    budget.  Chunks near the view are never evicted.
+    """
+    def evictChunks(self, nearChunks, viewCentre):
+        def distance(chunk):
+            x = (chunk[0] + 0.5) * CHUNK_WIDTH - viewCentre[0]
+            y = (chunk[1] + 0.5) * CHUNK_HEIGHT - viewCentre[1]
+            return x * x + y * y
+        farChunks = sorted([chunk for chunk in self.chunks if chunk not in nearChunks],
+                           key = distance, reverse = True)
+        for chunk in farChunks[:len(self.chunks) - CHUNK_BUDGET]:
+            del self.chunks[chunk]
+    
+    """
+    Returns the number of bytes held by the rendered chunks - see assets.AssetCache.
+    """
+    def getSize(self):
+        return sum([assets.getSurfaceSize(chunk) for chunk in self.chunks.values()])
+    
+    """
+    Returns the range of chunks touched by the given rectangle, clipped to the map.
+    """
+    def getChunkRange(self, rect):
+        rect = rect.clip(self.mapRect)
+        return (rect.left // CHUNK_WIDTH, rect.top // CHUNK_HEIGHT,
+                (rect.right - 1) // CHUNK_WIDTH, (rect.bottom - 1) // CHUNK_HEIGHT)
     
     def initialiseEvents(self, mapEvents):
         self.boundaryEvents = {}
-        self.tileEvents = {}
+        self.tileEvents = []
         for event in mapEvents:
             if event.type == playevents.TILE_EVENT:
                 self.mapTiles[event.x][event.y].addEvent(event)
+                self.tileEvents.append(event)
             elif event.type == playevents.BOUNDARY_EVENT:
                 if event.boundary in self.boundaryEvents:
                     self.boundaryEvents[event.boundary].append(event)
@@ -108,80 +212,257 @@ class RpgMap:
                 return True, retLevel
         return False, level
     
-    def isMoveValid(self, level, baseRect):
-        return self.isSpanValid(level, self.getBaseRectTiles(baseRect))
+    """
+    The same rules as isSpanValid, applied to the tiles from x1, y1 to x2, y2
+    inclusive using the walkability grid for the given level.  This is called
+    for every movement, so it walks the grid directly rather than building any
+    lists of tiles or values.
+    """
+    def checkRange(self, level, x1, y1, x2, y2):
+        grid = self.levelGrids.get(level)
+        if grid is None:
+            grid = self.getLevelGrid(level)
+        rows = self.rows
+        sameLevelCount, specialLevelCount = 0, 0
+        minLevel, maxLevel = 0, 0
+        x = x1
+        while x <= x2:
+            i, end = x * rows + y1, x * rows + y2
+            while i <= end:
+                value = grid[i]
+                if value == WALKABLE:
+                    sameLevelCount += 1
+                elif value == BLOCKED:
+                    # neither all the same level nor all special levels
+                    return False, level
+                else:
+                    # a special level
+                    if value == level:
+                        sameLevelCount += 1
+                    if specialLevelCount == 0 or value < minLevel:
+                        minLevel = value
+                    if specialLevelCount == 0 or value > maxLevel:
+                        maxLevel = value
+                    specialLevelCount += 1
+                i += 1
+            x += 1
+        # test validity of the requested movement
+        spanTileCount = max(0, x2 - x1 + 1) * max(0, y2 - y1 + 1)
+        if sameLevelCount == spanTileCount:
+            return True, level
+        elif specialLevelCount == spanTileCount:
+            if maxLevel - minLevel < 1:
+                # ensure we return a whole number if possible
+                retLevel = maxLevel if int(maxLevel) == maxLevel else minLevel 
+                return True, retLevel
+        return False, level
     
-    def isStripeValid(self, level, stripes, min, max):
-        if len(stripes) < 2:
+    """
+    Returns the walkability grid for the given level, which holds the result of
+    MapTile.testValidity for every tile in a flat list indexed on x * rows + y:
+    WALKABLE if the tile is at the same level, the special level if it has one
+    and BLOCKED otherwise.  Grids are built the first time a level is queried
+    and are discarded whenever the tile levels change.
+    """
+    def getLevelGrid(self, level):
+        if level in self.levelGrids:
+            return self.levelGrids[level]
+        grid = []
+        for tiles in self.mapTiles:
+            for tile in tiles:
+                increment, specialLevel = tile.testValidity(level)
+                if specialLevel:
+                    grid.append(specialLevel)
+                elif increment:
+                    grid.append(WALKABLE)
+                else:
+                    grid.append(BLOCKED)
+        self.levelGrids[level] = grid
+        return grid
+    
+    """
+    Checks a movement of the base rect given by left, top, width and height
+    (integer pixel coordinates) and returns (valid, level) - see isSpanValid.
+    """
+    def checkMove(self, level, left, top, width, height):
+        # the same as getTileRange, but inline to avoid creating a rect
+        x1, y1 = left // TILE_SIZE, top // TILE_SIZE
+        x2, y2 = (left + width - 1) // TILE_SIZE, (top + height - 1) // TILE_SIZE
+        if x1 < 0:
+            x1 = 0
+        if y1 < 0:
+            y1 = 0
+        if x2 >= self.cols:
+            x2 = self.cols - 1
+        if y2 >= self.rows:
+            y2 = self.rows - 1
+        return self.checkRange(level, x1, y1, x2, y2)
+    
+    """
+    When a movement of px, py is blocked, checks whether the base rect can be
+    shuffled instead so that it lines up with steps, doorways, etc.  Movement
+    up or down checks the columns touched by the moved base rect and movement
+    left or right checks the rows.  Returns (valid, level, shuffle), where the
+    shuffle is the direction to move in to line up with the valid column or row.
+    """
+    def checkShuffle(self, level, left, top, width, height, px, py):
+        x1, y1 = (left + px) // TILE_SIZE, (top + py) // TILE_SIZE
+        x2, y2 = (left + px + width - 1) // TILE_SIZE, (top + py + height - 1) // TILE_SIZE
+        if x1 < 0:
+            x1 = 0
+        if y1 < 0:
+            y1 = 0
+        if x2 >= self.cols:
+            x2 = self.cols - 1
+        if y2 >= self.rows:
+            y2 = self.rows - 1
+        if px == 0:
+            return self.checkStripes(level, x1, y1, x2, y2, left, left + width, True)
+        return self.checkStripes(level, x1, y1, x2, y2, top, top + height, False)
+    
+    """
+    Checks the first and last columns (vertical) or rows of the given range - the
+    end nearest to the matching base rect edge, min or max, is tried first.
+    """
+    def checkStripes(self, level, x1, y1, x2, y2, min, max, vertical):
+        if vertical:
+            first, last = x1, x2
+        else:
+            first, last = y1, y2
+        if last - first < 1:
             return False, level, 0
-        sortedKeys = sorted(stripes.keys())
-        minDiff = abs(sortedKeys[0] * TILE_SIZE - min)
-        maxDiff = abs((sortedKeys[-1] + 1) * TILE_SIZE - max)
-        if minDiff < maxDiff:
-            return self.isShuffleValid(stripes, sortedKeys, level, MIN_SHUFFLE)
-        return self.isShuffleValid(stripes, sortedKeys, level, MAX_SHUFFLE)
-        
-    def isShuffleValid(self, stripes, sortedKeys, level, shuffle):
-        index1, shuffle1, index2, shuffle2 = shuffle
-        stripe = stripes[sortedKeys[index1]]
-        valid, level = self.isSpanValid(level, stripe)
+        if abs(first * TILE_SIZE - min) < abs((last + 1) * TILE_SIZE - max):
+            stripe, shuffle, otherStripe, otherShuffle = first, -1, last, 1
+        else:
+            stripe, shuffle, otherStripe, otherShuffle = last, 1, first, -1
+        if vertical:
+            valid, level = self.checkRange(level, stripe, y1, stripe, y2)
+        else:
+            valid, level = self.checkRange(level, x1, stripe, x2, stripe)
         if valid:
-            return valid, level, shuffle1
-        stripe = stripes[sortedKeys[index2]]
-        valid, level = self.isSpanValid(level, stripe)
-        return valid, level, shuffle2
+            return valid, level, shuffle
+        if vertical:
+            valid, level = self.checkRange(level, otherStripe, y1, otherStripe, y2)
+        else:
+            valid, level = self.checkRange(level, x1, otherStripe, x2, otherStripe)
+        return valid, level, otherShuffle
+    
+    def isMoveValid(self, level, baseRect):
+        return self.checkMove(level, baseRect.left, baseRect.top, baseRect.width, baseRect.height)
                 
     def isVerticalValid(self, level, baseRect):
-        return self.isStripeValid(level, self.verticals,
-                                  baseRect.left, baseRect.right)
+        x1, y1, x2, y2 = self.getTileRange(baseRect)
+        return self.checkStripes(level, x1, y1, x2, y2, baseRect.left, baseRect.right, True)
 
     def isHorizontalValid(self, level, baseRect):
-        return self.isStripeValid(level, self.horizontals,
-                                  baseRect.top, baseRect.bottom)
+        x1, y1, x2, y2 = self.getTileRange(baseRect)
+        return self.checkStripes(level, x1, y1, x2, y2, baseRect.top, baseRect.bottom, False)
         
     """
     The given sprite must contain mapRect, level, z and upright attributes.  Typically
     this object will be a real sprite, but for ease of unit testing it can be anything.
     """
     def getMasks(self, sprite):
-        spriteTiles = self.getSpanTiles(sprite.mapRect)
+        x1, y1, x2, y2 = self.getTileRange(sprite.mapRect)
+        if not self.isRangeMasked(x1, y1, x2, y2):
+            return NO_MASKS
+        # the masks only depend on where the sprite's z falls among the mask z
+        # values, so that is all that needs to be part of the key
+        zBand = bisect.bisect_right(self.maskZs, sprite.z)
+        key = (x1, y1, x2, y2, sprite.level, zBand, sprite.upright)
+        masks = self.maskCache.get(key)
+        if masks is None:
+            if len(self.maskCache) >= MASK_CACHE_SIZE:
+                self.maskCache.clear()
+            masks = self.findMasks(x1, y1, x2, y2, sprite.level, sprite.z, sprite.upright)
+            self.maskCache[key] = masks
+        return masks
+    
+    def findMasks(self, x1, y1, x2, y2, level, z, upright):
         masks = {}
-        for tile in spriteTiles:
-            if tile:
-                tileMasks = tile.getMasks(sprite.level, sprite.z, sprite.upright)
+        for x in range(x1, x2 + 1):
+            for tile in self.mapTiles[x][y1:y2 + 1]:
+                tileMasks = tile.getMasks(level, z, upright)
                 if tileMasks:
                     masks[(tile.x, tile.y)] = tileMasks
         return masks
     
+    """
+    Checks the masked tile bitmap for any masked tiles in the given range.
+    """
+    def isRangeMasked(self, x1, y1, x2, y2):
+        rows = self.rows
+        x = x1
+        while x <= x2:
+            i = x * rows
+            if self.maskedTiles.find(MASKED, i + y1, i + y2 + 1) >= 0:
+                return True
+            x += 1
+        return False
+    
+    """
+    Builds the masked tile bitmap, which holds MASKED for each tile (indexed on
+    x * rows + y) with masks, and the sorted mask z values.
+    """
+    def initialiseMasks(self):
+        self.maskedTiles = bytearray(self.cols * self.rows)
+        maskZs = set()
+        for x, tiles in enumerate(self.mapTiles):
+            for y, tile in enumerate(tiles):
+                if tile.masks:
+                    self.maskedTiles[x * self.rows + y] = MASKED
+                    maskZs.update([maskInfo.z for maskInfo in tile.masks])
+        self.maskZs = sorted(maskZs)
+        # masks keyed on tile range, level, z band and upright - see getMasks
+        self.maskCache = {}
+    
+    """
+    Draws a sprite that never changes into the map, so that it doesn't have to be
+    drawn every frame.  The sprite is drawn as it would look on the screen - with
+    any masks - and cut into tile sized pieces that become the top layer of each
+    tile.  Each piece is also a mask for other sprites that are behind the sprite.
+    """
+    def bakeSprite(self, sprite):
+        if sprite.uid in self.bakedSprites:
+            return
+        self.bakedSprites.add(sprite.uid)
+        left, top = sprite.mapRect.topleft
+        spriteImage = view.createTransparentRect(sprite.mapRect.size)
+        spriteImage.blit(sprite.image, (0, 0))
+        masks = self.getMasks(sprite)
+        for tilePoint in masks:
+            for mask in masks[tilePoint]:
+                spriteImage.blit(mask, (tilePoint[0] * TILE_SIZE - left, tilePoint[1] * TILE_SIZE - top))
+        x1, y1, x2, y2 = self.getTileRange(sprite.mapRect)
+        for x in range(x1, x2 + 1):
+            for y in range(y1, y2 + 1):
+                piece = view.createTransparentRect((TILE_SIZE, TILE_SIZE))
+                piece.blit(spriteImage, (left - x * TILE_SIZE, top - y * TILE_SIZE))
+                self.mapTiles[x][y].addSpriteMask(piece, sprite.z)
+        # the masks have changed and the chunks need to be rendered again
+        self.initialiseMasks()
+        cx1, cy1, cx2, cy2 = self.getChunkRange(sprite.mapRect)
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                self.chunks.pop((cx, cy), None)
+    
     """
     Returns all the tiles that are touched by the given rectangle.
     """
     def getSpanTiles(self, rect):
         rectTiles = []
-        x1, y1 = self.convertTopLeft(rect.left, rect.top)
-        x2, y2 = self.convertBottomRight(rect.right - 1, rect.bottom - 1)
+        x1, y1, x2, y2 = self.getTileRange(rect)
         for x in range(x1, x2 + 1):
             rectTiles += self.mapTiles[x][y1:y2 + 1]
         return rectTiles
     
     """
-    Returns all the tiles that are touched by the given rectangle.  As a side-effect,
-    this method also caches the 'verticals' + 'horizontals' - the same tiles, but
-    divided into columns + rows.  This makes it much easier to check for valid shuffles
-    if the requested movement is invalid.
+    Returns the range of tiles touched by the given rectangle, clipped to the map.
     """
-    def getBaseRectTiles(self, rect):
-        rectTiles = []
+    def getTileRange(self, rect):
         x1, y1 = self.convertTopLeft(rect.left, rect.top)
         x2, y2 = self.convertBottomRight(rect.right - 1, rect.bottom - 1)
-        self.verticals = {}
-        for x in range(x1, x2 + 1):
-            self.verticals[x] = self.mapTiles[x][y1:y2 + 1]
-            rectTiles += self.verticals[x]
-        self.horizontals = {}
-        for y in range(y1, y2 + 1):
-            self.horizontals[y] = [self.mapTiles[x][y] for x in range(x1, x2 + 1)]
-        return rectTiles
+        return x1, y1, x2, y2
     
     """
     Returns a tile event or a falling event.
@@ -214,6 +495,8 @@ class RpgMap:
         if self.toRestore == None:
             self.toRestore = set()
         self.toRestore.add(self.mapTiles[x][y].addNewLevel(level))
+        self.levelGrids = {}
+        self.maskCache = {}
     
     """
     Restores any modified tiles to their original state.
@@ -224,20 +507,32 @@ class RpgMap:
         for tile in self.toRestore:
             tile.restore()
         self.toRestore = None
+        self.levelGrids = {}
+        self.maskCache = {}
         return self
 
 """
-A repository of named tile images.  Instances of this class are created and used
-whenever a new map is loaded from disk.
+A repository of named tile images.  The tile set image is kept whole as an
+atlas and each tile is a subsurface of it, so no pixels are copied.  Instances
+of this class are created once and shared by every map - see parser.getTileSet.
 """
 class TileSet:
     
-    def __init__(self, tiles):
-        self.tiles = tiles
+    def __init__(self, atlas, tileRects):
+        self.atlas = atlas
+        self.tileRects = tileRects
+        self.tiles = {}
+
+    def getSize(self):
+        return assets.getSurfaceSize(self.atlas)
 
     def getTile(self, name):
         if name in self.tiles:
             return self.tiles[name]
+        if name in self.tileRects:
+            tile = self.atlas.subsurface(self.tileRects[name])
+            self.tiles[name] = tile
+            return tile
         return None
     
 """
@@ -298,22 +593,24 @@ class MapTile:
             self.masks = []
         self.masks.append(MaskInfo(tileIndex, level, flat, self.y))
         
+    def addSpriteMask(self, image, z):
+        if not self.masks:
+            self.masks = []
+        self.masks.append(SpriteMaskInfo(len(self.tiles), z))
+        self.addTile(image)
+        
     def addEvent(self, event):
         if not self.events:
             self.events = []
         self.events.append(event)
             
-    def createTileImage(self):
-        if len(self.tiles) == 0:
-            return None
-        elif len(self.tiles) > 1:
-            # if we're layering more than one image we don't want to draw on any of
-            # the original images because that will affect every copy
-            tileImage = view.createRectangle((TILE_SIZE, TILE_SIZE), view.BLACK)
-            for image in self.tiles:
-                tileImage.blit(image, (0, 0))
-            return tileImage
-        return self.tiles[0]
+    """
+    Draws the layered tile images straight from the tile set atlas.
+    """
+    def drawTile(self, surface, position):
+        for image in self.tiles:
+            if image:
+                surface.blit(image, position)
     
     def testValidity(self, level):
         if level in self.levels:
@@ -360,13 +657,7 @@ class MapTile:
             return None
         masks = []
         for maskInfo in self.masks:
-            if maskInfo.z > spriteZ:
-                if maskInfo.flat and maskInfo.level == spriteLevel:
-                    continue
-                masks.append(self.tiles[maskInfo.tileIndex])
-            else:
-                if spriteUpright or maskInfo.flat or maskInfo.level < spriteLevel:
-                    continue
+            if maskInfo.isMasking(spriteLevel, spriteZ, spriteUpright):
                 masks.append(self.tiles[maskInfo.tileIndex])
         if len(masks) > 0:
             return masks
@@ -392,6 +683,24 @@ class MaskInfo:
         self.tileIndex = tileIndex
         self.z = (y + 1) * TILE_SIZE + level * TILE_SIZE - 1
 
+    def isMasking(self, spriteLevel, spriteZ, spriteUpright):
+        if self.z > spriteZ:
+            return not (self.flat and self.level == spriteLevel)
+        return not (spriteUpright or self.flat or self.level < spriteLevel)
+
+"""
+Masking information for a piece of a sprite that has been drawn into the map -
+see RpgMap.bakeSprite.  It only masks sprites that would be drawn before the
+baked sprite, ie. sprites with a lower z.
+"""
+class SpriteMaskInfo(MaskInfo):
+    def __init__(self, tileIndex, z):
+        self.tileIndex = tileIndex
+        self.z = z
+        
+    def isMasking(self, spriteLevel, spriteZ, spriteUpright):
+        return self.z > spriteZ
+
 """
 Sprite placeholder that is later used to construct a real sprite.
 """        
@@ -0,0 +1,216 @@
+#! /usr/bin/env python
+
+import os
+import gc
+import random
+import timeit
+import parser
+import map
+
+from pygame.locals import Rect
+
+from view import TILE_SIZE
+from sprites import MOVE_UNIT, BASE_RECT_HEIGHT
+from playevents import TileEvent
+
+# the number of calls timed for each primitive on each map
+SAMPLES = 5000
+
+# the best of this many runs is taken
+REPEATS = 5
+
+SEED = 1
+
+# more than the number of lists or dicts that Python keeps for reuse
+FREE_LIST_SIZE = 100
+
+# the width of the player's base rect
+BASE_RECT_WIDTH = 14 * MOVE_UNIT
+
+# the levels and special levels used to fill the dense maps
+DENSE_LEVELS = [1, 2, 3, 4, 5]
+DENSE_SPECIAL_LEVELS = [1, 1.5, 2, 2.5, 3, 3.5, 4]
+
+# synthetic maps where every tile has several levels, masks, etc.
+DENSE_MAPS = [("dense32", 32, 32), ("dense64", 64, 64)]
+
+PRIMITIVES = ["isMoveValid", "isVerticalValid", "isHorizontalValid", "getMasks",
+              "getSpanTiles", "getActions", "testValidity", "getSpecialLevel"]
+
+"""
+A stand in for a sprite with the attributes that RpgMap.getMasks needs.
+"""
+class BenchmarkSprite:
+
+    def __init__(self, mapRect, level, upright):
+        self.mapRect = mapRect
+        self.level = level
+        self.upright = upright
+        self.z = mapRect.bottom + level * TILE_SIZE
+
+"""
+Returns a map where every tile has several levels, masks and tile images, plus
+special levels, down levels and events on some of them.  The tile images are
+never drawn, so they're left empty.
+"""
+def createDenseMap(name, cols, rows, seed = SEED):
+    rand = random.Random(seed)
+    mapTiles = [[map.MapTile(x, y) for y in range(rows)] for x in range(cols)]
+    mapEvents = []
+    for tiles in mapTiles:
+        for tile in tiles:
+            for level in rand.sample(DENSE_LEVELS, rand.randint(1, 3)):
+                tile.addLevel(level)
+            if rand.random() < 0.3:
+                tile.addSpecialLevel(rand.choice(DENSE_SPECIAL_LEVELS))
+            if rand.random() < 0.1:
+                level = rand.choice(DENSE_LEVELS)
+                tile.addDownLevel(level, max(1, level - 1))
+            for i in range(rand.randint(1, 3)):
+                tile.addMask(len(tile.tiles), rand.choice(DENSE_LEVELS), rand.random() < 0.5)
+                tile.addTile(None)
+            if rand.random() < 0.05:
+                mapEvents.append(TileEvent(None, tile.x, tile.y, rand.choice(DENSE_LEVELS)))
+    return map.RpgMap(name, mapTiles, [], mapEvents)
+
+"""
+Returns every level that the tiles of the given map have, including special
+levels and the levels that have a down level.
+"""
+def getMapLevels(rpgMap):
+    levels = set()
+    for tiles in rpgMap.mapTiles:
+        for tile in tiles:
+            levels.update(tile.levels)
+            if tile.specialLevels:
+                levels.update(tile.specialLevels.values())
+            if tile.downLevels:
+                levels.update(tile.downLevels)
+    return sorted(levels)
+
+"""
+Returns the arguments for each call to each primitive on the given map.  The
+rects are scattered over the map, some partly off the edges, and the levels
+are those of the map - so some moves are valid and some aren't.
+"""
+def getSamples(rpgMap, samples = SAMPLES, seed = SEED):
+    rand = random.Random(seed)
+    levels = getMapLevels(rpgMap) or [1]
+    mapRect = rpgMap.mapRect
+    def randomRect(width, height):
+        left = rand.randrange(-(width // 2), mapRect.width - width // 2, MOVE_UNIT)
+        top = rand.randrange(-(height // 2), mapRect.height - height // 2, MOVE_UNIT)
+        return Rect(left, top, width, height)
+    def randomTile():
+        return rpgMap.mapTiles[rand.randrange(rpgMap.cols)][rand.randrange(rpgMap.rows)]
+    baseRects = [(rand.choice(levels), randomRect(BASE_RECT_WIDTH, BASE_RECT_HEIGHT))
+                 for i in range(samples)]
+    spriteRects = [randomRect(rand.randrange(16, 65, MOVE_UNIT), rand.randrange(16, 65, MOVE_UNIT))
+                   for i in range(samples)]
+    mapSprites = [BenchmarkSprite(rect, rand.choice(levels), rand.random() < 0.8)
+                  for rect in spriteRects]
+    tileLevels = [(randomTile(), rand.choice(levels)) for i in range(samples)]
+    return {"isMoveValid": (rpgMap.isMoveValid, baseRects),
+            "isVerticalValid": (rpgMap.isVerticalValid, baseRects),
+            "isHorizontalValid": (rpgMap.isHorizontalValid, baseRects),
+            "getMasks": (rpgMap.getMasks, [(sprite,) for sprite in mapSprites]),
+            "getSpanTiles": (rpgMap.getSpanTiles, [(rect,) for rect in spriteRects]),
+            "getActions": (rpgMap.getActions, baseRects),
+            "testValidity": (map.MapTile.testValidity, tileLevels),
+            "getSpecialLevel": (map.MapTile.getSpecialLevel, tileLevels)}
+
+"""
+Returns the number of calls per second, from the best of several runs.
+"""
+def getCallsPerSec(function, argsList, repeats = REPEATS, getTime = timeit.default_timer):
+    bestTime = None
+    for i in range(repeats):
+        startTime = getTime()
+        for args in argsList:
+            function(*args)
+        runTime = getTime() - startTime
+        if bestTime is None or runTime < bestTime:
+            bestTime = runTime
+    return len(argsList) / bestTime if bestTime else 0.0
+
+"""
+Returns the number of containers - lists, tuples, dicts, objects etc. - per
+call that are still allocated when the call returns, eg. a list of tiles that
+is returned.  Python 2 has no allocation tracing, so this is the change in the
+garbage collector's count of the containers it tracks: other objects such as
+ints and strings, and temporaries that are freed before the call returns,
+don't show up.  Containers reused from a free list aren't counted either, so
+the lists and dicts that the warm up call leaves in the free lists are used up
+by spare ones first.
+"""
+def getRetainedContainersPerCall(function, argsList):
+    # the results are kept until the end, so that they are counted
+    results = []
+    gc.collect()
+    # anything only allocated on the first call isn't counted
+    function(*argsList[0])
+    # use up the free lists - the spares are never read, just kept alive
+    spareLists = [[] for i in range(FREE_LIST_SIZE)]
+    spareDicts = [{} for i in range(FREE_LIST_SIZE)]
+    gc.disable()
+    try:
+        startCount = gc.get_count()[0]
+        for args in argsList:
+            results.append(function(*args))
+        containers = gc.get_count()[0] - startCount
+    finally:
+        gc.enable()
+    # only now can the spares refill the free lists
+    del results, spareLists, spareDicts
+    return float(containers) / len(argsList)
+
+def runPrimitives(rpgMap, samples = SAMPLES, repeats = REPEATS):
+    results = {}
+    mapSamples = getSamples(rpgMap, samples)
+    for primitive in PRIMITIVES:
+        function, argsList = mapSamples[primitive]
+        results[primitive] = {"callsPerSec": getCallsPerSec(function, argsList, repeats),
+                              "retainedContainersPerCall": getRetainedContainersPerCall(function, argsList)}
+    return results
+
+def getShippedMapNames():
+    mapNames = []
+    for filename in sorted(os.listdir(parser.MAPS_FOLDER)):
+        name, extension = os.path.splitext(filename)
+        if extension == parser.MAP_EXTENSION:
+            mapNames.append(name)
+    return mapNames
+
+"""
+Runs the primitives against the given maps, or every shipped map and the dense
+maps, and returns the results keyed on map name.
+"""
+def runBenchmarks(mapNames = None, samples = SAMPLES, repeats = REPEATS):
+    results = {}
+    for mapName in getShippedMapNames():
+        if not mapNames or mapName in mapNames:
+            results[mapName] = runPrimitives(parser.createRpgMap(mapName), samples, repeats)
+    for mapName, cols, rows in DENSE_MAPS:
+        if not mapNames or mapName in mapNames:
+            results[mapName] = runPrimitives(createDenseMap(mapName, cols, rows), samples, repeats)
+    return results
+
+"""
+Returns the results as a table of calls per second and retained containers per
+call for each map.  If base results are given, the change in calls per second from them
+is shown as well.
+"""
+def formatResults(results, baseResults = None):
+    lines = []
+    for mapName in sorted(results):
+        lines.append(mapName)
+        for primitive in PRIMITIVES:
+            timings = results[mapName][primitive]
+            line = "  %-17s %10.0f calls/sec" % (primitive, timings["callsPerSec"])
+            if baseResults and mapName in baseResults:
+                baseCallsPerSec = baseResults[mapName][primitive]["callsPerSec"]
+                if baseCallsPerSec:
+                    line += " (%+4.0f%%)" % ((timings["callsPerSec"] - baseCallsPerSec) * 100 / baseCallsPerSec)
+            line += " %5.2f retained containers/call" % timings["retainedContainersPerCall"]
+            lines.append(line)
+    return "\n".join(lines)
@@ -1,21 +1,47 @@
 #! /usr/bin/env python
 
+import os
+import tempfile
+import threading
 import unittest
 import pygame
 import parser
 import view
+import map
+import compiledmap
+import prefetcher
+import assets
+import sprites
+import othersprites
+import spriteframes
+import font
+import fixedsprites
+import gameclock
+import simulation
+import states
+import replay
+import benchmark
+import mapbenchmark
+import staticsprites
+import player
 
-from pygame.locals import Rect
+from pygame.locals import Rect, K_UP, K_RIGHT, K_SPACE
 
 from view import TILE_SIZE
+from assets import assetCache
+from registry import Registry
 
-# initialize everything
+# initialize everything - no display is needed
 pygame.init()
-screen = pygame.display.set_mode((1, 1))
 
 # this feels a bit hacky - is there a better way to do it?
 parser.MAPS_FOLDER = "../maps"
 parser.TILES_FOLDER = "../tiles"
+font.FONT_FOLDER = "../images"
+othersprites.SPRITES_FOLDER = "../sprites"
+staticsprites.SPRITES_FOLDER = "../sprites"
+fixedsprites.SPRITES_FOLDER = "../sprites"
+player.SPRITES_FOLDER = "../sprites"
 
 rpgMap = parser.loadRpgMap("unit")
 
@@ -110,6 +136,44 @@ class GetMasksTest(unittest.TestCase):
         spriteInfo.move(0, TILE_SIZE)
         self.assertEqual(0, len(rpgMap.getMasks(spriteInfo)))
 
+class MaskCacheTest(unittest.TestCase):
+
+    """
+    Cached masks must be the same as the masks found for each sprite afresh.
+    """
+    def testSameAsFindMasks(self):
+        for mapName in ["unit", "central", "caves"]:
+            maskMap = parser.loadRpgMap(mapName)
+            for level in [1, 2, 3, 4]:
+                for upright in [True, False]:
+                    for x in range(-TILE_SIZE, maskMap.mapRect.width, 13):
+                        for y in range(-TILE_SIZE, maskMap.mapRect.height, 9):
+                            spriteInfo = MockSprite(Rect(x, y, 28, 48), level)
+                            spriteInfo.upright = upright
+                            spriteInfo.move(0, 0)
+                            x1, y1, x2, y2 = maskMap.getTileRange(spriteInfo.mapRect)
+                            self.assertEqual(maskMap.findMasks(x1, y1, x2, y2, level, spriteInfo.z, upright),
+                                             maskMap.getMasks(spriteInfo))
+
+    def testUnmasked(self):
+        spriteInfo = MockSprite(Rect(0, 0, 28, 48), 1)
+        spriteInfo.move(0, 0)
+        rpgMap.maskCache = {}
+        self.assertFalse(rpgMap.isRangeMasked(0, 0, 0, 1))
+        self.assertEqual(0, len(rpgMap.getMasks(spriteInfo)))
+        self.assertEqual(0, len(rpgMap.maskCache))
+
+    def testInvalidation(self):
+        spriteInfo = MockSprite(Rect(6 * TILE_SIZE + 2, 2 * TILE_SIZE - 24, 28, 48), 1)
+        spriteInfo.move(0, 0)
+        self.assertEqual(1, len(rpgMap.getMasks(spriteInfo)))
+        self.assertTrue(len(rpgMap.maskCache) > 0)
+        rpgMap.addLevel(0, 0, 9)
+        self.assertEqual(0, len(rpgMap.maskCache))
+        self.assertEqual(1, len(rpgMap.getMasks(spriteInfo)))
+        rpgMap.restore()
+        self.assertEqual(0, len(rpgMap.maskCache))
+
 class MovementValidTest(unittest.TestCase):
 
     def testSpan1_1(self):
@@ -117,61 +181,61 @@ class MovementValidTest(unittest.TestCase):
         baseRect = Rect(5 * TILE_SIZE + 2, 2 * TILE_SIZE + 8, 28, 18)
         # [1,2] [S2]
         baseRect.move_ip(0, 16)
-        self.assertEqual(2, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(2, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((False, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((False, 1.5), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((True, 2), rpgMap.isMoveValid(2, baseRect))
         # [S2]
         baseRect.move_ip(0, 16)
-        self.assertEqual(1, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(1, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((False, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((True, 2), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((True, 2), rpgMap.isMoveValid(2, baseRect))
         # [S2] [S1.5]
         baseRect.move_ip(0, 16)
-        self.assertEqual(2, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(2, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((False, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((True, 2), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((True, 2), rpgMap.isMoveValid(2, baseRect))
         # [S1.5]
         baseRect.move_ip(0, 16)
-        self.assertEqual(1, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(1, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(2, baseRect))
         # [S1.5] [S1.5]
         baseRect.move_ip(0, 16)
-        self.assertEqual(2, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(2, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(2, baseRect))
         # [S1.5]
         baseRect.move_ip(0, 16)
-        self.assertEqual(1, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(1, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((True, 1.5), rpgMap.isMoveValid(2, baseRect))
         # [S1.5] [S1]
         baseRect.move_ip(0, 16)
-        self.assertEqual(2, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(2, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((True, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((True, 1), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((False, 2), rpgMap.isMoveValid(2, baseRect))
         # [S1]
         baseRect.move_ip(0, 16)
-        self.assertEqual(1, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(1, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((True, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((True, 1), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((False, 2), rpgMap.isMoveValid(2, baseRect))
         # [S1] [1]
         baseRect.move_ip(0, 16)
-        self.assertEqual(2, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(2, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((True, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((False, 1.5), rpgMap.isMoveValid(1.5, baseRect))
         self.assertEqual((False, 2), rpgMap.isMoveValid(2, baseRect))
         # [1]
         baseRect.move_ip(0, 16)
-        self.assertEqual(1, len(rpgMap.getBaseRectTiles(baseRect)))
+        self.assertEqual(1, len(rpgMap.getSpanTiles(baseRect)))
         self.assertEqual((True, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((False, 2), rpgMap.isMoveValid(2, baseRect))
 
@@ -384,5 +448,783 @@ class MovementValidTest(unittest.TestCase):
         self.assertEqual((True, 1), rpgMap.isMoveValid(1, baseRect))
         self.assertEqual((False, 2), rpgMap.isMoveValid(2, baseRect))
         
+class LevelGridTest(unittest.TestCase):
+
+    """
+    The walkability grids must give the same results as the tile by tile rules.
+    """
+    def testSameAsSpanValid(self):
+        for mapName in ["unit", "central", "caves"]:
+            gridMap = parser.loadRpgMap(mapName)
+            levels = set([1, 1.5, 2, 2.5, 3, 3.5, 4, 5])
+            for tiles in gridMap.mapTiles:
+                for tile in tiles:
+                    levels.update(tile.levels)
+            for level in levels:
+                for x in range(-TILE_SIZE // 2, gridMap.mapRect.width, 7):
+                    for y in range(-TILE_SIZE // 2, gridMap.mapRect.height, 11):
+                        baseRect = Rect(x, y, 24, 18)
+                        self.assertEqual(gridMap.isSpanValid(level, gridMap.getSpanTiles(baseRect)),
+                                         gridMap.isMoveValid(level, baseRect))
+
+    def testAddLevel(self):
+        baseRect = Rect(4 * TILE_SIZE, 6 * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+        valid, level = rpgMap.isMoveValid(9, baseRect)
+        self.assertFalse(valid)
+        rpgMap.addLevel(4, 6, 9)
+        self.assertEqual((True, 9), rpgMap.isMoveValid(9, baseRect))
+        rpgMap.restore()
+        self.assertEqual((False, 9), rpgMap.isMoveValid(9, baseRect))
+
+class MapChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chunkMap = parser.loadRpgMap("central")
+        self.mapImage = view.createRectangle(self.chunkMap.mapRect.size, view.BLACK)
+        for tiles in self.chunkMap.mapTiles:
+            for tile in tiles:
+                tile.drawTile(self.mapImage, (tile.x * TILE_SIZE, tile.y * TILE_SIZE))
+
+    def testDrawMapArea(self):
+        viewSize = (view.VIEW_WIDTH, view.VIEW_HEIGHT)
+        for x, y in [(0, 0), (2, 2), (310, 100), (320, 224), (704, 800), (703, 799)]:
+            area = Rect((x, y), viewSize)
+            expected = view.createRectangle(viewSize, view.BLACK)
+            expected.blit(self.mapImage, (0, 0), area)
+            actual = view.createRectangle(viewSize, view.BLACK)
+            self.chunkMap.drawMapArea(actual, (0, 0), area)
+            self.assertEqual(pygame.image.tostring(expected, "RGB"),
+                             pygame.image.tostring(actual, "RGB"))
+            self.assertTrue(len(self.chunkMap.chunks) <= map.CHUNK_BUDGET)
+
+    def testRenderMapArea(self):
+        self.chunkMap.chunks.clear()
+        area = Rect(320, 224, view.VIEW_WIDTH, view.VIEW_HEIGHT)
+        self.assertFalse(self.chunkMap.renderMapArea(area, 1))
+        self.assertEqual(1, len(self.chunkMap.chunks))
+        while not self.chunkMap.renderMapArea(area, 1):
+            pass
+        self.assertTrue(len(self.chunkMap.chunks) > 1)
+        self.assertTrue(self.chunkMap.renderMapArea(area, 1))
+
+class MapPrefetcherTest(unittest.TestCase):
+
+    def testPrefetchNear(self):
+        centralMap = parser.loadRpgMap("central")
+        assetCache.discard(parser.getMapKey("east"))
+        mapPrefetcher = prefetcher.MapPrefetcher()
+        # too far from any exit
+        mapPrefetcher.prefetchNear(centralMap, Rect(12 * TILE_SIZE, 12 * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+        mapPrefetcher.requests.join()
+        self.assertFalse(parser.isMapCached("east"))
+        # approaching the right boundary that leads to the east map
+        playerRect = Rect(30 * TILE_SIZE, 5 * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+        mapPrefetcher.prefetchNear(centralMap, playerRect)
+        mapPrefetcher.requests.join()
+        # the map is read by the worker, but created and rendered on this thread
+        mapPrefetcher.finishLoading()
+        self.assertTrue(parser.isMapCached("east"))
+        self.assertEqual(set(), mapPrefetcher.pending)
+        while mapPrefetcher.rendering:
+            mapPrefetcher.prefetchNear(centralMap, playerRect)
+        eastMap = parser.loadRpgMap("east")
+        self.assertTrue(len(eastMap.chunks) > 0)
+        mapPrefetcher.stop()
+        self.assertFalse(mapPrefetcher.worker.isAlive())
+
+    def testPrefetchFailure(self):
+        centralMap = parser.loadRpgMap("central")
+        assetCache.discard(parser.getMapKey("east"))
+        mapPrefetcher = prefetcher.MapPrefetcher()
+        prefetchMapData = parser.prefetchMapData
+        def failingPrefetch(name):
+            raise ValueError("bad map")
+        parser.prefetchMapData = failingPrefetch
+        try:
+            mapPrefetcher.prefetchNear(centralMap, Rect(30 * TILE_SIZE, 5 * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+            mapPrefetcher.requests.join()
+        finally:
+            parser.prefetchMapData = prefetchMapData
+        self.assertFalse(parser.isMapCached("east"))
+        self.assertEqual(set(), mapPrefetcher.pending)
+        # the worker is still running, so the map can be prefetched again
+        mapPrefetcher.prefetchNear(centralMap, Rect(30 * TILE_SIZE, 5 * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+        mapPrefetcher.requests.join()
+        mapPrefetcher.finishLoading()
+        self.assertTrue(parser.isMapCached("east"))
+        mapPrefetcher.stop()
+
+class AssetCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = 0
+        self.surfaceSize = assets.getSurfaceSize(self.loadSurface())
+        self.cache = assets.AssetCache(self.surfaceSize * 2)
+
+    def loadSurface(self):
+        self.loads += 1
+        return pygame.Surface((TILE_SIZE, TILE_SIZE))
+
+    def testLeastRecentlyUsedEviction(self):
+        a = self.cache.get("a", self.loadSurface)
+        self.cache.get("b", self.loadSurface)
+        self.assertTrue(a is self.cache.get("a", self.loadSurface))
+        self.cache.get("c", self.loadSurface)
+        # b was the least recently used
+        self.assertFalse(self.cache.contains("b"))
+        self.assertTrue(self.cache.contains("a"))
+        self.assertEqual(self.surfaceSize * 2, self.cache.getUsedBytes())
+        self.assertEqual((1, 3, 1), (self.cache.hits, self.cache.misses, self.cache.evictions))
+
+    def testPinning(self):
+        self.cache.get("a", self.loadSurface, True)
+        self.cache.get("b", self.loadSurface)
+        self.cache.get("c", self.loadSurface)
+        self.assertTrue(self.cache.contains("a"))
+        self.assertFalse(self.cache.contains("b"))
+        self.cache.unpin("a")
+        self.cache.get("d", self.loadSurface)
+        self.assertFalse(self.cache.contains("a"))
+
+    def testSubsurfaceSize(self):
+        surface = self.loadSurface()
+        frames = [surface.subsurface((0, 0, 4, 4)), surface.subsurface((4, 0, 4, 4))]
+        self.assertEqual(self.surfaceSize, assets.getSurfaceSize(frames[0]))
+        # the shared parent is only counted once
+        self.assertEqual(self.surfaceSize, assets.getAssetSize(frames))
+        self.assertEqual(self.surfaceSize, assets.getAssetSize([surface] + frames))
+
+    def testSharedSurfaceEviction(self):
+        sheet = self.cache.get("sheet", self.loadSurface)
+        self.cache.get("frames", lambda: [sheet.subsurface((0, 0, 4, 4))])
+        self.assertEqual(self.surfaceSize, self.cache.getUsedBytes())
+        self.cache.get("a", self.loadSurface)
+        self.cache.get("b", self.loadSurface)
+        # evicting the sheet frees nothing while its frames are cached, so they go as well
+        self.assertFalse(self.cache.contains("sheet"))
+        self.assertFalse(self.cache.contains("frames"))
+        self.assertEqual(self.surfaceSize * 2, self.cache.getUsedBytes())
+
+    def testMapSize(self):
+        sizeMap = parser.loadRpgMap("unit")
+        sizeMap.chunks = {}
+        self.assertEqual(0, sizeMap.getSize())
+        sizeMap.renderMapArea(Rect(0, 0, 1, 1))
+        self.assertTrue(sizeMap.getSize() > 0)
+
+class CompiledMapTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.compiledMapPath = tempfile.mkstemp(parser.COMPILED_MAP_EXTENSION)
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.compiledMapPath)
+
+    def testRoundTrip(self):
+        for filename in os.listdir(parser.MAPS_FOLDER):
+            name, extension = os.path.splitext(filename)
+            if extension != parser.MAP_EXTENSION:
+                continue
+            mapData = parser.parseMapFile(name)
+            stamp = parser.getSourceStamp(name)
+            compiledmap.writeCompiledMap(self.compiledMapPath, mapData, stamp)
+            compiledData = compiledmap.readCompiledMap(self.compiledMapPath, stamp)
+            self.assertEqual((mapData.cols, mapData.rows), (compiledData.cols, compiledData.rows))
+            self.assertEqual(sorted(mapData.levels), sorted(compiledData.levels))
+            self.assertEqual(sorted(mapData.images), sorted(compiledData.images))
+            self.assertEqual([vars(s) for s in mapData.mapSprites],
+                             [vars(s) for s in compiledData.mapSprites])
+            self.assertEqual([eventInfo(e) for e in mapData.mapEvents],
+                             [eventInfo(e) for e in compiledData.mapEvents])
+
+    def testStale(self):
+        mapData = parser.parseMapFile("unit")
+        stamp = parser.getSourceStamp("unit")
+        compiledmap.writeCompiledMap(self.compiledMapPath, mapData, stamp)
+        self.assertNotEqual(None, compiledmap.readCompiledMap(self.compiledMapPath, stamp))
+        self.assertEqual(None, compiledmap.readCompiledMap(self.compiledMapPath, (stamp[0] + 1, stamp[1])))
+        # no source file - the compiled map is used as is
+        self.assertNotEqual(None, compiledmap.readCompiledMap(self.compiledMapPath))
+
+    def testMissing(self):
+        self.assertEqual(None, compiledmap.readCompiledMap(self.compiledMapPath + ".missing"))
+
+    def testCorrupt(self):
+        mapData = parser.parseMapFile("unit")
+        compiledmap.writeCompiledMap(self.compiledMapPath, mapData, (0, 0))
+        with open(self.compiledMapPath, "rb") as compiledFile:
+            data = compiledFile.read()
+        # truncated, or with a garbled header or body
+        middle = len(data) // 2
+        for badData in [data[:10], data[:compiledmap.HEADER.size], data[:middle],
+                        data[:8] + "\xff\xff" + data[10:],
+                        data[:middle] + chr(ord(data[middle]) ^ 0xff) + data[middle + 1:]]:
+            with open(self.compiledMapPath, "wb") as compiledFile:
+                compiledFile.write(badData)
+            self.assertEqual(None, compiledmap.readCompiledMap(self.compiledMapPath))
+        # well formed, but with tiles outside the map
+        mapData.cols = 2
+        compiledmap.writeCompiledMap(self.compiledMapPath, mapData, (0, 0))
+        self.assertEqual(None, compiledmap.readCompiledMap(self.compiledMapPath))
+
+    def testCorruptFallback(self):
+        # stand in for the unit map's compiled file, if it has one
+        compiledMapPath = parser.getCompiledMapPath("unit")
+        if os.path.exists(compiledMapPath):
+            os.rename(compiledMapPath, self.compiledMapPath)
+        mapData = parser.parseMapFile("unit")
+        compiledmap.writeCompiledMap(compiledMapPath, mapData, parser.getSourceStamp("unit"))
+        try:
+            with open(compiledMapPath, "r+b") as compiledFile:
+                compiledFile.truncate(os.path.getsize(compiledMapPath) - 1)
+            unitMap = parser.createRpgMap("unit")
+        finally:
+            os.remove(compiledMapPath)
+            if os.path.getsize(self.compiledMapPath):
+                os.rename(self.compiledMapPath, compiledMapPath)
+                open(self.compiledMapPath, "w").close()
+        self.assertEqual((mapData.cols, mapData.rows), (unitMap.cols, unitMap.rows))
+        self.assertEqual(len(mapData.mapSprites), len(unitMap.mapSprites))
+
+class BakeSpriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bakeMap = parser.loadRpgMap("unit")
+        # a static sprite on an unmasked part of the map
+        self.sprite = MockSprite(Rect(TILE_SIZE, TILE_SIZE, TILE_SIZE, TILE_SIZE), 1)
+        self.sprite.move(0, 0)
+        self.sprite.uid = "rock"
+        self.sprite.image = view.createRectangle((TILE_SIZE, TILE_SIZE), view.RED)
+
+    def testBakeSprite(self):
+        self.assertEqual(0, len(self.bakeMap.getMasks(self.sprite)))
+        self.bakeMap.bakeSprite(self.sprite)
+        self.bakeMap.bakeSprite(self.sprite)
+        tile = self.bakeMap.mapTiles[1][1]
+        self.assertEqual(1, len(tile.masks))
+        # the baked sprite is drawn with the map
+        image = view.createRectangle((TILE_SIZE, TILE_SIZE), view.BLUE)
+        tile.drawTile(image, (0, 0))
+        self.assertEqual(view.RED, tuple(image.get_at((1, 1)))[:3])
+        # and masks sprites that are behind it, but not those in front
+        behind = MockSprite(Rect(TILE_SIZE, TILE_SIZE - 8, 28, 48), 1)
+        behind.move(0, -16)
+        self.assertTrue(len(self.bakeMap.getMasks(behind)) > 0)
+        inFront = MockSprite(Rect(TILE_SIZE, TILE_SIZE, 28, 48), 1)
+        inFront.move(0, 8)
+        self.assertEqual(0, len(self.bakeMap.getMasks(inFront)))
+
+class MockFrames:
+
+    def __init__(self):
+        self.image = view.createRectangle((TILE_SIZE, TILE_SIZE))
+
+    def advanceFrame(self, increment, **metadata):
+        return self.image, 0
+
+class RpgSpritesTest(unittest.TestCase):
+
+    def createSprite(self, y):
+        sprite = sprites.RpgSprite(MockFrames())
+        sprite.setPixelPosition(0, y, 1)
+        return sprite
+
+    def testOrder(self):
+        sprite1, sprite2, sprite3 = [self.createSprite(y) for y in (40, 20, 60)]
+        group = sprites.RpgSprites(sprite1, sprite2, sprite3)
+        self.assertEqual([sprite2, sprite1, sprite3], group.sprites())
+        # moving a sprite reorders it
+        sprite2.doMove(0, 30)
+        self.assertEqual([sprite1, sprite2, sprite3], group.sprites())
+        sprite3.doMove(0, -60)
+        self.assertEqual([sprite3, sprite1, sprite2], group.sprites())
+        group.remove(sprite1)
+        self.assertEqual([sprite3, sprite2], group.sprites())
+        self.assertEqual([], sprite1.orderedGroups)
+
+    def testStableView(self):
+        sprite1, sprite2 = [self.createSprite(y) for y in (20, 40)]
+        group = sprites.RpgSprites(sprite1, sprite2)
+        spritesView = group.sprites()
+        self.assertTrue(spritesView is group.sprites())
+        sprite1.doMove(0, 40)
+        group.remove(sprite2)
+        self.assertEqual([sprite1, sprite2], spritesView)
+        self.assertEqual([sprite1], group.sprites())
+
+class OcclusionTest(unittest.TestCase):
+
+    def tearDown(self):
+        view.OCCLUSION_MODE = True
+
+    """
+    Returns the view at the top left of the unit map with a red sprite drawn
+    behind the masked tile at (6, 2), using the given occlusion mode.
+    """
+    def drawMaskedSprite(self, occlusionMode, applyMasks = True):
+        view.OCCLUSION_MODE = occlusionMode
+        frames = MockFrames()
+        frames.image.fill(view.RED)
+        sprite = sprites.RpgSprite(frames)
+        sprite.setup("red", rpgMap, None)
+        sprite.setPixelPosition(6 * TILE_SIZE + 2, 2 * TILE_SIZE - 8, 1)
+        sprite.rect.topleft = sprite.mapRect.topleft
+        if applyMasks:
+            sprite.applyMasks()
+            self.assertTrue(sprite.masks if occlusionMode else sprite.maskedFrame)
+        viewRect = Rect(0, 0, view.VIEW_WIDTH, view.VIEW_HEIGHT)
+        surface = view.createRectangle(viewRect.size, view.BLACK)
+        rpgMap.drawMapArea(surface, (0, 0), viewRect)
+        group = sprites.RpgSprites(sprite)
+        group.draw(surface)
+        areaSurface = view.createRectangle(viewRect.size, view.BLACK)
+        rpgMap.drawMapArea(areaSurface, (0, 0), viewRect)
+        group.drawArea(areaSurface, sprite.rect)
+        self.assertEqual(pygame.image.tostring(surface, "RGB"), pygame.image.tostring(areaSurface, "RGB"))
+        sprite.clearMasks()
+        return pygame.image.tostring(surface, "RGB")
+
+    def testSameAsMaskedFrame(self):
+        occluded = self.drawMaskedSprite(True)
+        self.assertEqual(self.drawMaskedSprite(False), occluded)
+        # the tile does hide some of the sprite
+        self.assertNotEqual(self.drawMaskedSprite(True, False), occluded)
+
+class IndexedSpritesTest(unittest.TestCase):
+
+    def createSprite(self, x, y, level):
+        sprite = sprites.RpgSprite(MockFrames())
+        sprite.setPixelPosition(x, y, level)
+        return sprite
+
+    def testGetSprites(self):
+        sprite1 = self.createSprite(0, 40, 1)
+        sprite2 = self.createSprite(TILE_SIZE * 8, 20, 1)
+        sprite3 = self.createSprite(TILE_SIZE, 20, 2)
+        group = sprites.IndexedSprites(sprite1, sprite2, sprite3)
+        self.assertEqual([sprite1], group.getSprites(Rect(0, 0, TILE_SIZE, TILE_SIZE * 2), 1))
+        self.assertEqual([], group.getSprites(Rect(0, 0, TILE_SIZE, TILE_SIZE * 2), 3))
+        # all levels, in z order
+        self.assertEqual([sprite1, sprite3], group.getSprites(Rect(0, 0, TILE_SIZE * 2, TILE_SIZE * 2)))
+        # moving a sprite reindexes it
+        sprite2.doMove(-TILE_SIZE * 8, 0)
+        self.assertEqual([sprite2, sprite1], group.getSprites(Rect(0, 0, TILE_SIZE, TILE_SIZE * 2), 1))
+        group.remove(sprite1)
+        self.assertEqual([sprite2], group.getSprites(Rect(0, 0, TILE_SIZE, TILE_SIZE * 2), 1))
+        self.assertEqual(None, sprite1.spriteIndex)
+
+class MockPlayer:
+
+    def __init__(self, viewRect):
+        self.viewRect = viewRect
+
+class DormantSpritesTest(unittest.TestCase):
+
+    def createBeetle(self, beetleMap):
+        beetle = othersprites.Beetle()
+        beetle.setup("beetle", beetleMap, None)
+        beetle.initMovement(1, [(6, 5), (6, 11)])
+        return beetle
+
+    """
+    A beetle that is only updated when it's near the view must be wherever an
+    always updated one is whenever it can be seen - even when the view is only
+    over the far end of its path.
+    """
+    def testWakeByPath(self):
+        beetleMap = parser.loadRpgMap("wasps")
+        for viewTop in [320, 330, 340, 352]:
+            player = MockPlayer(Rect(0, viewTop, view.VIEW_WIDTH, view.VIEW_HEIGHT))
+            dormant, updated = self.createBeetle(beetleMap), self.createBeetle(beetleMap)
+            gameSprites, dormantVisible = sprites.IndexedSprites(dormant), sprites.RpgSprites()
+            updatedSprites, updatedVisible = pygame.sprite.Group(updated), sprites.RpgSprites()
+            seen = False
+            for i in range(400):
+                gameSprites.update(player, gameSprites, dormantVisible, 1)
+                updated.update(player, updatedSprites, updatedVisible, 1)
+                self.assertEqual(updated in updatedVisible, dormant in dormantVisible)
+                if updated in updatedVisible:
+                    seen = True
+                    self.assertEqual(updated.mapRect, dormant.mapRect)
+            self.assertTrue(seen)
+
+class BeetleTest(unittest.TestCase):
+
+    def createBeetle(self):
+        beetle = othersprites.Beetle()
+        beetle.initMovement(1, [(2, 2), (5, 2), (5, 2), (5, 4), (1, 6)])
+        return beetle
+
+    def step(self, beetle, ticks):
+        for i in range(ticks):
+            px, py, metadata = beetle.getMovement(None)
+            beetle.doMove(px, py)
+
+    def testFastForward(self):
+        # the path includes a repeated point and a diagonal
+        for start in (0, 7, 33):
+            for ticks in range(1, 100):
+                stepped, forwarded = self.createBeetle(), self.createBeetle()
+                self.step(stepped, start + ticks)
+                self.step(forwarded, start)
+                forwarded.fastForward(ticks)
+                self.assertEqual(stepped.mapRect, forwarded.mapRect)
+                self.assertEqual(stepped.pathPointIndex, forwarded.pathPointIndex)
+
+    def testProgress(self):
+        beetle = self.createBeetle()
+        self.step(beetle, 11)
+        progress = beetle.getProgress()
+        # a new beetle carries on from the same place
+        released = self.createBeetle()
+        released.setProgress(progress)
+        self.step(beetle, 5)
+        self.step(released, 5)
+        self.assertEqual(beetle.mapRect, released.mapRect)
+        self.assertEqual(beetle.pathPointIndex, released.pathPointIndex)
+
+class AnimationClockTest(unittest.TestCase):
+
+    def testGetFrame(self):
+        clock = spriteframes.AnimationClock()
+        frames = [view.createRectangle((1, 1)) for i in range(4)]
+        spriteFrames1 = spriteframes.StaticFrames(frames, 3, clock)
+        spriteFrames2 = spriteframes.StaticFrames(frames, 3)
+        for i in range(20):
+            clock.tick()
+            self.assertEqual(spriteFrames2.advanceFrame(), spriteFrames1.advanceFrame())
+        # no increment, so no new frame
+        clock.tick(0)
+        self.assertEqual((frames[2], None), spriteFrames1.advanceFrame(0))
+        # new sprites pick up the current frame
+        self.assertEqual((frames[2], None), spriteframes.StaticFrames(frames, 3, clock).advanceFrame(0))
+
+class FramePoolTest(unittest.TestCase):
+
+    def testCopyFrame(self):
+        framePool = spriteframes.FramePool()
+        frame = view.createTransparentRect((4, 4))
+        frame.fill(view.RED, Rect(0, 0, 2, 2))
+        frameCopy = framePool.copyFrame(frame)
+        self.assertFalse(frameCopy is frame)
+        self.assertEqual(view.RED, tuple(frameCopy.get_at((0, 0)))[:3])
+        self.assertEqual(view.TRANSPARENT_COLOUR, tuple(frameCopy.get_at((3, 3)))[:3])
+        # a released copy is reused and blanked out
+        frameCopy.fill(view.BLUE)
+        framePool.releaseFrame(frameCopy)
+        self.assertTrue(framePool.copyFrame(frame) is frameCopy)
+        self.assertEqual(view.TRANSPARENT_COLOUR, tuple(frameCopy.get_at((3, 3)))[:3])
+
+class FontTest(unittest.TestCase):
+
+    def testSharedGlyphs(self):
+        font1, font2 = font.NumbersFont(), font.NumbersFont()
+        self.assertTrue(font1.chars["7"] is font2.chars["7"])
+        
+    def testTextCache(self):
+        textCache = font.TextCache(2)
+        self.assertEqual("a", textCache.get("a", lambda: "a"))
+        self.assertEqual("b", textCache.get("b", lambda: "b"))
+        # a hit doesn't render the text again
+        self.assertEqual("a", textCache.get("a", lambda: "x"))
+        # the least recently used text is evicted
+        self.assertEqual("c", textCache.get("c", lambda: "c"))
+        self.assertEqual("y", textCache.get("b", lambda: "y"))
+        self.assertEqual((1, 4), (textCache.hits, textCache.misses))
+        
+    def testDrawText(self):
+        gameFont = font.GameFont()
+        textImage = gameFont.getTextImage("CONTINUE... 9")
+        self.assertTrue(textImage is gameFont.getTextImage("CONTINUE... 9"))
+        self.assertEqual(13 * gameFont.charWidth, gameFont.getTextWidth("CONTINUE... 9"))
+        surface = view.createRectangle(textImage.get_size(), view.BLACK)
+        gameFont.drawText(surface, "CONTINUE... 9")
+        expected = view.createRectangle(textImage.get_size(), view.BLACK)
+        expected.blit(textImage, (0, 0))
+        self.assertEqual(pygame.image.tostring(expected, "RGB"), pygame.image.tostring(surface, "RGB"))
+
+class MockFixedSprite:
+    
+    def __init__(self, rect):
+        self.image = view.createRectangle(rect.size, view.RED)
+        self.rect = rect
+        
+    def getDrawState(self):
+        return (self.image,)
+
+class HeadsUpDisplayTest(unittest.TestCase):
+
+    def testUpdate(self):
+        sprite = MockFixedSprite(Rect(4, 4, 8, 8))
+        headsUpDisplay = fixedsprites.HeadsUpDisplay([sprite])
+        self.assertEqual([Rect(4, 4, 8, 8)], headsUpDisplay.update())
+        # nothing has changed
+        self.assertEqual([], headsUpDisplay.update())
+        # both the old and the new areas need redrawing
+        sprite.image = view.createRectangle((16, 8), view.BLUE)
+        sprite.rect = Rect(4, 4, 16, 8)
+        self.assertEqual([Rect(4, 4, 8, 8), Rect(4, 4, 16, 8)], headsUpDisplay.update())
+        surface = view.createRectangle((32, 32), view.BLACK)
+        headsUpDisplay.draw(surface, Rect(0, 0, 32, 32))
+        self.assertEqual(view.BLUE, tuple(surface.get_at((16, 8)))[:3])
+        self.assertEqual(view.BLACK, tuple(surface.get_at((24, 8)))[:3])
+
+class GameClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 0
+        self.sleeps = []
+
+    def getTime(self):
+        return self.time
+
+    def sleep(self, ms):
+        self.sleeps.append(ms)
+        self.time += ms
+
+    def testTick(self):
+        clock = gameclock.GameClock(50, 2, self.getTime, self.sleep)
+        self.assertEqual(1, clock.tick())
+        # on time, so the clock waits for the next tick
+        self.time += 5
+        self.assertEqual(1, clock.tick())
+        self.assertEqual([15], self.sleeps)
+        # running behind - the frames for 2 ticks are skipped
+        self.time += 60
+        self.assertEqual(3, clock.tick())
+        self.assertEqual((1, 2, 0), (clock.lateFrames, clock.skippedFrames, clock.droppedTicks))
+        # too far behind - the ticks that can't be caught up are dropped
+        self.time += 200
+        self.assertEqual(3, clock.tick())
+        self.assertEqual((2, 4), (clock.lateFrames, clock.skippedFrames))
+        self.assertEqual(7, clock.droppedTicks)
+        self.assertEqual(1, clock.tick())
+        self.assertEqual(20, self.sleeps[-1])
+
+class SimulationTest(unittest.TestCase):
+
+    def testHeadless(self):
+        game = simulation.Simulation(Registry("unit", (4, 6), 1))
+        left = game.getPlayer().mapRect.left
+        for i in range(10):
+            state = game.step([K_RIGHT])
+        self.assertEqual("PlayState", state.__class__.__name__)
+        self.assertEqual(left + 10 * sprites.MOVE_UNIT, game.getPlayer().mapRect.left)
+        self.assertEqual(10, game.ticks)
+        self.assertTrue(pygame.display.get_surface() is None)
+        game.stop()
+
+    def testStop(self):
+        states.stopPrefetcher()
+        threadCount = threading.active_count()
+        for i in range(3):
+            game = simulation.Simulation(Registry("unit", (4, 6), 1))
+            game.step([K_RIGHT])
+            game.stop()
+        self.assertEqual(threadCount, threading.active_count())
+
+    def testNoPrefetch(self):
+        game = simulation.Simulation(Registry("unit", (4, 6), 1), False)
+        self.assertTrue(states.mapPrefetcher is None)
+        state = game.step([K_RIGHT])
+        self.assertEqual("PlayState", state.__class__.__name__)
+        game.stop()
+
+class DrawViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.game = simulation.Simulation(Registry("central", (6, 22), 2), False)
+        viewSize = (view.VIEW_WIDTH, view.VIEW_HEIGHT)
+        self.surface = view.createRectangle(viewSize, view.BLACK)
+        self.expected = view.createRectangle(viewSize, view.BLACK)
+
+    def tearDown(self):
+        self.game.stop()
+
+    """
+    Redrawing just what has changed must give the same frame as drawing the
+    whole view afresh, whether the sprites move, animate or stand still, and
+    whether the view scrolls across, down, diagonally or not at all.
+    """
+    def testSameAsFullRedraw(self):
+        scrolls = set()
+        lastTopleft = None
+        for pressedKeys in benchmark.getRouteKeys("D:51 R:15 D:41 R:16 U:16 R:64 DR:16 UL:16 UR:16") + [[]] * 30:
+            state = self.game.step(pressedKeys)
+            self.assertEqual("PlayState", state.__class__.__name__)
+            state.drawView(self.surface)
+            rpgMap, viewRect = self.game.getPlayer().getMapView()
+            if lastTopleft:
+                scrolls.add((viewRect.left != lastTopleft[0], viewRect.top != lastTopleft[1]))
+            lastTopleft = viewRect.topleft
+            rpgMap.drawMapArea(self.expected, (0, 0), viewRect)
+            state.visibleSprites.draw(self.expected)
+            states.headsUpDisplay.draw(self.expected)
+            self.assertTrue(pygame.image.tostring(self.expected, "RGB") == pygame.image.tostring(self.surface, "RGB"),
+                            "differs on tick %d" % self.game.ticks)
+        self.assertEqual(set([(False, False), (True, False), (False, True), (True, True)]), scrolls)
+
+class ScrollTest(unittest.TestCase):
+
+    def setUp(self):
+        self.area = Rect(0, 0, view.VIEW_WIDTH, view.VIEW_HEIGHT)
+
+    def testExposedRects(self):
+        width, height = self.area.size
+        self.assertEqual([], states.getExposedRects(self.area, 0, 0))
+        self.assertEqual([Rect(width - 2, 0, 2, height)], states.getExposedRects(self.area, 2, 0))
+        self.assertEqual([Rect(0, 0, 2, height)], states.getExposedRects(self.area, -2, 0))
+        self.assertEqual([Rect(0, height - 4, width, 4)], states.getExposedRects(self.area, 0, 4))
+        self.assertEqual([Rect(0, 0, width, 4)], states.getExposedRects(self.area, 0, -4))
+
+    def testExposedRectsDiagonal(self):
+        for px, py in [(2, 4), (-2, 4), (2, -4), (-2, -4), (6, 6)]:
+            exposedRects = states.getExposedRects(self.area, px, py)
+            self.assertEqual(2, len(exposedRects))
+            self.assertExposed(exposedRects, px, py)
+            # so they aren't merged into the whole area
+            self.assertEqual(exposedRects, view.mergeRects(exposedRects))
+
+    def testExposedRectsFullScroll(self):
+        width, height = self.area.size
+        for px, py in [(width, 0), (-width - 10, 0), (0, height), (0, -height * 2)]:
+            self.assertEqual([self.area], states.getExposedRects(self.area, px, py))
+        for px, py in [(width, 4), (-2, -height), (width * 2, -height * 2)]:
+            self.assertExposed(states.getExposedRects(self.area, px, py), px, py)
+
+    """
+    Asserts that the given rects cover just the part of the area that the
+    scrolled view no longer covers, without overlapping.
+    """
+    def assertExposed(self, exposedRects, px, py):
+        keptRect = self.area.move(-px, -py).clip(self.area)
+        for i, rect in enumerate(exposedRects):
+            self.assertTrue(self.area.contains(rect))
+            self.assertFalse(rect.colliderect(keptRect))
+            self.assertEqual(-1, rect.collidelist(exposedRects[i + 1:]))
+        self.assertEqual(self.area.width * self.area.height - keptRect.width * keptRect.height,
+                         sum(rect.width * rect.height for rect in exposedRects))
+
+    def testMergeRects(self):
+        self.assertEqual([], view.mergeRects([]))
+        # apart and just touching rects are left alone
+        rects = [Rect(0, 0, 10, 10), Rect(20, 0, 10, 10), Rect(10, 0, 10, 10)]
+        self.assertEqual(rects, view.mergeRects(rects))
+        # overlapping rects are merged
+        self.assertEqual([Rect(0, 0, 15, 15)], view.mergeRects([Rect(0, 0, 10, 10), Rect(5, 5, 10, 10)]))
+        # a merged rect can then overlap one that was apart from both
+        merged = view.mergeRects([Rect(0, 0, 10, 10), Rect(12, 0, 10, 10), Rect(5, 5, 10, 10)])
+        self.assertEqual([Rect(0, 0, 22, 15)], merged)
+        # nothing is drawn twice
+        rects = [Rect(x * 7 % 50, x * 13 % 40, 12, 9) for x in range(20)]
+        merged = view.mergeRects(rects)
+        for i, rect in enumerate(merged):
+            self.assertEqual(-1, rect.collidelist(merged[i + 1:]))
+        for rect in rects:
+            self.assertTrue(rect.collidelist(merged) >= 0 and merged[rect.collidelist(merged)].contains(rect))
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.recordingPath = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.recordingPath)
+
+    def testInputBits(self):
+        keyPresses = simulation.getKeyPresses([K_UP, K_SPACE])
+        bits = replay.getInputBits(keyPresses)
+        self.assertEqual([K_UP, K_SPACE], replay.getPressedKeys(bits))
+        self.assertEqual(0, replay.getInputBits(simulation.getKeyPresses([])))
+
+    def testReplay(self):
+        game = simulation.Simulation(Registry("central", (6, 22), 2))
+        recorder = replay.Recorder()
+        for i in range(60):
+            pressedKeys = [K_UP] if i < 30 else [K_RIGHT, K_SPACE]
+            recorder.startTick(game.state, simulation.getKeyPresses(pressedKeys))
+            game.step(pressedKeys)
+            recorder.endTick(game.state)
+        recorder.recording.save(self.recordingPath)
+        recording = replay.loadRecording(self.recordingPath)
+        self.assertEqual(60, recording.getTicks())
+        self.assertEqual("central", recording.getRegistry().mapName)
+        myReplay = replay.Replay(recording)
+        myReplay.run()
+        self.assertEqual([], myReplay.mismatches)
+        self.assertEqual(game.getPlayer().mapRect, myReplay.game.getPlayer().mapRect)
+        myReplay.stop()
+        # different input - the replay no longer matches from the changed tick
+        recording.inputs[40] = 0
+        myReplay = replay.Replay(recording)
+        myReplay.run()
+        myReplay.stop()
+        self.assertEqual(40, myReplay.mismatches[0])
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testRouteKeys(self):
+        routeKeys = benchmark.getRouteKeys("U:2 RA:1")
+        self.assertEqual([[K_UP], [K_UP], [K_RIGHT, K_SPACE]], routeKeys)
+
+    def testPercentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, benchmark.getPercentile(values, 50))
+        self.assertEqual(99, benchmark.getPercentile(values, 99))
+        self.assertEqual(7, benchmark.getPercentile([7], 95))
+
+    def testPhaseTimer(self):
+        self.time = 0.0
+        timer = benchmark.PhaseTimer(lambda: self.time)
+        drawMapArea = map.RpgMap.__dict__["drawMapArea"]
+        timer.instrument(map.RpgMap, "drawMapArea", "mapBlit")
+        self.assertNotEqual(drawMapArea, map.RpgMap.__dict__["drawMapArea"])
+        timer.restore()
+        self.assertEqual(drawMapArea, map.RpgMap.__dict__["drawMapArea"])
+        self.time = 0.002
+        timer.endFrame(0.0)
+        results = timer.getResults()
+        self.assertEqual(2.0, results["frame"]["p50"])
+        self.assertEqual(0.0, results["mapBlit"]["max"])
+
+    def testRunRoute(self):
+        results = benchmark.runRoute(("unit", (4, 6), 1, "R:10 D:5"))
+        self.assertEqual(15, results["frames"])
+        self.assertEqual("unit", results["map"])
+        for phase in benchmark.PHASES:
+            self.assertTrue(results[phase]["max"] >= results[phase]["p50"])
+        self.assertTrue(results["frame"]["p50"] > 0)
+
+class MapBenchmarkTest(unittest.TestCase):
+
+    def testDenseMap(self):
+        denseMap = mapbenchmark.createDenseMap("dense", 8, 8)
+        otherMap = mapbenchmark.createDenseMap("dense", 8, 8)
+        self.assertEqual((8, 8), (denseMap.cols, denseMap.rows))
+        self.assertEqual(mapbenchmark.getMapLevels(denseMap), mapbenchmark.getMapLevels(otherMap))
+        for tiles in denseMap.mapTiles:
+            for tile in tiles:
+                self.assertTrue(tile.levels)
+                self.assertTrue(tile.masks)
+
+    def testRetainedContainers(self):
+        spanArgs = [(Rect(0, 0, 48, 48),)] * 100
+        self.assertAlmostEqual(1.0, mapbenchmark.getRetainedContainersPerCall(rpgMap.getSpanTiles, spanArgs), 1)
+        tileArgs = [(rpgMap.mapTiles[0][0], 1)] * 100
+        self.assertAlmostEqual(0.0, mapbenchmark.getRetainedContainersPerCall(map.MapTile.getSpecialLevel, tileArgs), 1)
+
+    def testRunPrimitives(self):
+        results = mapbenchmark.runPrimitives(rpgMap, 50, 1)
+        self.assertEqual(sorted(mapbenchmark.PRIMITIVES), sorted(results))
+        for primitive in mapbenchmark.PRIMITIVES:
+            self.assertTrue(results[primitive]["callsPerSec"] > 0)
+
+def eventInfo(event):
+    info = dict(vars(event))
+    info["transition"] = vars(event.transition)
+    return info
+
 if __name__ == "__main__":
     unittest.main()   
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from sprites import *
-from spriteframes import DirectionalFrames, DIRECTION
+from spriteframes import DirectionalFrames, DIRECTION, animationClock
 from view import UP, DOWN, LEFT, RIGHT, VIEW_WIDTH, VIEW_HEIGHT
 from events import WaspZoomingEvent, BeetleCrawlingEvent
 
@@ -32,16 +32,12 @@ WASP_COUNTDOWN = 12 // VELOCITY
 
 class Beetle(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (12 * SCALAR, 12 * SCALAR)
     
     def __init__(self):
-        if Beetle.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "beetle-frames.png")
-            Beetle.framesImage = view.loadScaledImage(imagePath)        
-        animationFrames = view.processMovementFrames(Beetle.framesImage, 2)
-        spriteFrames = DirectionalFrames(animationFrames, BEETLE_FRAME_SKIP)
+        imagePath = os.path.join(SPRITES_FOLDER, "beetle-frames.png")
+        animationFrames = assets.getMovementFrames(imagePath, 2)
+        spriteFrames = DirectionalFrames(animationFrames, BEETLE_FRAME_SKIP, animationClock)
         OtherSprite.__init__(self, spriteFrames)
         self.upright = False
 
@@ -59,6 +55,60 @@ class Beetle(OtherSprite):
         self.numPoints = len(tilePoints)
         self.currentPathPoint = self.pathPoints[0]
         self.pathPointIndex = 0
+        # updates needed to get from each path point to the next - see fastForward
+        self.pathTicks = [self.getPathTicks(self.pathPoints[i], self.pathPoints[(i + 1) % self.numPoints])
+                          for i in range(self.numPoints)]
+            
+    # override
+    def getProgress(self):
+        return OtherSprite.getProgress(self), self.pathPointIndex
+    
+    # override
+    def setProgress(self, progress):
+        spriteProgress, self.pathPointIndex = progress
+        self.currentPathPoint = self.pathPoints[self.pathPointIndex]
+        OtherSprite.setProgress(self, spriteProgress)
+        
+    """
+    Beetles patrol a fixed loop, so where a beetle is after any number of
+    updates can be worked out from where it is now.  Each update moves the
+    beetle horizontally and then vertically towards the next path point, or
+    just moves on to the next point if it's already there.
+    """
+    # override
+    def fastForward(self, ticks):
+        # work out how far along its current path the beetle is
+        currentPosition = self.mapRect.topleft
+        if currentPosition == self.currentPathPoint:
+            i, pathTick = self.pathPointIndex, 0
+        else:
+            i = (self.pathPointIndex - 1) % self.numPoints
+            pathTick = self.getPathTicks(self.pathPoints[i], currentPosition)
+        pathTick += ticks % sum(self.pathTicks)
+        while pathTick >= self.pathTicks[i]:
+            pathTick -= self.pathTicks[i]
+            i = (i + 1) % self.numPoints
+        # the beetle is on the path from point i to the next point
+        if pathTick == 0:
+            self.pathPointIndex = i
+            x, y = self.pathPoints[i]
+        else:
+            self.pathPointIndex = (i + 1) % self.numPoints
+            x, y = self.getPathPosition(self.pathPoints[i], self.pathPoints[self.pathPointIndex], pathTick)
+        self.currentPathPoint = self.pathPoints[self.pathPointIndex]
+        self.doMove(x - currentPosition[0], y - currentPosition[1])
+        
+    # it takes one update to move on from a path point, even to the same point
+    def getPathTicks(self, fromPoint, toPoint):
+        distance = abs(toPoint[0] - fromPoint[0]) + abs(toPoint[1] - fromPoint[1])
+        return max(1, distance // MOVE_UNIT)
+    
+    def getPathPosition(self, fromPoint, toPoint, pathTick):
+        x, y = fromPoint
+        xTicks = abs(toPoint[0] - x) // MOVE_UNIT
+        if pathTick <= xTicks:
+            return x + cmp(toPoint[0], x) * pathTick * MOVE_UNIT, y
+        return toPoint[0], y + cmp(toPoint[1], y) * (pathTick - xTicks) * MOVE_UNIT
             
     def getMovement(self, player):
         currentPosition = self.mapRect.topleft
@@ -86,16 +136,12 @@ class Beetle(OtherSprite):
         
 class Wasp(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (9 * SCALAR, 12 * SCALAR)    
 
     def __init__(self):
-        if Wasp.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "wasp-frames.png")
-            Wasp.framesImage = view.loadScaledImage(imagePath)        
-        animationFrames = view.processMovementFrames(Wasp.framesImage, 2)
-        spriteFrames = DirectionalFrames(animationFrames, WASP_FRAME_SKIP)
+        imagePath = os.path.join(SPRITES_FOLDER, "wasp-frames.png")
+        animationFrames = assets.getMovementFrames(imagePath, 2)
+        spriteFrames = DirectionalFrames(animationFrames, WASP_FRAME_SKIP, animationClock)
         OtherSprite.__init__(self, spriteFrames)
         
     def processCollision(self, player):
@@ -113,6 +159,19 @@ class Wasp(OtherSprite):
         self.zooming = False
         self.direction = None # this is also used to detect if the sprite has 'seen' the player
     
+    # override
+    def getProgress(self):
+        return OtherSprite.getProgress(self), self.direction, self.countdown, self.zooming
+    
+    # override
+    def setProgress(self, progress):
+        spriteProgress, self.direction, self.countdown, self.zooming = progress
+        OtherSprite.setProgress(self, spriteProgress)
+        
+    # once a wasp has seen the player it must keep counting down
+    def canSleep(self):
+        return OtherSprite.canSleep(self) and not self.direction
+    
     def getMovement(self, player):
         if self.zooming:
             # print "zooming"
@@ -3,8 +3,13 @@
 from __future__ import with_statement
 
 import os
+import threading
 import view
 import map
+import compiledmap
+import assets
+
+from assets import assetCache
 
 from pygame.locals import Rect
 
@@ -13,6 +18,8 @@ from view import UP, DOWN, LEFT, RIGHT
 
 TILES_FOLDER = "tiles"
 MAPS_FOLDER = "maps"
+MAP_EXTENSION = ".map"
+COMPILED_MAP_EXTENSION = ".mapc"
 OPEN_SQ_BRACKET = "["
 CLOSE_SQ_BRACKET = "]"
 SPECIAL_LEVEL = "S"
@@ -26,7 +33,12 @@ DASH = "-"
 
 BOUNDARIES = {"up": UP, "down": DOWN, "left": LEFT, "right": RIGHT}
 
-mapCache = {}
+# serialises map loading - maps are only created on the main thread, but the
+# map prefetcher reads them on its worker thread
+loadLock = threading.RLock()
+
+# the key of the map in play, which is pinned in the asset cache
+currentMapKey = None
 
 def getXY(xyStr, delimiter = COMMA):
     return [int(n) for n in xyStr.split(delimiter)]
@@ -37,16 +49,92 @@ def getTilePoints(xyList, delimiter = COMMA):
         tilePoints.append(getXY(xy, delimiter))
     return tilePoints
     
+"""
+Returns the named map, which becomes the map in play.  Maps come from the asset
+cache where possible and the map in play is pinned so that it is never evicted.
+"""
 def loadRpgMap(name):
-    # check cache first
-    if name in mapCache:
-        return mapCache[name].restore()
+    global currentMapKey
+    with loadLock:
+        mapKey = getMapKey(name)
+        if currentMapKey and currentMapKey != mapKey:
+            assetCache.unpin(currentMapKey)
+        currentMapKey = mapKey
+        return assetCache.get(mapKey, lambda: createRpgMap(name), True).restore()
+
+def getMapKey(name):
+    return assets.MAP, name
+
+def isMapCached(name):
+    return assetCache.contains(getMapKey(name))
+
+"""
+Reads the data for the named map, unless it's already cached.  This is called
+by the map prefetcher from its worker thread, so it must not touch any pygame
+surfaces - the map itself is created on the main thread by cacheRpgMap.
+"""
+def prefetchMapData(name):
+    if isMapCached(name):
+        return None
+    return readMapData(name)
+
+"""
+Creates the named map from the given data and adds it to the cache, unless it
+has been loaded since the data was read.  Returns the new map, or None.
+"""
+def cacheRpgMap(name, mapData):
+    with loadLock:
+        if isMapCached(name):
+            return None
+        return assetCache.get(getMapKey(name), lambda: createRpgMapFromData(name, mapData))
+
+def readMapData(name):
+    # use the compiled map if it's up to date, otherwise parse the text file
+    mapData = readCompiledMap(name)
+    if mapData is None:
+        mapData = parseMapFile(name)
+    return mapData
+
+def createRpgMap(name):
+    return createRpgMapFromData(name, readMapData(name))
+
+def createRpgMapFromData(name, mapData):
+    # create map tiles
+    mapTiles = createMapTiles(mapData.cols, mapData.rows, mapData.levels, mapData.images)
+    # create map and return
+    return map.RpgMap(name, mapTiles, mapData.mapSprites, mapData.mapEvents)
+
+def getMapPath(name):
+    return os.path.join(MAPS_FOLDER, name + MAP_EXTENSION)
+
+def getCompiledMapPath(name):
+    return os.path.join(MAPS_FOLDER, name + COMPILED_MAP_EXTENSION)
+
+"""
+Returns the modification time and size of the given map's text file, or None
+if there is no text file - in which case any compiled map is used as is.
+"""
+def getSourceStamp(name):
+    try:
+        stat = os.stat(getMapPath(name))
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+def readCompiledMap(name):
+    compiledMapPath = getCompiledMapPath(name)
+    mapData = compiledmap.readCompiledMap(compiledMapPath, getSourceStamp(name))
+    if mapData:
+        print "loading: %s" % compiledMapPath
+    return mapData
+
+def parseMapFile(name):
     # tileData is keyed on an x,y tuple
     tileData = {}
     spriteData = []
     eventData = []
     # parse map file - each line represents one map tile        
-    mapPath = os.path.join(MAPS_FOLDER, name + ".map")
+    mapPath = getMapPath(name)
     print "loading: %s" % mapPath
     with open(mapPath) as mapFile:
         # eg. 10,4 [1] water:dark grass:l2 wood:lrs_supp:3
@@ -72,65 +160,87 @@ def loadRpgMap(name):
                                 tileData[(x, y)] = bits[1:]
             except ValueError:
                 pass
-    # create map tiles
-    mapTiles = createMapTiles(maxX + 1, maxY + 1, tileData)
+    levels, images = parseTileData(tileData)
     mapSprites = createMapSprites(spriteData, name)
-    playevents = createMapEvents(eventData)
-    # create map and return
-    myMap = map.RpgMap(name, mapTiles, mapSprites, playevents)
-    mapCache[name] = myMap
-    return myMap
+    mapEvents = createMapEvents(eventData)
+    return compiledmap.MapData(maxX + 1, maxY + 1, levels, images, mapSprites, mapEvents)
 
-def createMapTiles(cols, rows, tileData):
-    # create the map tiles
-    mapTiles = [[map.MapTile(x, y) for y in range(rows)] for x in range(cols)]
-    # iterate through the tile data and set the map tiles
-    tileSets = {}     
+"""
+Converts the tile data into the level and image records used to create the map
+tiles - see compiledmap.MapData.
+"""
+def parseTileData(tileData):
+    levels = []
+    images = []
     for tilePoint in tileData.keys():
         bits = tileData[tilePoint]
         x, y = tilePoint[0], tilePoint[1]
-        mapTile = mapTiles[x][y]
         # print bits
         startIndex = 0
         if bits[0][0] == OPEN_SQ_BRACKET and bits[0][-1] == CLOSE_SQ_BRACKET:
             # levels
             startIndex = 1
-            levels = bits[0][1:-1].split(COMMA)
-            for level in levels:
+            for level in bits[0][1:-1].split(COMMA):
                 if level[0] == SPECIAL_LEVEL:
-                    mapTile.addSpecialLevel(float(level[1:]))
+                    levels.append((x, y, compiledmap.SPECIAL_LEVEL, float(level[1:]), 0))
                 elif level[0] == DOWN_LEVEL:
                     levelBits = level[1:].split(DASH)
-                    mapTile.addDownLevel(int(levelBits[0]), int(levelBits[1]))
+                    levels.append((x, y, compiledmap.DOWN_LEVEL, int(levelBits[0]), int(levelBits[1])))
                 else:
-                    mapTile.addLevel(int(level))
+                    levels.append((x, y, compiledmap.LEVEL, int(level), 0))
         # tiles images
         for tileIndex, tiles in enumerate(bits[startIndex:]):
             tileBits = tiles.split(COLON)
             if len(tileBits) > 1:
-                tileSetName = tileBits[0]
-                if tileSetName in tileSets:
-                    tileSet = tileSets[tileSetName]
-                else:
-                    tileSet = loadTileSet(tileSetName)
-                    tileSets[tileSetName] = tileSet
-                tileName = tileBits[1]
-                mapTile.addTile(tileSet.getTile(tileName))
+                maskKind, maskLevel = compiledmap.NO_MASK, 0
                 # masks
                 if len(tileBits) > 2:
                     maskLevel = tileBits[2]
-                    # mapTile.addMaskTile(maskLevel, tileSet.getTile(tileName))
                     if maskLevel[0] == VERTICAL_MASK:
-                        mapTile.addMask(tileIndex, int(maskLevel[1:]), False)
+                        maskKind, maskLevel = compiledmap.VERTICAL_MASK, int(maskLevel[1:])
                     else:    
-                        mapTile.addMask(tileIndex, int(maskLevel))
+                        maskKind, maskLevel = compiledmap.FLAT_MASK, int(maskLevel)
+                images.append((x, y, tileIndex, tileBits[0], tileBits[1], maskKind, maskLevel))
+    return levels, images
+
+def createMapTiles(cols, rows, levels, images):
+    # create the map tiles
+    mapTiles = [[map.MapTile(x, y) for y in range(rows)] for x in range(cols)]
+    # iterate through the level records and set the map tile levels
+    for x, y, kind, level, downLevel in levels:
+        mapTile = mapTiles[x][y]
+        if kind == compiledmap.SPECIAL_LEVEL:
+            mapTile.addSpecialLevel(level)
+        elif kind == compiledmap.DOWN_LEVEL:
+            mapTile.addDownLevel(int(level), downLevel)
+        else:
+            mapTile.addLevel(int(level))
+    # iterate through the image records and set the map tile images
+    mapTileSets = {}
+    for x, y, tileIndex, tileSetName, tileName, maskKind, maskLevel in images:
+        mapTile = mapTiles[x][y]
+        if tileSetName not in mapTileSets:
+            mapTileSets[tileSetName] = getTileSet(tileSetName)
+        mapTile.addTile(mapTileSets[tileSetName].getTile(tileName))
+        # masks
+        if maskKind == compiledmap.VERTICAL_MASK:
+            mapTile.addMask(tileIndex, maskLevel, False)
+        elif maskKind == compiledmap.FLAT_MASK:
+            mapTile.addMask(tileIndex, maskLevel)
     return mapTiles
 
+"""
+Tile sets are shared by every map, so each tile set image is only loaded once.
+They are pinned in the asset cache because evicting one would not free its
+pixels while any map still uses its tiles.
+"""
+def getTileSet(name):
+    return assetCache.get((assets.TILE_SET, name), lambda: loadTileSet(name), True)
+
 def loadTileSet(name):
     # print "load tileset: %s" % (name)
-    # tileSet = map.TileSet()
-    tiles = {}
-    # load tile set image
+    tileRects = {}
+    # load tile set image - this is kept whole and used as an atlas
     imagePath = os.path.join(TILES_FOLDER, name + ".png")
     tilesImage = view.loadScaledImage(imagePath, view.TRANSPARENT_COLOUR)
     # parse metadata - each line represents one tile in the tile set
@@ -145,14 +255,11 @@ def loadTileSet(name):
                     # print "%s -> %s" % (tileRef, tileName)
                     x, y = tilePoint.split(COMMA)
                     px, py = int(x) * view.TILE_SIZE, int(y) * view.TILE_SIZE
-                    tileRect = Rect(px, py, view.TILE_SIZE, view.TILE_SIZE)
-                    tileImage = tilesImage.subsurface(tileRect).copy()
-                    tiles[tileName] = tileImage
-                    # self.maskTiles[tileName] = view.createMaskTile(tileImage)
+                    tileRects[tileName] = Rect(px, py, view.TILE_SIZE, view.TILE_SIZE)
             except ValueError:
                 pass
     # create tile set and return
-    return map.TileSet(tiles)
+    return map.TileSet(tilesImage, tileRects)
 
 def createMapSprites(spriteData, mapName):
     mapSprites = []
@@ -246,3 +353,20 @@ def createTileEvent(eventBits, transition):
     x, y = getXY(eventBits[1])
     level = int(eventBits[2])
     return TileEvent(transition, x, y, level)
+
+"""
+Compiles every map in the maps folder, so that loadRpgMap can skip parsing the
+text files.  Returns the names of the compiled maps.
+"""
+def compileMaps():
+    names = sorted(os.path.splitext(filename)[0] for filename in os.listdir(MAPS_FOLDER)
+                   if filename.endswith(MAP_EXTENSION))
+    for name in names:
+        compileMap(name)
+    return names
+
+def compileMap(name):
+    mapData = parseMapFile(name)
+    compiledMapPath = getCompiledMapPath(name)
+    compiledmap.writeCompiledMap(compiledMapPath, mapData, getSourceStamp(name))
+    print "compiled: %s" % compiledMapPath
@@ -8,7 +8,7 @@ from sprites import *
 from events import PlayerFootstepEvent, PlayerFallingEvent, LifeLostEvent
 from spriteframes import DirectionalFrames, StaticFrames
 from staticsprites import Shadow
-from view import NONE, UP, DOWN, LEFT, RIGHT
+from view import NONE, UP, DOWN, LEFT, RIGHT, VIEW_WIDTH, VIEW_HEIGHT
 
 
 PLAYER_FOOTSTEP_EVENT = PlayerFootstepEvent()
@@ -53,7 +53,7 @@ class Player(RpgSprite):
         self.fallingFrames = fallingFrames
         self.movingFrames = movingFrames
         # view rect is the scrolling window onto the map
-        self.viewRect = Rect((0, 0), pygame.display.get_surface().get_size())
+        self.viewRect = Rect(0, 0, VIEW_WIDTH, VIEW_HEIGHT)
         # movement
         self.movement = None
         self.deferredMovement = None
@@ -111,14 +111,14 @@ class Player(RpgSprite):
         if event:
             return event
         # have we collided with any sprites?
-        event = self.processCollisions(visibleSprites.sprites())
+        event = self.processCollisions(gameSprites.getSprites(self.baseRect, self.level))
         if event:
             return event
         # go ahead and handle user input
         directionBits, action = self.processKeyPresses(keyPresses)
         self.handleMovement(directionBits)
         if action:
-            self.processActions(visibleSprites.sprites())
+            self.processActions(gameSprites.getSprites(self.baseRect, self.level))
         return None
     
     """
@@ -166,8 +166,9 @@ class Player(RpgSprite):
         self.movement = movement
         px, py, direction, diagonal = movement
         # is the requested movement valid?
-        newBaseRect = self.baseRect.move(px, py)
-        valid, level = self.rpgMap.isMoveValid(self.level, newBaseRect)
+        baseRect = self.baseRect
+        valid, level = self.rpgMap.checkMove(self.level, baseRect.left + px, baseRect.top + py,
+                                             baseRect.width, baseRect.height)
         if valid:
             # if movement diagonal we only move 2 out of 3 ticks
             if diagonal and self.ticks == 0:
@@ -191,15 +192,15 @@ class Player(RpgSprite):
     """
     def slide(self, movement):
         px, py, direction, diagonal = movement
+        baseRect = self.baseRect
+        left, top, width, height = baseRect.left, baseRect.top, baseRect.width, baseRect.height
         # check if we can slide horizontally
-        xBaseRect = self.baseRect.move(px, 0)
-        valid, level = self.rpgMap.isMoveValid(self.level, xBaseRect)
+        valid, level = self.rpgMap.checkMove(self.level, left + px, top, width, height)
         if valid:
             self.deferMovement(level, direction, px, 0)
             return valid
         # check if we can slide vertically
-        yBaseRect = self.baseRect.move(0, py)
-        valid, level = self.rpgMap.isMoveValid(self.level, yBaseRect)                
+        valid, level = self.rpgMap.checkMove(self.level, left, top + py, width, height)
         if valid:
             self.deferMovement(level, direction, 0, py)
         return valid
@@ -212,14 +213,15 @@ class Player(RpgSprite):
     """
     def shuffle(self, movement):
         px, py, direction, diagonal = movement
+        baseRect = self.baseRect
+        valid, level, shuffle = self.rpgMap.checkShuffle(self.level, baseRect.left, baseRect.top,
+                                                         baseRect.width, baseRect.height, px, py)
         # check if we can shuffle horizontally
         if px == 0:
-            valid, level, shuffle = self.rpgMap.isVerticalValid(self.level, self.baseRect)
             if valid:
                 self.deferMovement(level, direction, px + shuffle * MOVE_UNIT, 0)
             return valid
         # check if we can shuffle vertically
-        valid, level, shuffle = self.rpgMap.isHorizontalValid(self.level, self.baseRect)
         if valid:
             self.deferMovement(level, direction, 0, py + shuffle * MOVE_UNIT)
         return valid
@@ -363,32 +365,28 @@ class Player(RpgSprite):
     
     """
     Processes collisions with other sprites in the given sprite collection.
+    Only sprites that are in view can collide with the player.
     """
     def processCollisions(self, sprites):
-        # if there are less than two sprites then self is the only sprite
-        if len(sprites) < 2:
-            return False
         for sprite in sprites:
-            if sprite.isIntersecting(self) and sprite.processCollision(self):
+            if sprite.inView and sprite.isIntersecting(self) and sprite.processCollision(self):
                 return playevents.LifeLostEvent(self.gameOver())
         return False
 
     """
     Processes interactions with other sprites in the given sprite collection.
+    Only sprites that are in view can interact with the player.
     """
     def processActions(self, sprites):
-        # if there are less than two sprites then self is the only sprite
-        if len(sprites) < 2:
-            return
         for sprite in sprites:
-            if sprite.isIntersecting(self):
+            if sprite.inView and sprite.isIntersecting(self):
                 sprite.processAction(self)
     
     """
-    Convenience method that returns the map image and the player's view of it.
+    Convenience method that returns the map and the player's view of it.
     """            
     def getMapView(self):
-        return self.rpgMap.mapImage, self.viewRect
+        return self.rpgMap, self.viewRect
                         
     def getCoinCount(self):
         return self.coinCount.count;
@@ -426,19 +424,12 @@ Extends the player sprite by defining a set of frame images.
 """    
 class Ulmo(Player):
     
-    movingFramesImage = None
-    fallingFramesImage = None
-    
     def __init__(self):
-        if Ulmo.movingFramesImage is None:          
-            imagePath = os.path.join(SPRITES_FOLDER, "ulmo-frames.png")
-            Ulmo.movingFramesImage = view.loadScaledImage(imagePath)
-        if Ulmo.fallingFramesImage is None:          
-            imagePath = os.path.join(SPRITES_FOLDER, "ulmo-falling.png")
-            Ulmo.fallingFramesImage = view.loadScaledImage(imagePath)
-        animationFrames = view.processMovementFrames(Ulmo.movingFramesImage)
+        imagePath = os.path.join(SPRITES_FOLDER, "ulmo-frames.png")
+        animationFrames = assets.getMovementFrames(imagePath)
         movingFrames = DirectionalFrames(animationFrames, ULMO_FRAME_SKIP)
-        animationFrames = view.processStaticFrames(Ulmo.fallingFramesImage)
+        imagePath = os.path.join(SPRITES_FOLDER, "ulmo-falling.png")
+        animationFrames = assets.getStaticFrames(imagePath)
         fallingFrames = StaticFrames(animationFrames)
         Player.__init__(self, movingFrames, fallingFrames, (1, -12))
         
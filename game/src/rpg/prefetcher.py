@@ -0,0 +1,164 @@
+#! /usr/bin/env python
+
+import threading
+import Queue
+import parser
+import playevents
+
+from pygame.locals import Rect
+
+from view import TILE_SIZE, VIEW_WIDTH, VIEW_HEIGHT, UP, DOWN, LEFT, RIGHT
+
+# maps are prefetched once the player comes within this distance of an exit
+PREFETCH_DISTANCE = TILE_SIZE * 5
+
+# the number of chunks of a prefetched map that are rendered on each tick
+PREFETCH_CHUNKS_PER_TICK = 1
+
+"""
+Loads the maps that the player could reach soon.  Exits are found from the
+boundary events and tile events of the current map, and when the player comes
+near one the data for the map on the other side is read on a worker thread.
+The map itself is then created and the chunks around its entry point rendered
+on the main thread, a little on each tick, as pygame surfaces can't safely be
+drawn on by two threads at once.  By the time the player hits the exit,
+parser.loadRpgMap simply picks the map up from the cache.
+"""
+class MapPrefetcher:
+
+    def __init__(self):
+        self.requests = Queue.Queue()
+        # maps read by the worker that are waiting to be created
+        self.loaded = Queue.Queue()
+        # the prefetched map whose entry area is being rendered, if any
+        self.rendering = None
+        # names of the maps that have been queued but not created yet
+        self.pending = set()
+        self.worker = threading.Thread(target = self.run, name = "MapPrefetcher")
+        self.worker.daemon = True
+        self.worker.start()
+
+    """
+    Queues any uncached maps that can be reached from exits near the given
+    player rect, and carries on with any maps that have been read.  This is
+    cheap enough to be called on every tick.
+    """
+    def prefetchNear(self, rpgMap, playerRect):
+        for events in rpgMap.boundaryEvents.values():
+            for event in events:
+                self.prefetchEvent(rpgMap, event, playerRect)
+        for event in rpgMap.tileEvents:
+            self.prefetchEvent(rpgMap, event, playerRect)
+        self.finishLoading()
+
+    def prefetchEvent(self, rpgMap, event, playerRect):
+        mapName = event.transition.mapName
+        if mapName is None or mapName == rpgMap.name:
+            return
+        if parser.isMapCached(mapName) or mapName in self.pending:
+            return
+        if getDistance(playerRect, getExitRect(rpgMap, event)) > PREFETCH_DISTANCE:
+            return
+        self.pending.add(mapName)
+        self.requests.put((mapName, event.transition, Rect(playerRect)))
+
+    """
+    Either creates the next map that the worker has read, or renders some more
+    of the entry area of the last one.
+    """
+    def finishLoading(self):
+        if self.rendering:
+            nextMap, entryArea = self.rendering
+            if not parser.isMapCached(nextMap.name) or \
+                    nextMap.renderMapArea(entryArea, PREFETCH_CHUNKS_PER_TICK):
+                self.rendering = None
+            return
+        try:
+            mapName, mapData, transition, playerRect = self.loaded.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            nextMap = parser.cacheRpgMap(mapName, mapData)
+            if nextMap:
+                self.rendering = (nextMap, getEntryArea(nextMap, transition, playerRect))
+        except Exception, e:
+            print "prefetch failed: %s (%s)" % (mapName, e)
+        finally:
+            self.pending.discard(mapName)
+
+    """
+    Stops the worker thread once it has finished any queued requests.
+    """
+    def stop(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                self.requests.task_done()
+                return
+            mapName, transition, playerRect = request
+            mapData = None
+            try:
+                mapData = parser.prefetchMapData(mapName)
+            except Exception, e:
+                # the transition itself will report the problem
+                print "prefetch failed: %s (%s)" % (mapName, e)
+            finally:
+                if mapData:
+                    self.loaded.put((mapName, mapData, transition, playerRect))
+                else:
+                    # the map can be requested again if it failed
+                    self.pending.discard(mapName)
+                self.requests.task_done()
+
+"""
+Returns the area of the current map that the given event is triggered from.
+"""
+def getExitRect(rpgMap, event):
+    if event.type == playevents.TILE_EVENT:
+        return Rect(event.x * TILE_SIZE, event.y * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+    # event.type == playevents.BOUNDARY_EVENT
+    first, size = event.range[0] * TILE_SIZE, len(event.range) * TILE_SIZE
+    mapRect = rpgMap.mapRect
+    if event.boundary == UP:
+        return Rect(first, mapRect.top, size, 0)
+    if event.boundary == DOWN:
+        return Rect(first, mapRect.bottom, size, 0)
+    if event.boundary == LEFT:
+        return Rect(mapRect.left, first, 0, size)
+    # event.boundary == RIGHT
+    return Rect(mapRect.right, first, 0, size)
+
+"""
+Returns the gap between two rectangles along whichever axis it is widest.
+"""
+def getDistance(rect, otherRect):
+    dx = max(otherRect.left - rect.right, rect.left - otherRect.right, 0)
+    dy = max(otherRect.top - rect.bottom, rect.top - otherRect.bottom, 0)
+    return max(dx, dy)
+
+"""
+Returns the view the player is likely to see on arriving in the next map.  This
+mirrors the way the transition states position the player - see hidePlayer.
+"""
+def getEntryArea(nextMap, transition, playerRect):
+    mapRect = nextMap.mapRect
+    if transition.type == playevents.SCENE_TRANSITION:
+        x, y = transition.tilePosition
+        px, py = x * TILE_SIZE, y * TILE_SIZE
+    else: # transition.type == playevents.BOUNDARY_TRANSITION
+        px, py = [i + transition.modifier * TILE_SIZE for i in playerRect.topleft]
+        if transition.boundary == UP:
+            py = mapRect.bottom
+        elif transition.boundary == DOWN:
+            py = mapRect.top
+        elif transition.boundary == LEFT:
+            px = mapRect.right
+        else: # transition.boundary == RIGHT
+            px = mapRect.left
+    entryArea = Rect(0, 0, VIEW_WIDTH, VIEW_HEIGHT)
+    entryArea.center = (px, py)
+    return entryArea.clamp(mapRect)
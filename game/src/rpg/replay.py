@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+
+import time
+import zlib
+import cPickle
+import pygame
+import states
+
+from simulation import Simulation, KEYS
+from gameclock import GameClock
+
+"""
+Returns the keys pressed as a number, with a bit for each key in simulation.KEYS
+- ie. the 4 directions plus the action key.
+"""
+def getInputBits(keyPresses):
+    bits = 0
+    for i, key in enumerate(KEYS):
+        if keyPresses[key]:
+            bits |= 1 << i
+    return bits
+
+"""
+Returns the keys that are pressed for the given input bits.
+"""
+def getPressedKeys(bits):
+    return [key for i, key in enumerate(KEYS) if bits & (1 << i)]
+
+"""
+Returns the sprites of the play state that the given state is in or is heading
+to, if any.
+"""
+def getGameSprites(state):
+    if not hasattr(state, "gameSprites"):
+        state = getattr(state, "playState", None)
+    if state:
+        return state.gameSprites
+    return None
+
+"""
+Returns a checksum of the state of the game world - the current state, the
+player and the game sprites.  Two runs that end up in the same place have the
+same checksum, so a replay can be checked against the run that was recorded.
+The sprites are sorted as the order of a sprite group can differ between runs.
+"""
+def getChecksum(state):
+    player = states.player
+    worldState = [state.__class__.__name__,
+                  player.rpgMap.name,
+                  tuple(player.mapRect),
+                  player.level,
+                  player.spriteFrames.direction,
+                  player.getCoinCount(),
+                  player.getKeyCount(),
+                  player.lives.count]
+    gameSprites = getGameSprites(state)
+    if gameSprites:
+        worldState.append(sorted((sprite.uid, tuple(sprite.mapRect), sprite.level)
+                                 for sprite in gameSprites))
+    return zlib.crc32(repr(worldState)) & 0xffffffff
+
+"""
+The input for each tick of a game, plus the registry it started from and the
+checksum of the game world after each tick.  The registry is kept pickled, so
+it can't be changed by the game and a fresh copy is returned each time.  A game
+that was started from the title screen begins with the start state, which
+updates the sprites once as it brings the play state into view.
+"""
+class Recording:
+
+    def __init__(self, registry, fromTitle = False):
+        self.registryData = cPickle.dumps(registry, cPickle.HIGHEST_PROTOCOL)
+        self.fromTitle = fromTitle
+        self.inputs = []
+        self.checksums = []
+
+    def getRegistry(self):
+        return cPickle.loads(self.registryData)
+
+    def addTick(self, inputBits, checksum):
+        self.inputs.append(inputBits)
+        self.checksums.append(checksum)
+
+    def getTicks(self):
+        return len(self.inputs)
+
+    def save(self, filePath):
+        with open(filePath, "wb") as recordingFile:
+            cPickle.dump(self, recordingFile, cPickle.HIGHEST_PROTOCOL)
+
+def loadRecording(filePath):
+    with open(filePath, "rb") as recordingFile:
+        return cPickle.load(recordingFile)
+
+"""
+Records the game as it's played.  Recording starts on the first tick of the
+start state or the first play state, from the registry the game was started
+with, as that is where a replay starts - see Replay.  Any ticks before then are
+ignored.
+"""
+class Recorder:
+
+    def __init__(self):
+        self.recording = None
+        self.inputBits = None
+
+    """
+    Must be called before each tick with the current state and the key presses
+    for the tick.
+    """
+    def startTick(self, state, keyPresses):
+        if not self.recording:
+            if not isinstance(state, (states.StartState, states.PlayState)):
+                return
+            self.recording = Recording(states.registryHandler.snapshot,
+                                       isinstance(state, states.StartState))
+        self.inputBits = getInputBits(keyPresses)
+
+    """
+    Must be called after each tick with the state the game is now in.
+    """
+    def endTick(self, state):
+        if self.inputBits is not None:
+            self.recording.addTick(self.inputBits, getChecksum(state))
+            self.inputBits = None
+
+"""
+Plays a recording back through the game, either at the normal rate or as fast
+as it can go, and checks the state of the game world after every tick against
+the recording.  Frames are drawn unless the game is headless - see
+states.initDisplay.
+"""
+class Replay:
+
+    def __init__(self, recording):
+        self.recording = recording
+        self.game = Simulation(recording.getRegistry())
+        if recording.fromTitle:
+            self.game.state = states.StartState(self.game.state)
+        # ticks where the game world differs from the recording
+        self.mismatches = []
+        self.ticks = 0
+
+    def step(self):
+        state = self.game.step(getPressedKeys(self.recording.inputs[self.ticks]))
+        if getChecksum(state) != self.recording.checksums[self.ticks]:
+            self.mismatches.append(self.ticks)
+        self.ticks += 1
+        return state
+
+    def isFinished(self):
+        return self.ticks >= self.recording.getTicks()
+
+    """
+    Plays the rest of the recording and returns the time taken in seconds.
+    """
+    def run(self, realTime = False):
+        clock = GameClock(states.FRAMES_PER_SEC) if realTime else None
+        startTime = time.time()
+        while not self.isFinished():
+            ticks = clock.tick() if clock else 1
+            for i in range(ticks):
+                if self.isFinished():
+                    break
+                state = self.step()
+            if not states.headless:
+                pygame.event.pump()
+                if hasattr(state, "drawFrame"):
+                    state.drawFrame()
+        return time.time() - startTime
+
+    def stop(self):
+        self.game.stop()
+
+    def getStats(self, seconds):
+        ticksPerSec = self.ticks / seconds if seconds else 0
+        return "ticks: %d, seconds: %.2f, ticks per sec: %.0f, mismatches: %d" \
+            % (self.ticks, seconds, ticksPerSec, len(self.mismatches))
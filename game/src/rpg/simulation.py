@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+
+import states
+
+from pygame.locals import K_UP, K_DOWN, K_LEFT, K_RIGHT, K_SPACE
+
+KEYS = [K_UP, K_DOWN, K_LEFT, K_RIGHT, K_SPACE]
+
+"""
+Runs the game without a display, one tick at a time, as fast as it can go - eg.
+for tests, bots and benchmarks.  The play state only draws when asked to, so
+nothing is drawn unless a transition draws onto the off-screen surface - see
+states.initDisplay.  Sounds are turned off, and so is the map prefetcher if
+prefetch is False.
+"""
+class Simulation:
+
+    def __init__(self, registry, prefetch = True):
+        if states.screen is None:
+            states.initDisplay(True)
+        states.initGame(prefetch)
+        states.soundHandler.soundOn = False
+        self.state = states.startGame(registry = registry)
+        self.ticks = 0
+
+    """
+    Runs one tick of the game for the given keys, which are the only keys that
+    are pressed, and returns the current state.
+    """
+    def step(self, pressedKeys = []):
+        keyPresses = getKeyPresses(pressedKeys)
+        newState = self.state.execute(keyPresses)
+        states.soundHandler.flush()
+        if newState:
+            self.state = newState
+        self.ticks += 1
+        return self.state
+
+    """
+    Stops the worker thread the game uses to prefetch maps.
+    """
+    def stop(self):
+        states.stopPrefetcher()
+
+    def getPlayer(self):
+        return states.player
+
+    def getRegistry(self):
+        return states.registryHandler.registry
+
+"""
+Returns key presses in the same form as the game reads them from the keyboard.
+"""
+def getKeyPresses(pressedKeys):
+    keyPresses = {}
+    for key in KEYS:
+        keyPresses[key] = key in pressedKeys
+    return keyPresses
@@ -1,7 +1,9 @@
 #! /usr/bin/env python
 
-import pygame
+import sprites
 
+from sprites import ACTIVITY_MARGIN, getPathRect
+from view import TILE_SIZE
 from othersprites import Beetle, Wasp
 from staticsprites import Flames, Coin, Key, Chest, Rock, Door, Checkpoint
 
@@ -16,36 +18,145 @@ spriteClasses = {"flames": Flames,
                  "wasp": Wasp,
                  "checkpoint" : Checkpoint}
 
+# sprites are created when the area they can be in comes this close to the
+# view - this must be far enough out that they exist before they are needed
+SPAWN_MARGIN = ACTIVITY_MARGIN + TILE_SIZE * 4
+# sprites are released again once they're dormant and this far from the view
+RELEASE_MARGIN = SPAWN_MARGIN + TILE_SIZE * 4
+# the number of updates between looking for sprites to release
+RELEASE_INTERVAL = 60
+
+SPAWN_CELL_SIZE = TILE_SIZE * 4
+
 """
-Returns a sprite instance based on the given mapSprite.  If the registry
-indicates that the sprite has been removed from the map, this method returns
-None.
+Checks the registry to see if the sprite has been removed from the map.  This
+also applies any interactions the sprite has had with the map, eg. an open door.
 """
-def createSprite(mapSprite, rpgMap, eventBus, registry):
+def isRemovedFromMap(mapSprite, rpgMap, registry):
     spriteMetadata = registry.getMetadata(mapSprite.uid);
     if spriteMetadata:
         # allow any interactions with the map, eg. an open door
         spriteMetadata.applyMapActions(rpgMap)
         if spriteMetadata.isRemovedFromMap():
-            return None
+            return True
+    return False
+
+def getSpriteClass(mapSprite):
     if mapSprite.type in spriteClasses:
-        spriteClass = spriteClasses[mapSprite.type]
-        sprite = spriteClass()
-        sprite.setup(mapSprite.uid, rpgMap, eventBus)
-        return sprite
+        return spriteClasses[mapSprite.type]
     print "sprite type not found:", mapSprite.type 
     return None
+        
+def newSprite(spriteClass, mapSprite, rpgMap, eventBus):
+    sprite = spriteClass()
+    sprite.setup(mapSprite.uid, rpgMap, eventBus)
+    return sprite
 
 """
 Returns a sprite group for the given map.  This excludes any sprites that are
-removed from the map.
+removed from the map.  Apart from static sprites, the sprites themselves are
+only created as the view comes near them - see SpriteSpawner.
 """
 def createSpritesForMap(rpgMap, eventBus, registry):
-    gameSprites = pygame.sprite.Group()
+    gameSprites = sprites.IndexedSprites()
+    gameSprites.spawner = SpriteSpawner(rpgMap, eventBus)
     if rpgMap.mapSprites:
         for mapSprite in rpgMap.mapSprites:
-            sprite = createSprite(mapSprite, rpgMap, eventBus, registry)
-            if sprite:
+            # the registry is checked up front, since it also affects the map
+            if isRemovedFromMap(mapSprite, rpgMap, registry):
+                continue
+            spriteClass = getSpriteClass(mapSprite)
+            if spriteClass and spriteClass.static:
+                # static sprites are drawn into the map, which must happen up front
+                sprite = newSprite(spriteClass, mapSprite, rpgMap, eventBus)
                 sprite.initMovement(mapSprite.level, mapSprite.tilePoints)
+                sprite.bake()
                 gameSprites.add(sprite)
+            elif spriteClass:
+                gameSprites.spawner.addSpawnPoint(SpawnPoint(mapSprite, spriteClass))
     return gameSprites
+
+"""
+Where a sprite from the map can appear, along with its progress if it has been
+created and then released.
+"""
+class SpawnPoint:
+    
+    def __init__(self, mapSprite, spriteClass):
+        self.mapSprite = mapSprite
+        self.spriteClass = spriteClass
+        self.spawnRect = getPathRect(mapSprite.tilePoints)
+        # the sprite, if it currently exists
+        self.sprite = None
+        # where the sprite had got to when it was released, and when
+        self.progress = None
+        self.lastTick = 0
+
+"""
+Creates the sprites for a map as the view comes near them and releases them
+again once they are dormant and far away, so that only the sprites around the
+view take up any memory.  A released sprite keeps its progress, eg. where a
+beetle is on its path, and carries on from there when it's created again.
+Sprites that are created late - or again - are fast forwarded by the updates
+they missed, exactly like dormant sprites (see sprites.IndexedSprites).
+"""
+class SpriteSpawner:
+    
+    def __init__(self, rpgMap, eventBus):
+        self.rpgMap = rpgMap
+        self.eventBus = eventBus
+        # lists of spawn points keyed on cell
+        self.cells = {}
+        self.spawnPoints = []
+        
+    def addSpawnPoint(self, spawnPoint):
+        self.spawnPoints.append(spawnPoint)
+        for cell in getCells(spawnPoint.spawnRect):
+            self.cells.setdefault(cell, []).append(spawnPoint)
+            
+    def update(self, gameSprites, viewRect):
+        self.spawnSprites(gameSprites, viewRect.inflate(SPAWN_MARGIN * 2, SPAWN_MARGIN * 2))
+        if gameSprites.ticks % RELEASE_INTERVAL == 0:
+            self.releaseSprites(gameSprites, viewRect.inflate(RELEASE_MARGIN * 2, RELEASE_MARGIN * 2))
+            
+    def spawnSprites(self, gameSprites, spawnRect):
+        for cell in getCells(spawnRect):
+            if cell in self.cells:
+                for spawnPoint in self.cells[cell]:
+                    if not spawnPoint.sprite and spawnPoint.spawnRect.colliderect(spawnRect):
+                        self.spawnSprite(gameSprites, spawnPoint)
+    
+    def spawnSprite(self, gameSprites, spawnPoint):
+        mapSprite = spawnPoint.mapSprite
+        sprite = newSprite(spawnPoint.spriteClass, mapSprite, self.rpgMap, self.eventBus)
+        sprite.initMovement(mapSprite.level, mapSprite.tilePoints)
+        if spawnPoint.progress:
+            sprite.setProgress(spawnPoint.progress)
+        # the sprite existed all along as far as the game is concerned
+        gameSprites.addDormant(sprite, spawnPoint.lastTick)
+        spawnPoint.sprite = sprite
+    
+    def releaseSprites(self, gameSprites, releaseRect):
+        for spawnPoint in self.spawnPoints:
+            sprite = spawnPoint.sprite
+            if not sprite:
+                continue
+            if not sprite.alive():
+                # the sprite has gone for good, eg. a coin has been collected
+                spawnPoint.sprite = None
+                self.removeSpawnPoint(spawnPoint)
+            elif sprite.canSleep() and not spawnPoint.spawnRect.colliderect(releaseRect):
+                spawnPoint.progress = sprite.getProgress()
+                spawnPoint.lastTick = gameSprites.getLastTick(sprite)
+                spawnPoint.sprite = None
+                sprite.remove(gameSprites)
+        
+    def removeSpawnPoint(self, spawnPoint):
+        self.spawnPoints.remove(spawnPoint)
+        for cell in getCells(spawnPoint.spawnRect):
+            self.cells[cell].remove(spawnPoint)
+            
+def getCells(rect):
+    cx1, cy1 = rect.left // SPAWN_CELL_SIZE, rect.top // SPAWN_CELL_SIZE
+    cx2, cy2 = (rect.right - 1) // SPAWN_CELL_SIZE, (rect.bottom - 1) // SPAWN_CELL_SIZE
+    return [(cx, cy) for cx in range(cx1, cx2 + 1) for cy in range(cy1, cy2 + 1)]
@@ -6,14 +6,60 @@ from view import DOWN
 
 DIRECTION = "direction"
 
+"""
+A clock that all animations with the same frame skip and number of frames can
+share, so that they run in step.  The current frame is worked out once per
+tick for each kind of animation rather than counted by every sprite, and a
+sprite picks up the right frame whenever it looks, eg. on coming into view.
+"""
+class AnimationClock:
+    
+    def __init__(self):
+        self.ticks = 0
+        self.advanced = False
+        # the current frame index and new frame index, keyed on (frameSkip, numFrames)
+        self.frames = {}
+        
+    def tick(self, increment = 1):
+        self.ticks += increment
+        self.advanced = increment > 0
+        self.frames = {}
+    
+    """
+    Returns the current frame index, along with the same index again if this
+    tick has just moved on to it - otherwise None.
+    """
+    def getFrame(self, frameSkip, numFrames):
+        key = (frameSkip, numFrames)
+        if key not in self.frames:
+            frameIndex = (self.ticks // frameSkip) % numFrames
+            if self.advanced and self.ticks % frameSkip == 0:
+                self.frames[key] = frameIndex, frameIndex
+            else:
+                self.frames[key] = frameIndex, None
+        return self.frames[key]
+
+# the clock shared by all sprite animations - see states.PlayState.drawMapView
+animationClock = AnimationClock()
+
+"""
+Sprite frames either count their own frames, eg. the player's only animate
+when the player moves, or follow the given clock.
+"""
 class SpriteFrames:
     
-    def __init__(self, frameSkip = None):
+    def __init__(self, frameSkip = None, clock = None):
         self.frameSkip = frameSkip
+        self.clock = clock
         self.frameCount = 0
         self.frameIndex = 0
 
     def advanceFrameIndex(self, increment = 1):
+        if self.clock and self.frameSkip:
+            self.frameIndex, newFrameIndex = self.clock.getFrame(self.frameSkip, self.numFrames)
+            if increment:
+                return newFrameIndex
+            return None
         if increment and self.frameSkip:
             self.frameCount = (self.frameCount + increment) % self.frameSkip
             if self.frameCount == 0:
@@ -21,9 +67,6 @@ class SpriteFrames:
                 return self.frameIndex
         return None
     
-    def repairCurrentFrame(self):
-        pass
-    
     def advanceFrame(self, increment = 1, **kwargs):
         pass
 
@@ -33,35 +76,30 @@ class SpriteFrames:
     def setState(self, spriteFrames):
         self.frameCount, self.frameIndex, direction = spriteFrames.getState() 
         return self   
+
+    def restoreState(self, state):
+        self.frameCount, self.frameIndex, direction = state
             
 class StaticFrames(SpriteFrames):
     
-    def __init__(self, animationFrames, frameSkip = None):
-        SpriteFrames.__init__(self, frameSkip)
-        self.virginAnimationFrames = animationFrames
-        self.animationFrames = view.copyStaticFrames(animationFrames)
+    def __init__(self, animationFrames, frameSkip = None, clock = None):
+        SpriteFrames.__init__(self, frameSkip, clock)
+        # the frames are shared with other sprites - see assets.getStaticFrames
+        self.animationFrames = animationFrames
         self.numFrames = len(self.animationFrames)
 
-    def repairCurrentFrame(self):
-        lastImage = self.animationFrames[self.frameIndex]
-        lastImage.blit(self.virginAnimationFrames[self.frameIndex], (0, 0))
-
     def advanceFrame(self, increment = 1, **kwargs):
         newFrameIndex = self.advanceFrameIndex(increment)
         return self.animationFrames[self.frameIndex], newFrameIndex
     
 class DirectionalFrames(SpriteFrames):
     
-    def __init__(self, animationFrames, frameSkip = None):
-        SpriteFrames.__init__(self, frameSkip)
-        self.virginAnimationFrames = animationFrames
-        self.animationFrames = view.copyMovementFrames(animationFrames)
+    def __init__(self, animationFrames, frameSkip = None, clock = None):
+        SpriteFrames.__init__(self, frameSkip, clock)
+        # the frames are shared with other sprites - see assets.getMovementFrames
+        self.animationFrames = animationFrames
         self.numFrames = len(animationFrames[DOWN])
         self.direction = DOWN
-
-    def repairCurrentFrame(self):
-        lastImage = self.animationFrames[self.direction][self.frameIndex]
-        lastImage.blit(self.virginAnimationFrames[self.direction][self.frameIndex], (0, 0))
         
     def advanceFrame(self, increment = 1, **kwargs):
         newFrameIndex = self.advanceFrameIndex(increment)
@@ -75,4 +113,36 @@ class DirectionalFrames(SpriteFrames):
     def setState(self, spriteFrames):
         self.frameCount, self.frameIndex, self.direction = spriteFrames.getState()
         return self   
-            
+
+    def restoreState(self, state):
+        self.frameCount, self.frameIndex, self.direction = state
+
+"""
+Animation frames are shared between sprites, so a sprite that needs to draw on
+its frame - to be masked by the map - borrows a surface from this pool and
+draws on a copy of the frame instead.  The surface is given back as soon as
+the sprite is no longer masked, so the number of surfaces only depends on how
+many sprites are masked at once.
+"""
+class FramePool:
+    
+    def __init__(self):
+        # lists of spare surfaces keyed on size
+        self.spareFrames = {}
+        
+    def copyFrame(self, frame):
+        size = frame.get_size()
+        if self.spareFrames.get(size):
+            frameCopy = self.spareFrames[size].pop()
+            # blank out the last frame, since the new frame is transparent in places
+            frameCopy.fill(view.TRANSPARENT_COLOUR)
+        else:
+            frameCopy = view.createTransparentRect(size)
+        frameCopy.blit(frame, (0, 0))
+        return frameCopy
+    
+    def releaseFrame(self, frameCopy):
+        self.spareFrames.setdefault(frameCopy.get_size(), []).append(frameCopy)
+        
+# the frame pool shared by all sprites
+framePool = FramePool()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
 import os
+import bisect
 import pygame
 import view
+import assets
+
+from spriteframes import framePool
 
 from pygame.locals import Rect
 from view import SCALAR, TILE_SIZE
@@ -16,6 +20,12 @@ BASE_RECT_EXTEND = 1 * SCALAR
 
 SPRITES_FOLDER = "sprites"
 
+# the size of the cells that IndexedSprites buckets sprites into
+INDEX_CELL_SIZE = TILE_SIZE * 2
+
+# sprites this far outside the view are dormant - see IndexedSprites.update
+ACTIVITY_MARGIN = TILE_SIZE * 4
+
 NO_METADATA = {}
 NO_MOVEMENT = (0, 0, NO_METADATA)
 
@@ -34,10 +44,21 @@ class RpgSprite(pygame.sprite.Sprite):
         self.upright = True
         # indicates if this sprite is currently visible
         self.inView = False
-        # indicates if this sprite is currently masked by any map tiles
-        self.masked = False
+        # the frame under the masks, if this sprite is currently masked by any map tiles
+        self.maskedFrame = None
+        # the map tiles to draw over this sprite in occlusion mode, keyed on tile point
+        self.masks = None
+        self.maskOrigin = None
         # indicates if this sprite should be removed on next update
         self.toRemove = False
+        # pseudo z order, set when the sprite moves - see doMove
+        self.z = 0
+        # the RpgSprites groups that keep this sprite in z order
+        self.orderedGroups = []
+        # the IndexedSprites group that tracks where this sprite is
+        self.spriteIndex = None
+        # the area this sprite can move around, once it has a path - see initMovement
+        self.pathRect = None
         
     def setup(self, uid, rpgMap, eventBus):
         self.uid = uid
@@ -61,6 +82,8 @@ class RpgSprite(pygame.sprite.Sprite):
             self.level = level
         if px > 0 or py > 0:
             self.doMove(px, py)
+        if self.spriteIndex:
+            self.spriteIndex.reindex(self)
         
     def initBaseRect(self):
         baseRectWidth = self.mapRect.width 
@@ -80,24 +103,63 @@ class RpgSprite(pygame.sprite.Sprite):
         self.mapRect.move_ip(px, py)
         self.baseRect.move_ip(px, py)
         # a pseudo z order is used to test if one sprite is behind another
-        self.z = int(self.mapRect.bottom + self.level * TILE_SIZE)
+        z = int(self.mapRect.bottom + self.level * TILE_SIZE)
+        if z != self.z:
+            for group in self.orderedGroups:
+                group.reorder(self, z)
+            self.z = z
+        if self.spriteIndex and (px or py):
+            self.spriteIndex.reindex(self)
         # print self.uid, self.mapRect, self.baseRect
 
     def clearMasks(self):
-        if self.masked:
-            self.masked = False
-            self.spriteFrames.repairCurrentFrame()
+        self.masks = None
+        if self.maskedFrame:
+            # give back the copy of the frame the masks were drawn on
+            framePool.releaseFrame(self.image)
+            self.image = self.maskedFrame
+            self.maskedFrame = None
         
     def applyMasks(self):
         # masks is a map of lists, keyed on the associated tile points
         masks = self.rpgMap.getMasks(self)
+        if view.OCCLUSION_MODE:
+            # the masks are drawn over the sprite by RpgSprites.draw - the origin
+            # is kept so they move with the sprite, as if they were on the frame
+            self.masks = masks
+            self.maskOrigin = self.mapRect.topleft
+            return
         if len(masks) > 0:
-            self.masked = True
+            # the frame is shared, so draw on a copy of it
+            self.maskedFrame = self.image
+            self.image = framePool.copyFrame(self.image)
             for tilePoint in masks:
                 px = tilePoint[0] * view.TILE_SIZE - self.mapRect.left
                 py = tilePoint[1] * view.TILE_SIZE - self.mapRect.top
                 [self.image.blit(mask, (px, py)) for mask in masks[tilePoint]]
                 
+    """
+    Draws the masks over the sprite, which must have just been drawn onto the
+    given surface.  Masks are clipped to the sprite, so this looks exactly the
+    same as if they had been blitted onto the sprite's frame.
+    """
+    def drawMasks(self, surface):
+        clip = surface.get_clip()
+        surface.set_clip(self.rect.clip(clip))
+        px = self.rect.left - self.maskOrigin[0]
+        py = self.rect.top - self.maskOrigin[1]
+        for tilePoint in self.masks:
+            for mask in self.masks[tilePoint]:
+                surface.blit(mask, (px + tilePoint[0] * TILE_SIZE, py + tilePoint[1] * TILE_SIZE))
+        surface.set_clip(clip)
+                
+    """
+    Returns everything apart from its position that affects how this sprite
+    looks on the screen - if this changes between frames it needs redrawing.
+    """
+    def getDrawState(self):
+        return (self.image, self.z, self.masks, self.maskOrigin, self.maskedFrame)
+    
     def advanceFrame(self, increment, metadata):
         self.image, frameIndex = self.spriteFrames.advanceFrame(increment, **metadata)
         self.playSound(frameIndex)
@@ -121,6 +183,9 @@ Base class for any sprites that aren't either the player or a fixed sprite.
 """
 class OtherSprite(RpgSprite):
     
+    # static sprites never move or change - see bake
+    static = False
+    
     def __init__(self, spriteFrames, position = (0, 0)):
         RpgSprite.__init__(self, spriteFrames, position)
         self.movement = None
@@ -155,32 +220,325 @@ class OtherSprite(RpgSprite):
             self.inView = False
             self.remove(visibleSprites)
     
+    """
+    Static sprites are drawn into the map instead of being updated and drawn
+    every frame - see map.RpgMap.bakeSprite.  They are still game sprites, so
+    the player can interact with them as usual.
+    """
+    def bake(self):
+        self.rpgMap.bakeSprite(self)
+        # the sprite is visible whenever the map around it is
+        self.inView = True
+    
+    """
+    Indicates if this sprite can be left dormant while it's away from the view.
+    A dormant sprite isn't updated, so it must either do nothing while out of
+    view or be able to catch up - see fastForward.
+    """
+    def canSleep(self):
+        return not self.toRemove
+    
+    """
+    Catches up with the given number of updates that were skipped while this
+    sprite was dormant.  Sprites that do nothing out of view have nothing to do.
+    """
+    def fastForward(self, ticks):
+        pass
+    
+    """
+    Returns whatever this sprite needs to carry on from where it is if it's
+    released and created again - see spritebuilder.SpriteSpawner.
+    """
+    def getProgress(self):
+        return self.mapRect.topleft, self.spriteFrames.getState()
+    
+    """
+    Carries on from the given progress - this must be called after initMovement.
+    """
+    def setProgress(self, progress):
+        position, frameState = progress
+        self.doMove(position[0] - self.mapRect.left, position[1] - self.mapRect.top)
+        self.spriteFrames.restoreState(frameState)
+        self.image, frameIndex = self.spriteFrames.advanceFrame(0)
+    
     # initialises sprite movement and sets the tile position        
     def initMovement(self, level, tilePoints):
         self.setTilePosition(tilePoints[0][0], tilePoints[0][1], level)
         self.level = level
         self.tilePoints = tilePoints
+        self.pathRect = getPathRect(tilePoints)
             
     # base movement method - this is sufficient for static sprites only        
     def getMovement(self, player):
         return NO_MOVEMENT
                                    
+"""
+Returns the area that a sprite moving around the given tiles can cover, with
+room for sprites that are bigger than a tile.
+"""
+def getPathRect(tilePoints):
+    xs, ys = [tilePoint[0] for tilePoint in tilePoints], [tilePoint[1] for tilePoint in tilePoints]
+    return Rect((min(xs) - 1) * TILE_SIZE, (min(ys) - 1) * TILE_SIZE,
+                (max(xs) - min(xs) + 3) * TILE_SIZE, (max(ys) - min(ys) + 3) * TILE_SIZE)
+
+"""
+Returns the index cells touched by the given rect.
+"""
+def getIndexCells(rect):
+    cx1, cy1 = rect.left // INDEX_CELL_SIZE, rect.top // INDEX_CELL_SIZE
+    cx2, cy2 = (rect.right - 1) // INDEX_CELL_SIZE, (rect.bottom - 1) // INDEX_CELL_SIZE
+    return [(cx, cy) for cx in range(cx1, cx2 + 1) for cy in range(cy1, cy2 + 1)]
+
 """
 Sprite group that ensures pseudo z ordering for the sprites.  This works
 because internally AbstractGroup calls self.sprites() to get a list of sprites
 before it draws them.  I've overidden the sprites() method to return the
 sprites in the correct order - this works, but I might be in trouble if the
 internals of AbstractGroup ever changes.
+
+The order is kept up to date as sprites are added, removed and moved, rather
+than sorting the sprites every time they're asked for: sprites tell the group
+when their z changes (see RpgSprite.doMove) and are moved to their new place.
+Sprites with the same z stay in the order they arrived in.
 """
 class RpgSprites(pygame.sprite.Group):
     
     def __init__(self, *sprites):
         pygame.sprite.AbstractGroup.__init__(self)
+        # sprites in z order, with their z values alongside for bisecting
+        self.orderedSprites = []
+        self.orderedZs = []
+        # a copy of orderedSprites that is safe to hold on to while the group changes
+        self.spritesView = None
         self.add(*sprites)
         
     def sprites(self):
         # return the sprites sorted on their z field to ensure 
         # that they appear in the correct 'z' order
-        return sorted(self.spritedict.keys(),
-                      lambda sprite1, sprite2: sprite1.z - sprite2.z)
+        if self.spritesView is None:
+            self.spritesView = list(self.orderedSprites)
+        return self.spritesView
+    
+    # override
+    def add_internal(self, sprite):
+        pygame.sprite.AbstractGroup.add_internal(self, sprite)
+        sprite.orderedGroups.append(self)
+        self.insertSprite(sprite, sprite.z)
+        
+    # override
+    def remove_internal(self, sprite):
+        pygame.sprite.AbstractGroup.remove_internal(self, sprite)
+        sprite.orderedGroups.remove(self)
+        self.removeSprite(sprite)
         
+    """
+    Moves the sprite to its place for the given z - this must be called before
+    the sprite's z is changed.
+    """
+    def reorder(self, sprite, z):
+        self.removeSprite(sprite)
+        self.insertSprite(sprite, z)
+        
+    def insertSprite(self, sprite, z):
+        i = bisect.bisect_right(self.orderedZs, z)
+        self.orderedZs.insert(i, z)
+        self.orderedSprites.insert(i, sprite)
+        self.spritesView = None
+        
+    def removeSprite(self, sprite):
+        i = bisect.bisect_left(self.orderedZs, sprite.z)
+        while self.orderedSprites[i] is not sprite:
+            i += 1
+        del self.orderedZs[i]
+        del self.orderedSprites[i]
+        self.spritesView = None
+    
+    # override
+    def draw(self, surface):
+        for sprite in self.sprites():
+            self.spritedict[sprite] = surface.blit(sprite.image, sprite.rect)
+            # in occlusion mode any masks are drawn over the sprite straight away
+            if sprite.masks:
+                sprite.drawMasks(surface)
+        self.lostsprites = []
+    
+    """
+    Draws the sprites that overlap the given area of the surface, without
+    drawing anything outside of it.
+    """
+    def drawArea(self, surface, area):
+        clip = surface.get_clip()
+        surface.set_clip(area.clip(clip))
+        for sprite in self.sprites():
+            if area.colliderect(sprite.rect):
+                surface.blit(sprite.image, sprite.rect)
+                if sprite.masks:
+                    sprite.drawMasks(surface)
+        surface.set_clip(clip)
+
+"""
+Sprite group that also keeps a spatial index of its sprites, so that the
+sprites near a given area can be found without testing every sprite on the
+map.  Sprites are bucketed by level into cells of INDEX_CELL_SIZE and tell
+the group when they move (see RpgSprite.doMove).  A sprite is indexed by
+both its map rect and its base rect, since either may be queried.  Sprites
+that follow a path are also indexed by the whole area of their path, which
+must be set up before they're added - see OtherSprite.initMovement.
+"""
+class IndexedSprites(pygame.sprite.Group):
+    
+    def __init__(self, *sprites):
+        pygame.sprite.AbstractGroup.__init__(self)
+        # lists of sprites keyed on cell, keyed on level
+        self.levelCells = {}
+        # the range of cells each sprite is in as (level, cx1, cy1, cx2, cy2)
+        self.cellRanges = {}
+        # lists of the sprites whose paths cross each cell, keyed on cell
+        self.pathCells = {}
+        # the order sprites were added in, so query results are repeatable
+        self.arrivals = {}
+        self.arrivalCount = 0
+        # the number of updates so far and the last update each sprite had
+        self.ticks = 0
+        self.lastTicks = {}
+        # sprites that must be updated even when away from the view
+        self.restlessSprites = []
+        # creates and releases sprites as the view moves, if set
+        self.spawner = None
+        self.add(*sprites)
+        
+    # override
+    def add_internal(self, sprite):
+        pygame.sprite.AbstractGroup.add_internal(self, sprite)
+        sprite.spriteIndex = self
+        self.arrivalCount += 1
+        self.arrivals[sprite] = self.arrivalCount
+        self.cellRanges[sprite] = None
+        self.lastTicks[sprite] = self.ticks
+        self.reindex(sprite)
+        if sprite.pathRect and not sprite.static:
+            for cell in getIndexCells(sprite.pathRect):
+                self.pathCells.setdefault(cell, []).append(sprite)
+        
+    # override
+    def remove_internal(self, sprite):
+        pygame.sprite.AbstractGroup.remove_internal(self, sprite)
+        sprite.spriteIndex = None
+        self.moveCells(sprite, self.cellRanges.pop(sprite), None)
+        if sprite.pathRect and not sprite.static:
+            for cell in getIndexCells(sprite.pathRect):
+                self.pathCells[cell].remove(sprite)
+                if not self.pathCells[cell]:
+                    del self.pathCells[cell]
+        del self.arrivals[sprite]
+        del self.lastTicks[sprite]
+    
+    """
+    Updates the sprites that are active - in view or near it - plus any that
+    can't be left dormant (see OtherSprite.canSleep).  Dormant sprites are not
+    updated at all, so the cost of an update depends on what is on or near the
+    screen rather than on the whole map.  A sprite that follows a path wakes
+    as soon as any of its path comes near the view, as that's where it could
+    be by now, and a dormant sprite is fast forwarded by the updates it missed
+    before it is updated again.
+    
+    Note that the arguments are the same as OtherSprite.update takes.
+    """
+    # override
+    def update(self, player, gameSprites, visibleSprites, increment):
+        self.ticks += 1
+        if self.spawner:
+            self.spawner.update(self, player.viewRect)
+        nearRect = player.viewRect.inflate(ACTIVITY_MARGIN * 2, ACTIVITY_MARGIN * 2)
+        activeSprites = set([sprite for sprite in self.getSprites(nearRect) if not sprite.static])
+        activeSprites.update(self.getPathSprites(nearRect))
+        activeSprites.update(self.restlessSprites)
+        # anything in view is near it, but make sure it gets the chance to leave
+        activeSprites.update([sprite for sprite in visibleSprites if sprite in self.lastTicks])
+        activeSprites = sorted(activeSprites, key = self.arrivals.get)
+        for sprite in activeSprites:
+            skippedTicks = self.ticks - self.lastTicks[sprite] - 1
+            if skippedTicks > 0:
+                sprite.fastForward(skippedTicks)
+            sprite.update(player, gameSprites, visibleSprites, increment)
+            if sprite in self.lastTicks:
+                self.lastTicks[sprite] = self.ticks
+        self.restlessSprites = [sprite for sprite in activeSprites
+                                if sprite in self.lastTicks and not sprite.canSleep()]
+        
+    """
+    Returns the sprites whose paths cross the cells touched by the given rect.
+    """
+    def getPathSprites(self, rect):
+        pathSprites = set()
+        for cell in getIndexCells(rect):
+            if cell in self.pathCells:
+                pathSprites.update(self.pathCells[cell])
+        return pathSprites
+    
+    """
+    Adds a sprite that has been dormant since the given update, so that it's
+    fast forwarded when it is next updated.
+    """
+    def addDormant(self, sprite, lastTick):
+        self.add(sprite)
+        self.lastTicks[sprite] = lastTick
+        
+    def getLastTick(self, sprite):
+        return self.lastTicks[sprite]
+        
+    """
+    Moves the sprite to the cells it's in now - called whenever it moves.
+    """
+    def reindex(self, sprite):
+        mapRect, baseRect = sprite.mapRect, sprite.baseRect
+        cellRange = (sprite.level,
+                     min(mapRect.left, baseRect.left) // INDEX_CELL_SIZE,
+                     min(mapRect.top, baseRect.top) // INDEX_CELL_SIZE,
+                     (max(mapRect.right, baseRect.right) - 1) // INDEX_CELL_SIZE,
+                     (max(mapRect.bottom, baseRect.bottom) - 1) // INDEX_CELL_SIZE)
+        lastCellRange = self.cellRanges[sprite]
+        if cellRange != lastCellRange:
+            self.cellRanges[sprite] = cellRange
+            self.moveCells(sprite, lastCellRange, cellRange)
+            
+    def moveCells(self, sprite, lastCellRange, cellRange):
+        if lastCellRange:
+            level, cx1, cy1, cx2, cy2 = lastCellRange
+            cells = self.levelCells[level]
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    cell = cells[(cx, cy)]
+                    cell.remove(sprite)
+                    if not cell:
+                        del cells[(cx, cy)]
+        if cellRange:
+            level, cx1, cy1, cx2, cy2 = cellRange
+            cells = self.levelCells.setdefault(level, {})
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    cells.setdefault((cx, cy), []).append(sprite)
+    
+    """
+    Returns the sprites in the cells touched by the given rect, on the given
+    level or on all levels, in z order.  The sprites are near the rect but
+    may not actually intersect it.
+    """
+    def getSprites(self, rect, level = None):
+        if level is None:
+            levels = self.levelCells.keys()
+        elif level in self.levelCells:
+            levels = [level]
+        else:
+            return []
+        cx1, cy1 = rect.left // INDEX_CELL_SIZE, rect.top // INDEX_CELL_SIZE
+        cx2, cy2 = (rect.right - 1) // INDEX_CELL_SIZE, (rect.bottom - 1) // INDEX_CELL_SIZE
+        nearSprites = {}
+        for level in levels:
+            cells = self.levelCells[level]
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    if (cx, cy) in cells:
+                        for sprite in cells[(cx, cy)]:
+                            nearSprites[sprite] = (sprite.z, self.arrivals[sprite])
+        return sorted(nearSprites, key = nearSprites.get)
@@ -18,8 +18,10 @@ from eventbus import EventBus
 from registry import RegistryHandler, Registry
 from player import Ulmo
 from sounds import SoundHandler
+from prefetcher import MapPrefetcher
+from spriteframes import animationClock
 from events import MapTransitionEvent, EndGameEvent
-from fixedsprites import FixedCoin, CoinCount, KeyCount, Lives, CheckpointIcon
+from fixedsprites import FixedCoin, CoinCount, KeyCount, Lives, CheckpointIcon, HeadsUpDisplay
 
 FRAMES_PER_SEC = 60 // VELOCITY
 
@@ -41,22 +43,61 @@ DOORWAY_TICKS = {UP: 16 // VELOCITY,
                  LEFT: 16 // VELOCITY,
                  RIGHT: 16 // VELOCITY}
 
-pygame.display.set_caption("Ulmo's Adventure")
-screen = pygame.display.set_mode(DIMENSIONS)
-
-blackRect = view.createRectangle(DIMENSIONS)
-
-gameFont = font.GameFont()
-titleFont = font.TitleFont()
-
 # globals
+screen = None
+headless = False
+blackRect = None
+gameFont = None
+titleFont = None
 eventBus = None
 soundHandler = None
 registryHandler = None
 fixedSprites = None
+headsUpDisplay = None
 player = None
+mapPrefetcher = None
+
+"""
+Sets up the screen, which must be done before anything else.  When headless the
+game is drawn onto an ordinary surface instead of a window, so that it can run
+without a display - eg. for tests, bots and benchmarks.
+"""
+def initDisplay(headlessMode = False):
+    global screen, headless
+    headless = headlessMode
+    if headless:
+        screen = view.createRectangle(DIMENSIONS)
+    else:
+        pygame.display.set_caption("Ulmo's Adventure")
+        screen = pygame.display.set_mode(DIMENSIONS)
+
+    global blackRect, gameFont, titleFont
+    blackRect = view.createRectangle(DIMENSIONS)
+    gameFont = font.GameFont()
+    titleFont = font.TitleFont()
+
+"""
+Shows the changes to the screen - the given areas, or the whole screen if no
+areas are given.  There's nothing to show when headless.
+"""
+def updateDisplay(rects = None):
+    if headless:
+        return
+    if rects is None:
+        pygame.display.flip()
+    else:
+        pygame.display.update(rects)
 
 def showTitle():
+    initGame()
+    # return the title state
+    return TitleState()
+
+"""
+Sets up the event bus and its listeners for a new game, plus the map prefetcher
+unless prefetch is False.
+"""
+def initGame(prefetch = True):
     global eventBus
     eventBus = EventBus()
 
@@ -81,11 +122,32 @@ def showTitle():
     eventBus.addDoorOpenedListener(registryHandler)
     eventBus.addCheckpointReachedListener(registryHandler)
 
-    # return the title state
-    return TitleState()
-
-def startGame(cont = False):
-    registry = getRegistry(cont)
+    # the prefetcher's worker thread is only started once
+    global mapPrefetcher
+    if not prefetch:
+        stopPrefetcher()
+    elif mapPrefetcher is None:
+        mapPrefetcher = MapPrefetcher()
+
+"""
+Stops the map prefetcher's worker thread - eg. when a simulation is finished
+with.  A new one is started by the next call to initGame.
+"""
+def stopPrefetcher():
+    global mapPrefetcher
+    if mapPrefetcher:
+        mapPrefetcher.stop()
+        mapPrefetcher = None
+
+"""
+Starts a game from the given registry, or otherwise from a new or continued
+registry - see getRegistry.
+"""
+def startGame(cont = False, registry = None):
+    if registry:
+        registryHandler.setRegistry(registry)
+    else:
+        registry = getRegistry(cont)
 
     # create fixed sprites
     global fixedSprites
@@ -96,6 +158,8 @@ def startGame(cont = False):
     lives = Lives(2, (3, 3))
     checkpointIcon = CheckpointIcon((-11, -11))
     fixedSprites.add(fixedCoin, lives, coinCount, keyCount, checkpointIcon)
+    global headsUpDisplay
+    headsUpDisplay = HeadsUpDisplay(fixedSprites)
 
     # create player
     global player
@@ -150,14 +214,36 @@ def sceneZoomIn(screenImage, ticks):
     screen.blit(blackRect, ORIGIN)
     extract = Rect(xBorder, yBorder, VIEW_WIDTH - xBorder * 2, VIEW_HEIGHT - yBorder * 2)
     screen.blit(screenImage, (xBorder, yBorder), extract)
-    pygame.display.flip()
+    updateDisplay()
 
 def sceneZoomOut(screenImage, ticks):
     xBorder = (THIRTY_TWO - (ticks + 1)) * X_MULT
     yBorder = xBorder * Y_X_RATIO
     extract = Rect(xBorder, yBorder, VIEW_WIDTH - xBorder * 2, VIEW_HEIGHT - yBorder * 2)
     screen.blit(screenImage, (xBorder, yBorder), extract)
-    pygame.display.flip()
+    updateDisplay()
+
+"""
+Returns the strips along the edges of the given area that are exposed when it
+is scrolled by (-px, -py).  The strips don't overlap, so that they aren't
+merged into the whole area when the view scrolls diagonally.
+"""
+def getExposedRects(area, px, py):
+    exposedRects = []
+    # the part of the area that isn't in the side strip
+    rest = Rect(area)
+    if px > 0:
+        exposedRects.append(Rect(area.right - px, area.top, px, area.height).clip(area))
+        rest.width -= exposedRects[0].width
+    elif px < 0:
+        exposedRects.append(Rect(area.left, area.top, -px, area.height).clip(area))
+        rest.left += exposedRects[0].width
+        rest.width -= exposedRects[0].width
+    if py > 0:
+        exposedRects.append(Rect(rest.left, area.bottom - py, rest.width, py).clip(rest))
+    elif py < 0:
+        exposedRects.append(Rect(rest.left, area.top, rest.width, -py).clip(rest))
+    return [rect for rect in exposedRects if rect.width and rect.height]
 
 class TitleState:
 
@@ -179,16 +265,16 @@ class TitleState:
             if (self.ticks % 2) == 0:
                 x, y = 0, self.ticks * MOVE_UNIT // 2
                 screen.blit(self.backgroundImage, ORIGIN, Rect(x, y, VIEW_WIDTH, VIEW_HEIGHT))
-                pygame.display.flip()
+                updateDisplay()
         elif self.ticks == self.titleTicks + THIRTY_TWO:
             x, y = (VIEW_WIDTH - self.titleImage.get_width()) // 2, 26 * SCALAR
             screen.blit(self.titleImage, (x, y))
-            pygame.display.flip()
+            updateDisplay()
         elif self.ticks == self.titleTicks + SIXTY_FOUR:
             self.playState = startGame()
             x, y = (VIEW_WIDTH - self.playLine.get_width()) // 2, 88 * SCALAR
             screen.blit(self.playLine, (x, y))
-            pygame.display.flip()
+            updateDisplay()
         elif self.ticks > self.titleTicks + SIXTY_FOUR:
             if keyPresses[K_SPACE]:
                 return StartState(self.playState)
@@ -221,14 +307,27 @@ class PlayState:
         self.visibleSprites = sprites.RpgSprites(player)
         # create more sprites
         self.gameSprites = spritebuilder.createSpritesForMap(player.rpgMap, eventBus, registryHandler.registry)
+        # what was last drawn, so that only the areas that change need redrawing
+        self.lastView = None
+        self.lastViewTopleft = None
+        self.drawStates = {}
 
     def execute(self, keyPresses):
         event = player.handleInteractions(keyPresses, self.gameSprites, self.visibleSprites)
         if event:
             return self.handleEvent(event)
-        # draw the map view to the screen
-        self.drawMapView(screen)
-        pygame.display.flip()
+        # load any maps the player is heading towards
+        if mapPrefetcher:
+            mapPrefetcher.prefetchNear(player.rpgMap, player.mapRect)
+        self.updateSprites()
+
+    """
+    Draws the map view to the screen.  Unlike the other states, the play state
+    doesn't draw anything in execute, so the game loop can skip drawing frames
+    when it falls behind - see gameclock.GameClock.
+    """
+    def drawFrame(self):
+        updateDisplay(self.drawView(screen))
 
     def handleEvent(self, event):
         if event.type == playevents.LIFE_LOST_EVENT:
@@ -246,14 +345,89 @@ class PlayState:
         # this should never happen!
         return None
 
-    def drawMapView(self, surface, increment = 1):
-        rpgMapImage, playerViewRect = player.getMapView()
-        surface.blit(rpgMapImage, ORIGIN, playerViewRect)
+    def updateSprites(self, increment = 1):
+        animationClock.tick(increment)
         # if the sprite being updated is in view it will be added to visibleSprites as a side-effect
         self.gameSprites.update(player, self.gameSprites, self.visibleSprites, increment)
-        self.visibleSprites.draw(surface)
-        if increment:
-            fixedSprites.draw(surface)
+
+    def drawMapView(self, surface, increment = 1):
+        self.updateSprites(increment)
+        return self.drawView(surface, increment > 0)
+
+    """
+    Draws the map view and returns the areas of the surface that have changed.
+    The whole view is only redrawn if it's being drawn onto a different surface
+    or it has scrolled too far.  When the view scrolls the last frame is shifted
+    along and just the exposed strips are drawn from the map, and otherwise
+    just the areas around sprites that have moved or changed are redrawn.
+    Frames that are skipped don't matter, as the areas that have changed are
+    worked out from what was last drawn.
+    """
+    def drawView(self, surface, showHud = True):
+        rpgMap, playerViewRect = player.getMapView()
+        surfaceRect = surface.get_rect()
+        currentView = (surface, rpgMap, showHud)
+        px, py = 0, 0
+        if currentView == self.lastView:
+            px = playerViewRect.left - self.lastViewTopleft[0]
+            py = playerViewRect.top - self.lastViewTopleft[1]
+        dirtyRects = self.getDirtyRects(self.visibleSprites.sprites(), surfaceRect, px, py)
+        self.lastViewTopleft = playerViewRect.topleft
+        if showHud:
+            # the fixed sprites stay put when the view scrolls, so they need
+            # redrawing where they were shifted to as well as where they are
+            lastHudRects = headsUpDisplay.rects
+            hudRects = headsUpDisplay.update()
+            if px or py:
+                hudRects += [rect.move(-px, -py).clip(surfaceRect) for rect in lastHudRects] + headsUpDisplay.rects
+            dirtyRects = view.mergeRects(dirtyRects + [rect for rect in hudRects if rect.width and rect.height])
+        if currentView != self.lastView or abs(px) >= surfaceRect.width or abs(py) >= surfaceRect.height:
+            self.lastView = currentView
+            rpgMap.drawMapArea(surface, ORIGIN, playerViewRect)
+            self.visibleSprites.draw(surface)
+            if showHud:
+                headsUpDisplay.draw(surface)
+            return [surfaceRect]
+        if px or py:
+            # reuse what we can of the last frame - the sprites are then redrawn
+            # wherever they were or are now, so the shifted copies don't matter
+            surface.scroll(-px, -py)
+            dirtyRects = view.mergeRects(getExposedRects(surfaceRect, px, py) + dirtyRects)
+        for dirtyRect in dirtyRects:
+            rpgMap.drawMapArea(surface, dirtyRect.topleft, dirtyRect.move(playerViewRect.topleft))
+            self.visibleSprites.drawArea(surface, dirtyRect)
+            if showHud:
+                headsUpDisplay.draw(surface, dirtyRect)
+        if px or py:
+            # everything on the surface has moved
+            return [surfaceRect]
+        return dirtyRects
+
+    """
+    Returns the areas of the surface covered by the given sprites that have
+    changed since they were last drawn, plus those of any sprites that are no
+    longer drawn.  If the view has scrolled by (px, py) since then, everything
+    last drawn is treated as having moved by (-px, -py) along with it.
+    """
+    def getDirtyRects(self, drawnSprites, surfaceRect, px = 0, py = 0):
+        dirtyRects = []
+        drawStates = {}
+        for sprite in drawnSprites:
+            drawState = sprite.getDrawState()
+            lastDrawState, lastRect = self.drawStates.pop(sprite, (None, None))
+            if lastRect:
+                lastRect.move_ip(-px, -py)
+            if drawState != lastDrawState or lastRect != sprite.rect:
+                if lastRect:
+                    dirtyRects.append(lastRect)
+                dirtyRects.append(Rect(sprite.rect))
+            drawStates[sprite] = (drawState, Rect(sprite.rect))
+        # anything left over has been removed
+        for lastDrawState, lastRect in self.drawStates.values():
+            dirtyRects.append(lastRect.move(-px, -py))
+        self.drawStates = drawStates
+        dirtyRects = [rect.clip(surfaceRect) for rect in dirtyRects]
+        return view.mergeRects([rect for rect in dirtyRects if rect.width and rect.height])
 
     def lifeLostTransition(self):
         registryHandler.switchToSnapshot()
@@ -342,7 +516,7 @@ class BoundaryTransitionState:
                 self.screenWipeRight(sliceWidth)
             else: # self.boundary == RIGHT
                 self.screenWipeLeft(sliceWidth)
-            pygame.display.flip()
+            updateDisplay()
         else:
             return ShowPlayerState(self.boundary, self.playState, BOUNDARY_TICKS[self.boundary])
         self.ticks += 1
@@ -406,13 +580,13 @@ class GameOverState:
                 screen.blit(self.topLine3, (x, y))
                 # set the countdown topleft for later
                 self.countdownTopleft = (x, y)
-            pygame.display.flip()
+            updateDisplay()
         elif self.ticks == SIXTY_FOUR:
             x, y = (VIEW_WIDTH - self.lowLine1.get_width()) // 2, VIEW_HEIGHT - 42 * SCALAR
             screen.blit(self.lowLine1, (x, y))
             x, y = (VIEW_WIDTH - self.lowLine2.get_width()) // 2, VIEW_HEIGHT - 30 * SCALAR
             screen.blit(self.lowLine2, (x, y))
-            pygame.display.flip()
+            updateDisplay()
             if self.continueOffered:
                 self.countdown = 10
         elif self.ticks > SIXTY_FOUR:
@@ -424,13 +598,17 @@ class GameOverState:
 
     def updateCountdown(self):
         self.countdown = self.countdown - 1
-        countdownLine = gameFont.getTextImage("CONTINUE... " + str(self.countdown))
-        screen.blit(self.blackRect, self.countdownTopleft)
         if self.countdown > 0:
-            screen.blit(countdownLine, self.countdownTopleft)
+            # only the number changes, so it is drawn over the old one
+            x, y = self.countdownTopleft
+            x += gameFont.getTextWidth("CONTINUE... ")
+            numberWidth = gameFont.getTextWidth("10")
+            screen.blit(self.blackRect, (x, y), Rect(0, 0, numberWidth, gameFont.charHeight))
+            gameFont.drawText(screen, str(self.countdown), (x, y))
         else:
+            screen.blit(self.blackRect, self.countdownTopleft)
             self.countdown = None
-        pygame.display.flip()
+        updateDisplay()
 
 class EndGameState:
 
@@ -455,13 +633,13 @@ class EndGameState:
             screen.blit(self.topLine2, (x, y))
             x, y = (VIEW_WIDTH - self.topLine3.get_width()) // 2, 56 * SCALAR
             screen.blit(self.topLine3, (x, y))
-            pygame.display.flip()
+            updateDisplay()
         elif self.ticks == SIXTY_FOUR:
             x, y = (VIEW_WIDTH - self.lowLine1.get_width()) // 2, VIEW_HEIGHT - 42 * SCALAR
             screen.blit(self.lowLine1, (x, y))
             x, y = (VIEW_WIDTH - self.lowLine2.get_width()) // 2, VIEW_HEIGHT - 30 * SCALAR
             screen.blit(self.lowLine2, (x, y))
-            pygame.display.flip()
+            updateDisplay()
         elif self.ticks > SIXTY_FOUR:
             if keyPresses[K_SPACE]:
                 return startGame()
@@ -488,5 +666,5 @@ class ShowPlayerState:
         else: # self.boundary == RIGHT
             px = MOVE_UNIT
         self.playState.showPlayer(px, py)
-        pygame.display.flip()
+        updateDisplay()
         self.ticks += 1
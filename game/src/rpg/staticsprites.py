@@ -2,7 +2,7 @@
 
 from sprites import *
 
-from spriteframes import StaticFrames
+from spriteframes import StaticFrames, animationClock
 from events import CoinCollectedEvent, KeyCollectedEvent, DoorOpenedEvent, DoorOpeningEvent, CheckpointReachedEvent
 from events import KeyMetadata, CoinMetadata, DoorMetadata, CheckpointMetadata
 
@@ -14,28 +14,20 @@ CHECKPOINT_FRAME_SKIP = 12 // VELOCITY
 
 class Flames(OtherSprite):
     
-    framesImage = None
-    
     def __init__(self):
-        if Flames.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "flame-frames.png")
-            Flames.framesImage = view.loadScaledImage(imagePath, None)        
-        animationFrames = view.processStaticFrames(Flames.framesImage)
-        spriteFrames = StaticFrames(animationFrames, FLAMES_FRAME_SKIP)
+        imagePath = os.path.join(SPRITES_FOLDER, "flame-frames.png")
+        animationFrames = assets.getStaticFrames(imagePath)
+        spriteFrames = StaticFrames(animationFrames, FLAMES_FRAME_SKIP, animationClock)
         OtherSprite.__init__(self, spriteFrames, (4, 2))
 
 class Coin(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (8 * SCALAR, BASE_RECT_HEIGHT)
         
     def __init__(self):
-        if Coin.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "coin-frames.png")
-            Coin.framesImage = view.loadScaledImage(imagePath, None)        
-        animationFrames = view.processStaticFrames(Coin.framesImage)
-        spriteFrames = StaticFrames(animationFrames, COIN_FRAME_SKIP)
+        imagePath = os.path.join(SPRITES_FOLDER, "coin-frames.png")
+        animationFrames = assets.getStaticFrames(imagePath)
+        spriteFrames = StaticFrames(animationFrames, COIN_FRAME_SKIP, animationClock)
         OtherSprite.__init__(self, spriteFrames, (2, 2))
         
     def processCollision(self, player):
@@ -46,16 +38,12 @@ class Coin(OtherSprite):
 
 class Key(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (8 * SCALAR, BASE_RECT_HEIGHT)
         
     def __init__(self):
-        if Key.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "key-frames.png")
-            Key.framesImage = view.loadScaledImage(imagePath, None)        
-        animationFrames = view.processStaticFrames(Key.framesImage, 6)
-        spriteFrames = StaticFrames(animationFrames, KEY_FRAME_SKIP)
+        imagePath = os.path.join(SPRITES_FOLDER, "key-frames.png")
+        animationFrames = assets.getStaticFrames(imagePath, 6)
+        spriteFrames = StaticFrames(animationFrames, KEY_FRAME_SKIP, animationClock)
         OtherSprite.__init__(self, spriteFrames, (2, 2))
         
     def processCollision(self, player):
@@ -66,15 +54,12 @@ class Key(OtherSprite):
 
 class Chest(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (8 * SCALAR, BASE_RECT_HEIGHT)
+    static = True
         
     def __init__(self):
-        if Chest.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "chest.png")
-            Chest.framesImage = view.loadScaledImage(imagePath, None)        
-        animationFrames = view.processStaticFrames(Chest.framesImage, 1)
+        imagePath = os.path.join(SPRITES_FOLDER, "chest.png")
+        animationFrames = assets.getStaticFrames(imagePath, 1)
         spriteFrames = StaticFrames(animationFrames)
         OtherSprite.__init__(self, spriteFrames)
         
@@ -84,15 +69,12 @@ class Chest(OtherSprite):
                 
 class Rock(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (8 * SCALAR, BASE_RECT_HEIGHT)
+    static = True
         
     def __init__(self):
-        if Rock.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "rock.png")
-            Rock.framesImage = view.loadScaledImage(imagePath, None)        
-        animationFrames = view.processStaticFrames(Rock.framesImage, 1)
+        imagePath = os.path.join(SPRITES_FOLDER, "rock.png")
+        animationFrames = assets.getStaticFrames(imagePath, 1)
         spriteFrames = StaticFrames(animationFrames)
         OtherSprite.__init__(self, spriteFrames, (0, -4))
         
@@ -102,15 +84,11 @@ class Rock(OtherSprite):
                 
 class Door(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (4 * SCALAR, BASE_RECT_HEIGHT)    
 
     def __init__(self):
-        if Door.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "door-frames.png")
-            Door.framesImage = view.loadScaledImage(imagePath, None)
-        animationFrames = view.processStaticFrames(Door.framesImage, 8)
+        imagePath = os.path.join(SPRITES_FOLDER, "door-frames.png")
+        animationFrames = assets.getStaticFrames(imagePath, 8)
         spriteFrames = StaticFrames(animationFrames, DOOR_FRAME_SKIP)
         OtherSprite.__init__(self, spriteFrames)
         self.opening = False
@@ -135,6 +113,16 @@ class Door(OtherSprite):
                 else:
                     self.image = self.spriteFrames.animationFrames[self.frameIndex]
     
+    # override
+    def getProgress(self):
+        return OtherSprite.getProgress(self), self.opening, self.frameCount, self.frameIndex
+    
+    # override
+    def setProgress(self, progress):
+        spriteProgress, self.opening, self.frameCount, self.frameIndex = progress
+        OtherSprite.setProgress(self, spriteProgress)
+        self.image = self.spriteFrames.animationFrames[self.frameIndex]
+        
     def opened(self):
         metadata = DoorMetadata(self.uid, self.tilePosition, self.level)
         metadata.applyMapActions(self.rpgMap)
@@ -150,16 +138,12 @@ class Door(OtherSprite):
 
 class Checkpoint(OtherSprite):
     
-    framesImage = None
-    
     baseRectSize = (8 * SCALAR, BASE_RECT_HEIGHT)
         
     def __init__(self):
-        if Checkpoint.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "check-frames.png")
-            Checkpoint.framesImage = view.loadScaledImage(imagePath, None)        
-        animationFrames = view.processStaticFrames(Checkpoint.framesImage, 4)
-        spriteFrames = StaticFrames(animationFrames, CHECKPOINT_FRAME_SKIP)
+        imagePath = os.path.join(SPRITES_FOLDER, "check-frames.png")
+        animationFrames = assets.getStaticFrames(imagePath, 4)
+        spriteFrames = StaticFrames(animationFrames, CHECKPOINT_FRAME_SKIP, animationClock)
         OtherSprite.__init__(self, spriteFrames, (3, -3))
         
     def processCollision(self, player):
@@ -175,13 +159,9 @@ class Checkpoint(OtherSprite):
         
 class Shadow(OtherSprite):
     
-    framesImage = None
-    
     def __init__(self):
-        if Shadow.framesImage is None:    
-            imagePath = os.path.join(SPRITES_FOLDER, "shadow.png")
-            Shadow.framesImage = view.loadScaledImage(imagePath, None)        
-        animationFrames = view.processStaticFrames(Shadow.framesImage, 1)
+        imagePath = os.path.join(SPRITES_FOLDER, "shadow.png")
+        animationFrames = assets.getStaticFrames(imagePath, 1)
         spriteFrames = StaticFrames(animationFrames)
         OtherSprite.__init__(self, spriteFrames, (4, 2))
         self.upright = False
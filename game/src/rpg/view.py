@@ -19,6 +19,12 @@ VIEW_HEIGHT = TILE_SIZE * 7
 
 TRANSPARENT_COLOUR = GREEN
 
+# when True, sprite frames are drawn as they are and any map tiles that should
+# appear in front of a sprite are drawn over it - see sprites.RpgSprites.draw.
+# Otherwise a masked sprite gets a copy of its frame that the tiles are blitted
+# onto - see spriteframes.FramePool.
+OCCLUSION_MODE = True
+
 NONE = 0
 UP = 1
 DOWN = 2
@@ -27,8 +33,18 @@ RIGHT = 8
 
 DIRECTIONS = [UP, DOWN, LEFT, RIGHT]
 
+"""
+Converts an image to the pixel format of the display, so that it's quicker to
+draw.  Without a display - eg. when the game runs headless - images are left in
+the format they were loaded or created in.
+"""
+def convertImage(image):
+    if pygame.display.get_surface():
+        return image.convert()
+    return image
+
 def createRectangle(dimensions, colour = None):
-    rectangle = pygame.Surface(dimensions).convert()
+    rectangle = convertImage(pygame.Surface(dimensions, 0, 32))
     if colour is not None:
         rectangle.fill(colour)
     return rectangle
@@ -39,7 +55,7 @@ def loadImage(imagePath, colourKey = None):
     except pygame.error, message:
         print "Cannot load image: ", os.path.abspath(imagePath)
         raise SystemExit, message
-    image = image.convert()
+    image = convertImage(image)
     if colourKey is not None:
         image.set_colorkey(colourKey, RLEACCEL)
     return image
@@ -75,18 +91,6 @@ def processMovementFrames(framesImage, numFrames = 4):
         row += 1
     return animationFrames
 
-# create a copy of the given animation frames
-def copyMovementFrames(animationFrames):
-    # map of image lists for animation keyed on direction
-    animationFramesCopy = {}
-    for direction in DIRECTIONS:
-        framesCopy = []
-        for frame in animationFrames[direction]:
-            img = createDuplicateSpriteImage(frame)
-            framesCopy.append(img)
-        animationFramesCopy[direction] = framesCopy
-    return animationFramesCopy
-
 # process animation frames from the composite image
 def processStaticFrames(framesImage, numFrames = 4):
     framesRect = framesImage.get_rect()
@@ -99,20 +103,34 @@ def processStaticFrames(framesImage, numFrames = 4):
         animationFrames.append(img)
     return animationFrames
 
-# create a copy of the given animation frames
-def copyStaticFrames(animationFrames):
-    # map of image lists for animation keyed on direction
-    animationFramesCopy = []
+# make the given animation frames ready to be shared - they only need to be made transparent
+def shareMovementFrames(animationFrames):
+    for direction in DIRECTIONS:
+        shareStaticFrames(animationFrames[direction])
+    return animationFrames
+
+# make the given animation frames ready to be shared - they only need to be made transparent
+def shareStaticFrames(animationFrames):
     for frame in animationFrames:
-        img = createDuplicateSpriteImage(frame)
-        animationFramesCopy.append(img)
-    return animationFramesCopy
+        frame.set_colorkey(TRANSPARENT_COLOUR, RLEACCEL)
+    return animationFrames
 
 def createTransparentRect(dimensions):
     transparentRect = createRectangle(dimensions, TRANSPARENT_COLOUR)
     transparentRect.set_colorkey(TRANSPARENT_COLOUR, RLEACCEL)
     return transparentRect
 
+# merges any overlapping rectangles so that no area is drawn twice
+def mergeRects(rects):
+    mergedRects = []
+    for rect in rects:
+        i = rect.collidelist(mergedRects)
+        while i >= 0:
+            rect = rect.union(mergedRects.pop(i))
+            i = rect.collidelist(mergedRects)
+        mergedRects.append(rect)
+    return mergedRects
+
 def processFontImage(fontImage, charWidth, rows = 1):
     charImages = []
     charHeight = fontImage.get_height() // rows